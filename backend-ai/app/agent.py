@@ -1,62 +1,170 @@
-from langchain_openai import ChatOpenAI
-from chroma_store import get_chroma_retriever
-from tools import estimate_travel_time_minutes
+from settings import get_llm, llm_configured
+from chroma_store import search_city_pois, asearch_city_pois, upsert_generated_pois, normalize_city, get_embeddings
+from city_snapshot import city_snapshots
+from tools import travel_time_matrix, atravel_time_matrix
+from scheduler import plan_day_routes, order_day
+from opening_hours import trip_days
+from poi_table import PoiTable, as_table
+from cache import MISSING, LRUCache, lazy_cache
+from singleflight import SingleFlight, AsyncSingleFlight
+from json_stream import JsonObjectStream
+from spatial import spatial_indexes, CityIndex
+from observability import get_logger, span, LLM_FALLBACKS, UPSTREAM_ERRORS, record_token_usage
+from upstream import llm_upstream, UpstreamError, LLM_HEDGE_AFTER_SECS
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
+import asyncio
+import math
+import threading
 import os
+import time
 import json
 import re
-from dotenv import load_dotenv
-from pathlib import Path
-
-# Load environment variables from .env file
-# Try current directory first, then parent directory (backend-ai/)
-env_path = Path(__file__).parent / '.env'
-if not env_path.exists():
-    env_path = Path(__file__).parent.parent / '.env'
-load_dotenv(env_path)
-
-# Initialize OpenAI/OpenRouter LLM
-llm = None
-api_key = os.getenv("OPENAI_API_KEY")
-if api_key:
-    model = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
-    base_url = os.getenv("OPENAI_BASE_URL")
-    
-    if base_url:
-        # Using OpenRouter or custom endpoint
-        # ChatOpenAI uses chat/completions endpoint which OpenRouter requires
-        llm = ChatOpenAI(
-            temperature=0.0,
-            model=model,
-            base_url=base_url,
-            api_key=api_key
-        )
+
+logger = get_logger("agent")
+
+# LLM-generated POIs are refreshed after this long, both in the cache below and in ChromaDB
+POI_CACHE_TTL_SECS = int(os.getenv("POI_CACHE_TTL_SECS", str(7 * 24 * 3600)))
+# LLM-generated POI sets, keyed by normalized city + interests (+ max_pois for
+# sets that generation may have cut short).
+get_generated_poi_cache = lazy_cache(
+    "generated_pois",
+    os.getenv("POI_CACHE_PATH", "./cache/poi_cache.sqlite"),
+    memory_size=int(os.getenv("POI_CACHE_MEMORY_SIZE", "1000")),
+    disk_size=int(os.getenv("POI_CACHE_DISK_SIZE", "50000")),
+    ttl=POI_CACHE_TTL_SECS,
+)
+# Finished itineraries, keyed by the canonical trip (plan_request_key). The
+# SQLite tier is shared by every worker on the host. Entries for a city are
+# dropped when its POIs are reloaded or invalidated; with a disk tier there is
+# no per-worker memory tier, so no worker serves an itinerary another dropped.
+get_itinerary_cache = lazy_cache(
+    "itineraries",
+    os.getenv("ITINERARY_CACHE_PATH", "./cache/itinerary_cache.sqlite"),
+    memory_size=int(os.getenv("ITINERARY_CACHE_MEMORY_SIZE", "2000")),
+    disk_size=int(os.getenv("ITINERARY_CACHE_DISK_SIZE", "100000")),
+    ttl=int(os.getenv("ITINERARY_CACHE_TTL_SECS", str(6 * 3600))),
+    shared=True,
+)
+# Ranked candidates and travel matrix behind recent plans, by plan_request_key,
+# so /replan can re-schedule an itinerary without retrieval or travel estimates
+plan_contexts = LRUCache(
+    maxsize=int(os.getenv("PLAN_CONTEXT_CACHE_SIZE", "500")),
+    ttl=int(os.getenv("ITINERARY_CACHE_TTL_SECS", str(6 * 3600))),
+)
+# Chroma write-back runs off the request path
+_writeback_pool = None
+_writeback_pool_lock = threading.Lock()
+# Identical in-flight work is computed once and shared by every waiter
+plan_flight = SingleFlight("plan_itinerary")
+poi_generation_flight = SingleFlight("generate_pois")
+async_plan_flight = AsyncSingleFlight("plan_itinerary_async")
+async_poi_generation_flight = AsyncSingleFlight("generate_pois_async")
+# Candidate POIs fetched per plan from the city's ChromaDB documents
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "20"))
+# Concurrency limit for query embeddings in the async pipeline (LLM limits live in upstream.llm_upstream)
+_retrieval_semaphore = asyncio.Semaphore(int(os.getenv("EMBEDDINGS_MAX_CONCURRENCY", "32")))
+# LLM POI generation stops reading once a trip has enough POIs: never fewer
+# than GENERATED_POIS_MIN, otherwise about one per MINUTES_PER_GENERATED_POI of trip time
+GENERATED_POIS_MIN = int(os.getenv("GENERATED_POIS_MIN", "10"))
+MINUTES_PER_GENERATED_POI = 110
+# Every day starts at 9 AM
+DAY_START_MINUTES = 9 * 60
+# Default search radius for trips anchored on a location (e.g. the hotel)
+DEFAULT_NEAR_RADIUS_KM = float(os.getenv("DEFAULT_NEAR_RADIUS_KM", "3"))
+
+def poi_cache_key(destination_city: str, user_prefs: Dict) -> str:
+    interests = sorted({str(i).lower().strip() for i in user_prefs.get("interests", []) if str(i).strip()})
+    return f"{normalize_city(destination_city)}|{','.join(interests)}"
+
+def _get_writeback_pool():
+    global _writeback_pool
+    with _writeback_pool_lock:
+        if _writeback_pool is None:
+            _writeback_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writeback")
+        return _writeback_pool
+
+def _write_back_pois(destination_city: str, pois: List[Dict]):
+    try:
+        count = upsert_generated_pois(destination_city, pois)
+        logger.info(f"Wrote {count} generated POIs for {destination_city} back into ChromaDB")
+    except Exception as e:
+        UPSTREAM_ERRORS.inc(upstream="chroma")
+        logger.warning(f"Failed to write generated POIs for {destination_city} into ChromaDB: {str(e)}")
+
+def _truncated_key(key: str, max_pois: int = None) -> str:
+    """Cache key for a POI set that may have been cut short at max_pois"""
+    return f"{key}|{max_pois or ''}"
+
+def _cached_pois(key: str, max_pois: int = None):
+    cached = get_generated_poi_cache().get(key)
+    if cached is MISSING and max_pois:
+        cached = get_generated_poi_cache().get(_truncated_key(key, max_pois))
+    return cached
+
+def _cache_generated_pois(key: str, destination_city: str, pois: List[Dict], max_pois: int = None):
+    if max_pois and len(pois) >= max_pois:
+        # Generation may have stopped early: only reused by trips needing the
+        # same number of POIs, and kept out of ChromaDB
+        get_generated_poi_cache().set(_truncated_key(key, max_pois), pois)
+        return
+    get_generated_poi_cache().set(key, pois)
+    _get_writeback_pool().submit(_write_back_pois, destination_city, pois)
+
+def get_or_generate_pois(destination_city: str, user_prefs: Dict, max_pois: int = None):
+    """generate_pois_with_llm behind the generated-POI cache, with write-back
+    into ChromaDB of complete sets (not ones stopped early at max_pois)"""
+    key = poi_cache_key(destination_city, user_prefs)
+    cached = _cached_pois(key, max_pois)
+    if cached is not MISSING:
+        logger.info(f"Using {len(cached)} cached generated POIs for {destination_city}")
+        return cached
+    return poi_generation_flight.do(_truncated_key(key, max_pois), _generate_and_cache_pois,
+                                    key, destination_city, user_prefs, max_pois)
+
+def _generate_and_cache_pois(key: str, destination_city: str, user_prefs: Dict, max_pois: int = None):
+    with span("poi_generation", city=destination_city):
+        pois = generate_pois_with_llm(destination_city, user_prefs, max_pois)
+    if pois:
+        _cache_generated_pois(key, destination_city, pois, max_pois)
+    return pois
+
+async def aget_or_generate_pois(destination_city: str, user_prefs: Dict, max_pois: int = None):
+    """Async get_or_generate_pois"""
+    key = poi_cache_key(destination_city, user_prefs)
+    cached = _cached_pois(key, max_pois)
+    if cached is not MISSING:
+        logger.info(f"Using {len(cached)} cached generated POIs for {destination_city}")
+        return cached
+    return await async_poi_generation_flight.do(_truncated_key(key, max_pois), _agenerate_and_cache_pois,
+                                                key, destination_city, user_prefs, max_pois)
+
+async def _agenerate_and_cache_pois(key: str, destination_city: str, user_prefs: Dict, max_pois: int = None):
+    with span("poi_generation", city=destination_city):
+        pois = await agenerate_pois_with_llm(destination_city, user_prefs, max_pois)
+    if pois:
+        _cache_generated_pois(key, destination_city, pois, max_pois)
+    return pois
+
+def invalidate_generated_pois(destination_city: str = None):
+    """Drop cached generated POIs for one city (any interests) or for every city,
+    along with the itineraries planned from them"""
+    if destination_city:
+        get_generated_poi_cache().delete_prefix(f"{normalize_city(destination_city)}|")
     else:
-        # Using standard OpenAI endpoint
-        llm = ChatOpenAI(temperature=0.0, model=model)
+        get_generated_poi_cache().clear()
+    invalidate_itineraries(destination_city)
 
 def rank_pois(pois: List[Dict], user_prefs: Dict):
-    scored = []
-    prefer_cats = user_prefs.get("interests", [])
-    for p in pois:
-        score = 0
-        cats = str(p.get("category","")).lower()
-        for ic in prefer_cats:
-            if ic.lower() in cats:
-                score += 10
-        score -= p.get("duration_mins",60)/60.0
-        scored.append((score,p))
-    scored.sort(key=lambda x: -x[0])
-    return [p for s,p in scored]
-
-def generate_pois_with_llm(destination_city: str, user_prefs: Dict):
-    """Generate POIs using LLM when ChromaDB doesn't have data for the city"""
-    if not llm:
-        print("LLM not initialized, cannot generate POIs")
-        return []
-    
+    return list(rank_table(pois, user_prefs))
+
+def rank_table(pois, user_prefs: Dict) -> PoiTable:
+    """rank_pois, but returns the columnar PoiTable the planner works on"""
+    return as_table(pois).ranked(user_prefs.get("interests", []))
+
+def _poi_generation_prompt(destination_city: str, user_prefs: Dict) -> str:
     interests = ', '.join(user_prefs.get('interests', []))
-    prompt = f"""You are a travel guide expert. Generate exactly 10-15 popular points of interest (POIs) for {destination_city}.
+    return f"""You are a travel guide expert. Generate exactly 10-15 popular points of interest (POIs) for {destination_city}.
 
 Requirements for each POI:
 1. name: Exact name of the attraction/place (string)
@@ -74,317 +182,729 @@ Example of correct format (use this exact structure):
 [{{"name": "Museum Name", "category": "art,museums", "desc": "Description here", "duration_mins": 120, "lat": 40.7128, "lng": -74.0060}}, {{"name": "Park Name", "category": "nature,parks", "desc": "Description", "duration_mins": 90, "lat": 40.7580, "lng": -73.9855}}]
 
 Now generate POIs for {destination_city}:"""
+
+def _response_text(response) -> str:
+    """Extract the text from whatever the LLM client returned"""
+    # Handle response - ChatOpenAI returns AIMessage or similar
+    if hasattr(response, 'content'):
+        response = response.content
+    elif hasattr(response, 'text'):
+        response = response.text
+    elif hasattr(response, 'message'):
+        # Some responses have message.content
+        response = response.message.content if hasattr(response.message, 'content') else str(response.message)
+    elif not isinstance(response, str):
+        response = str(response)
+    
+    logger.debug(f"LLM response (first 200 chars): {response[:200]}")
+    return response
+
+def _parse_generated_pois(response: str, destination_city: str) -> List[Dict]:
+    # Clean response - remove markdown code blocks if present
+    response = re.sub(r'```json\s*', '', response)
+    response = re.sub(r'```\s*', '', response)
+    response = response.strip()
     
+    # Extract JSON from response if it contains other text
+    json_match = re.search(r'\[.*\]', response, re.DOTALL)
+    if json_match:
+        response = json_match.group(0)
+    
+    pois = json.loads(response)
+    
+    # Validate and ensure all POIs have required fields
+    validated_pois = [v for v in (_validate_poi(poi) for poi in pois) if v is not None]
+    
+    logger.info(f"Successfully generated {len(validated_pois)} POIs for {destination_city}")
+    return validated_pois
+
+def _validate_poi(poi):
+    """Generated POI with every required field filled in, or None if unusable"""
+    if not isinstance(poi, dict) or 'name' not in poi:
+        return None
+    return {
+        'name': poi.get('name', 'Unknown'),
+        'category': poi.get('category', 'general'),
+        'desc': poi.get('desc', ''),
+        'duration_mins': poi.get('duration_mins', 60),
+        'lat': poi.get('lat', 0.0),
+        'lng': poi.get('lng', 0.0)
+    }
+
+def _chunk_text(chunk) -> str:
+    content = getattr(chunk, 'content', chunk)
+    return content if isinstance(content, str) else ""
+
+class _StreamedPois:
+    """Collects validated POIs from streamed LLM output and says when to stop reading"""
+
+    def __init__(self, destination_city: str, max_pois: int = None):
+        self.destination_city = destination_city
+        self.max_pois = max_pois
+        self.parser = JsonObjectStream()
+        self.pois = []
+        self.text = []
+        self.first_poi_at = None
+        self.started = time.perf_counter()
+
+    def feed(self, chunk) -> bool:
+        """Returns True once enough POIs have arrived"""
+        # With stream_usage the final chunk carries the token counts
+        record_token_usage(getattr(chunk, "usage_metadata", None))
+        text = _chunk_text(chunk)
+        self.text.append(text)
+        for obj in self.parser.feed(text):
+            poi = _validate_poi(obj)
+            if poi is None:
+                continue
+            if self.first_poi_at is None:
+                self.first_poi_at = time.perf_counter()
+            self.pois.append(poi)
+        return self.max_pois is not None and len(self.pois) >= self.max_pois
+
+    def result(self, stopped_early: bool) -> List[Dict]:
+        if not self.pois:
+            # Nothing parsed incrementally; let the whole-response parser report what went wrong
+            return _parse_generated_pois("".join(self.text), self.destination_city)
+        pois = self.pois[:self.max_pois] if self.max_pois else self.pois
+        notes = []
+        if stopped_early:
+            notes.append(f"stopped early at {len(pois)}")
+        if self.parser.pending:
+            notes.append("output truncated, kept valid prefix")
+        if self.parser.skipped:
+            notes.append(f"skipped {self.parser.skipped} malformed objects")
+        first = round((self.first_poi_at - self.started) * 1000)
+        logger.info(f"Successfully generated {len(pois)} POIs for {self.destination_city} "
+              f"(first after {first} ms{'; ' + '; '.join(notes) if notes else ''})")
+        return pois
+
+def pois_needed(dates: Dict, day_hours=8):
+    """How many generated POIs a trip can use; None when the trip length is unknown"""
+    days = trip_days(dates)
+    if not days:
+        return None
+    return max(GENERATED_POIS_MIN, math.ceil(days * day_hours * 60 / MINUTES_PER_GENERATED_POI))
+
+def _log_generation_error(e: Exception):
+    cause = e.__cause__ if isinstance(e, UpstreamError) and e.__cause__ is not None else e
+    if isinstance(cause, json.JSONDecodeError):
+        logger.error(f"JSON decode error generating POIs with LLM: {str(cause)}; response was: {cause.doc[:500]}")
+    else:
+        logger.error(f"Error generating POIs with LLM: {str(e)}")
+
+def _stream_pois_once(timeout, cancelled, llm, messages, destination_city: str, max_pois: int = None):
+    """One streamed generation attempt. Stops reading at max_pois, when a hedged
+    twin has already won (returns None), or at timeout, keeping what parsed."""
+    streamed = _StreamedPois(destination_city, max_pois)
+    give_up_at = time.monotonic() + timeout
+    stopped_early = False
+    for chunk in llm.stream(messages, timeout=timeout):
+        if streamed.feed(chunk):
+            stopped_early = True
+            break
+        if cancelled.is_set():
+            return None
+        if time.monotonic() > give_up_at:
+            if not streamed.pois:
+                raise TimeoutError(f"no POIs after {timeout:.0f}s")
+            stopped_early = True
+            break
+    return streamed.result(stopped_early)
+
+def _invoke_pois_once(timeout, cancelled, llm, messages, prompt: str, destination_city: str):
+    """One attempt for clients without streaming"""
+    # Use invoke() for ChatOpenAI
+    if hasattr(llm, 'invoke'):
+        response = llm.invoke(messages, timeout=timeout)
+    elif hasattr(llm, 'predict'):
+        response = llm.predict(prompt)
+    else:
+        response = llm(messages)
+    record_token_usage(getattr(response, "usage_metadata", None))
+    return _parse_generated_pois(_response_text(response), destination_city)
+
+async def _astream_pois_once(timeout, llm, messages, destination_city: str, max_pois: int = None):
+    """Async _stream_pois_once; a losing hedged attempt is cancelled, which closes its stream"""
+    streamed = _StreamedPois(destination_city, max_pois)
+    give_up_at = time.monotonic() + timeout
+    stopped_early = False
+    stream = llm.astream(messages, timeout=timeout)
+    try:
+        async for chunk in stream:
+            if streamed.feed(chunk):
+                stopped_early = True
+                break
+            if time.monotonic() > give_up_at:
+                if not streamed.pois:
+                    raise TimeoutError(f"no POIs after {timeout:.0f}s")
+                stopped_early = True
+                break
+    finally:
+        # Closing the stream drops the connection so no more tokens are generated
+        await stream.aclose()
+    return streamed.result(stopped_early)
+
+def generate_pois_with_llm(destination_city: str, user_prefs: Dict, max_pois: int = None):
+    """Generate POIs using LLM when ChromaDB doesn't have data for the city.
+
+    The completion is streamed and POIs are parsed as each object closes, so
+    a malformed tail only loses the objects after it. Reading stops once
+    max_pois POIs have arrived. Calls go through llm_upstream (timeouts,
+    retries, hedging); on failure an empty list is returned.
+    """
+    llm = get_llm()
+    if not llm:
+        logger.warning("LLM not initialized, cannot generate POIs")
+        return []
+    
+    prompt = _poi_generation_prompt(destination_city, user_prefs)
     try:
-        print(f"Calling LLM to generate POIs for {destination_city}...")
+        logger.info(f"Calling LLM to generate POIs for {destination_city}...")
         
         # ChatOpenAI uses invoke() with messages format
         # Convert prompt to message format for chat models
         from langchain_core.messages import HumanMessage
         messages = [HumanMessage(content=prompt)]
         
-        # Use invoke() for ChatOpenAI
-        if hasattr(llm, 'invoke'):
-            response = llm.invoke(messages)
-        elif hasattr(llm, 'predict'):
-            response = llm.predict(prompt)
-        else:
-            response = llm(messages)
-        
-        print(f"LLM response type: {type(response)}")
-        
-        # Handle response - ChatOpenAI returns AIMessage or similar
-        if hasattr(response, 'content'):
-            response = response.content
-        elif hasattr(response, 'text'):
-            response = response.text
-        elif hasattr(response, 'message'):
-            # Some responses have message.content
-            response = response.message.content if hasattr(response.message, 'content') else str(response.message)
-        elif not isinstance(response, str):
-            response = str(response)
-        
-        print(f"LLM response (first 200 chars): {response[:200]}")
-        
-        # Clean response - remove markdown code blocks if present
-        response = re.sub(r'```json\s*', '', response)
-        response = re.sub(r'```\s*', '', response)
-        response = response.strip()
-        
-        # Extract JSON from response if it contains other text
-        json_match = re.search(r'\[.*\]', response, re.DOTALL)
-        if json_match:
-            response = json_match.group(0)
-        
-        pois = json.loads(response)
-        
-        # Validate and ensure all POIs have required fields
-        validated_pois = []
-        for poi in pois:
-            if isinstance(poi, dict) and 'name' in poi:
-                # Ensure all required fields exist
-                validated_poi = {
-                    'name': poi.get('name', 'Unknown'),
-                    'category': poi.get('category', 'general'),
-                    'desc': poi.get('desc', ''),
-                    'duration_mins': poi.get('duration_mins', 60),
-                    'lat': poi.get('lat', 0.0),
-                    'lng': poi.get('lng', 0.0)
-                }
-                validated_pois.append(validated_poi)
-        
-        print(f"Successfully generated {len(validated_pois)} POIs for {destination_city}")
-        return validated_pois
-        
-    except json.JSONDecodeError as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"JSON decode error generating POIs with LLM: {str(e)}")
-        print(f"Response was: {response[:500] if 'response' in locals() else 'No response'}")
-        print(error_details)
+        if hasattr(llm, 'stream'):
+            return llm_upstream.hedged(_stream_pois_once, llm, messages, destination_city, max_pois,
+                                       hedge_after=LLM_HEDGE_AFTER_SECS)
+        return llm_upstream.call(_invoke_pois_once, threading.Event(), llm, messages, prompt, destination_city)
+    except Exception as e:
+        _log_generation_error(e)
         return []
+
+async def agenerate_pois_with_llm(destination_city: str, user_prefs: Dict, max_pois: int = None):
+    """Async generate_pois_with_llm: awaits the model instead of holding a worker thread"""
+    llm = get_llm()
+    if not llm:
+        logger.warning("LLM not initialized, cannot generate POIs")
+        return []
+    
+    prompt = _poi_generation_prompt(destination_city, user_prefs)
+    try:
+        logger.info(f"Calling LLM to generate POIs for {destination_city}...")
+        from langchain_core.messages import HumanMessage
+        messages = [HumanMessage(content=prompt)]
+        return await llm_upstream.ahedged(_astream_pois_once, llm, messages, destination_city, max_pois,
+                                          hedge_after=LLM_HEDGE_AFTER_SECS)
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Error generating POIs with LLM: {str(e)}")
-        print(f"Response was: {response[:500] if 'response' in locals() else 'No response'}")
-        print(error_details)
+        _log_generation_error(e)
         return []
 
+def plan_request_key(destination_city: str, dates: Dict, user_prefs: Dict, day_hours) -> str:
+    """Canonical form of a trip: requests that must produce the same itinerary get the same key.
+
+    City and interests are normalized as in poi_cache_key, dates only count
+    through the number of days, and a "near" anchor is rounded like travel
+    cache coordinates (~11 m) with its default radius filled in.
+    """
+    near = user_prefs.get("near")
+    if near:
+        radius_km = float(near.get("radius_km", DEFAULT_NEAR_RADIUS_KM))
+        near = f"{round(float(near['lat']), 4)},{round(float(near['lng']), 4)},{radius_km:g}"
+    return f"{poi_cache_key(destination_city, user_prefs)}|{trip_days(dates) or ''}|{day_hours}|{near or ''}"
+
+def _cached_itinerary(key: str, destination_city: str):
+    cached = get_itinerary_cache().get(key)
+    if cached is MISSING:
+        return None
+    # The key normalizes the city name; echo it back as this request spelled it
+    return {**cached, "city": destination_city}
+
+def _cache_itinerary(key: str, result: Dict):
+    # Errors (no POIs, LLM down) are not cached so the next request retries
+    if isinstance(result, dict) and "itinerary" in result:
+        get_itinerary_cache().set(key, result)
+    return result
+
+def invalidate_itineraries(destination_city: str = None):
+    """Drop cached itineraries (and their plan contexts) for one city or for every city"""
+    if destination_city:
+        get_itinerary_cache().delete_prefix(f"{normalize_city(destination_city)}|")
+        plan_contexts.delete_prefix(f"{normalize_city(destination_city)}|")
+    else:
+        get_itinerary_cache().clear()
+        plan_contexts.clear()
+
 def plan_itinerary(destination_city: str, dates: Dict, user_prefs: Dict, day_hours=8):
-    if not llm:
+    """Plan a trip: served from the itinerary cache when an equivalent trip was
+    planned recently, otherwise shared with identical requests already in flight"""
+    key = plan_request_key(destination_city, dates, user_prefs, day_hours)
+    cached = _cached_itinerary(key, destination_city)
+    if cached is not None:
+        return cached
+    result = plan_flight.do(key, _plan_itinerary, destination_city, dates, user_prefs, day_hours=day_hours)
+    return _cache_itinerary(key, result)
+
+async def aplan_itinerary(destination_city: str, dates: Dict, user_prefs: Dict, day_hours=8):
+    """Async plan_itinerary: LLM, embedding and maps I/O are awaited, not blocking"""
+    key = plan_request_key(destination_city, dates, user_prefs, day_hours)
+    cached = _cached_itinerary(key, destination_city)
+    if cached is not None:
+        return cached
+    result = await async_plan_flight.do(key, _aplan_itinerary, destination_city, dates, user_prefs, day_hours=day_hours)
+    return _cache_itinerary(key, result)
+
+def _plan_itinerary(destination_city: str, dates: Dict, user_prefs: Dict, day_hours=8):
+    if not llm_configured():
         return {"error": "OpenAI API key not configured. Please set OPENAI_API_KEY environment variable."}
     
+    snapshot = city_snapshots.get(destination_city)
+    if snapshot is not None:
+        ranked, travel_matrix, error = _snapshot_candidates(snapshot, destination_city, user_prefs)
+        if error:
+            return error
+    else:
+        pois, error = _retrieve_pois(destination_city, user_prefs, max_pois=pois_needed(dates, day_hours))
+        if error:
+            return error
+
+        with span("ranking", pois=len(pois)):
+            ranked, error = _rank_candidates(destination_city, pois, user_prefs)
+        if error:
+            return error
+
+        # Travel times for every pair of ranked POIs, computed once up front
+        with span("travel_matrix", pois=len(ranked)):
+            travel_matrix = travel_time_matrix(ranked)
+    plan_contexts.set(plan_request_key(destination_city, dates, user_prefs, day_hours), (ranked, travel_matrix))
+
+    with span("scheduling", pois=len(ranked)):
+        return build_itinerary(destination_city, ranked, travel_matrix, day_hours, dates)
+
+async def _aplan_itinerary(destination_city: str, dates: Dict, user_prefs: Dict, day_hours=8, on_event=None):
+    """Async _plan_itinerary. on_event, when given, receives the progress and
+    day events of astream_itinerary as each stage finishes."""
+    if not llm_configured():
+        return {"error": "OpenAI API key not configured. Please set OPENAI_API_KEY environment variable."}
+
+    emit = on_event or (lambda event: None)
+    ranked, travel_matrix, error = await _aprepare_plan(destination_city, dates, user_prefs, day_hours, emit)
+    if error:
+        return error
+
+    emit({"event": "progress", "stage": "scheduling"})
+    unscheduled = []
+    itinerary = []
+    with span("scheduling", pois=len(ranked)):
+        for day in iter_itinerary_days(ranked, travel_matrix, day_hours, dates, unscheduled):
+            itinerary.append(day)
+            if on_event is not None:
+                emit({"event": "day", "city": destination_city, **day})
+                # Let the server flush this day before packing the next one
+                await asyncio.sleep(0)
+    result = {"city": destination_city, "itinerary": itinerary}
+    if unscheduled:
+        result["unscheduled"] = unscheduled
+    return result
+
+async def _aprepare_plan(destination_city: str, dates: Dict, user_prefs: Dict, day_hours, emit):
+    """Everything before scheduling: snapshot or retrieval/generation, ranking and
+    the travel matrix, remembered in plan_contexts. Returns (ranked, travel_matrix, error)."""
+    snapshot = city_snapshots.get(destination_city)
+    if snapshot is not None:
+        ranked, travel_matrix, error = await _asnapshot_candidates(snapshot, destination_city, user_prefs)
+        if error:
+            return None, None, error
+        emit({"event": "progress", "stage": "pois_ready", "count": len(ranked)})
+    else:
+        pois, error = await _aretrieve_pois(destination_city, user_prefs, max_pois=pois_needed(dates, day_hours))
+        if error:
+            return None, None, error
+
+        with span("ranking", pois=len(pois)):
+            ranked, error = await _arank_candidates(destination_city, pois, user_prefs)
+        if error:
+            return None, None, error
+        emit({"event": "progress", "stage": "pois_ready", "count": len(ranked)})
+
+        emit({"event": "progress", "stage": "estimating_travel_times"})
+        with span("travel_matrix", pois=len(ranked)):
+            travel_matrix = await atravel_time_matrix(ranked)
+    plan_contexts.set(plan_request_key(destination_city, dates, user_prefs, day_hours), (ranked, travel_matrix))
+    return ranked, travel_matrix, None
+
+def _ranked_from_snapshot(snapshot, destination_city: str, user_prefs: Dict, query_vector):
+    """Candidates picked, ranked and given travel times the way the ChromaDB path
+    does it, but from the compiled snapshot. Returns (ranked, travel_matrix, error)."""
+    near = user_prefs.get("near")
+    with span("ranking", pois=len(snapshot)):
+        if near:
+            radius_km = float(near.get("radius_km", DEFAULT_NEAR_RADIUS_KM))
+            rows = snapshot.within_radius(near["lat"], near["lng"], radius_km)
+            if not len(rows):
+                return None, None, {"error": f"No POIs found within {radius_km} km of the requested location in {destination_city}."}
+            ranked, rows = snapshot.ranked(rows, user_prefs.get("interests", []), RETRIEVAL_K)
+        else:
+            ranked, rows = snapshot.ranked(snapshot.search(query_vector, RETRIEVAL_K), user_prefs.get("interests", []))
+    with span("travel_matrix", pois=len(ranked)):
+        travel_matrix = snapshot.travel_matrix(rows)
+    return ranked, travel_matrix, None
+
+def _snapshot_candidates(snapshot, destination_city: str, user_prefs: Dict):
+    """(ranked, travel_matrix, error) from the city's snapshot; no ChromaDB, LLM or Distance Matrix calls"""
+    query_vector = None
+    if not user_prefs.get("near"):
+        with span("retrieval", city=destination_city, source="snapshot"):
+            query_vector = get_embeddings().embed_query(_retrieval_query(destination_city, user_prefs))
+    return _ranked_from_snapshot(snapshot, destination_city, user_prefs, query_vector)
+
+async def _asnapshot_candidates(snapshot, destination_city: str, user_prefs: Dict):
+    query_vector = None
+    if not user_prefs.get("near"):
+        async with _retrieval_semaphore:
+            with span("retrieval", city=destination_city, source="snapshot"):
+                query_vector = await get_embeddings().aembed_query(_retrieval_query(destination_city, user_prefs))
+    return _ranked_from_snapshot(snapshot, destination_city, user_prefs, query_vector)
+
+def _rank_candidates(destination_city: str, pois: List[Dict], user_prefs: Dict):
+    """Rank POIs for the trip. With user_prefs["near"] = {"lat", "lng", "radius_km"},
+    candidates come from the city's spatial index instead, so the whole catalog
+    is searched rather than just the retrieved top-k. Returns (ranked, error)."""
+    near = user_prefs.get("near")
+    if not near:
+        return rank_table(pois, user_prefs), None
+    lat, lng = float(near["lat"]), float(near["lng"])
+    radius_km = float(near.get("radius_km", DEFAULT_NEAR_RADIUS_KM))
+    candidates = spatial_indexes.get(destination_city).within_radius(lat, lng, radius_km)
+    if not candidates:
+        # City not indexed yet (e.g. POIs just generated): filter what we have
+        candidates = CityIndex(pois).within_radius(lat, lng, radius_km)
+    if not candidates:
+        return None, {"error": f"No POIs found within {radius_km} km of the requested location in {destination_city}."}
+    logger.info(f"{len(candidates)} POIs within {radius_km} km of ({lat}, {lng}) in {destination_city}")
+    candidates = [{k: v for k, v in p.items() if k != "distance_km"} for p in candidates]
+    table = PoiTable(candidates)
+    return table.take(table.rank_order(user_prefs.get("interests", []))[:RETRIEVAL_K]), None
+
+async def _arank_candidates(destination_city: str, pois: List[Dict], user_prefs: Dict):
+    if not user_prefs.get("near"):
+        return rank_table(pois, user_prefs), None
+    # Building a city index reads ChromaDB, so keep it off the event loop
+    return await asyncio.to_thread(_rank_candidates, destination_city, pois, user_prefs)
+
+def _retrieval_query(destination_city: str, user_prefs: Dict) -> str:
+    return f"{destination_city} travel points of interest. Interests: {', '.join(user_prefs.get('interests',[]))}"
+
+def _city_pois_from_docs(docs, destination_city: str) -> List[Dict]:
+    # Handle different response formats
     pois = []
+    for d in docs or []:
+        if hasattr(d, 'metadata'):
+            pois.append(d.metadata)
+        elif isinstance(d, dict):
+            pois.append(d.get('metadata', d))
+        else:
+            # If document itself is the metadata
+            pois.append(d if isinstance(d, dict) else {})
+    
+    # Filter POIs to only include ones from the requested city (case-insensitive, exact match)
+    # This is CRITICAL - we must only use POIs that exactly match the requested city
+    unfiltered_count = len(pois)
+    filtered_pois = []
+    dest_city = normalize_city(destination_city)
+    stale_before = time.time() - POI_CACHE_TTL_SECS
+    for p in pois:
+        if normalize_city(p.get('city', '')) != dest_city:
+            continue
+        # Written-back LLM POIs count as missing once stale, so they get regenerated
+        if p.get('source') == 'llm' and float(p.get('generated_at') or 0) < stale_before:
+            continue
+        filtered_pois.append(p)
+    
+    logger.info(f"ChromaDB returned {unfiltered_count} POIs, filtered to {len(filtered_pois)} POIs for city '{destination_city}'")
     
+    # Only use filtered POIs if we found exact city matches
+    if filtered_pois:
+        logger.info(f"Using {len(filtered_pois)} POIs from ChromaDB for {destination_city}")
+    else:
+        # No exact city match found in ChromaDB - must generate with LLM
+        logger.info(f"No exact city match in ChromaDB for '{destination_city}' (found {unfiltered_count} unmatched POIs from other cities)")
+    return filtered_pois
+
+def _no_city_pois_error(destination_city: str):
+    logger.warning(f"LLM generation failed or returned no POIs for {destination_city}")
+    return {
+        "error": f"Could not find or generate POIs for {destination_city}. LLM generation may have failed. Please check server logs for details or try a different city."
+    }
+
+def _retrieval_failed_error(destination_city: str, e: Exception):
+    return {
+        "error": f"Failed to retrieve POIs from ChromaDB and LLM generation also failed for {destination_city}. Error: {str(e)}. Please check server logs for details."
+    }
+
+def _log_retrieval_error(e: Exception, destination_city: str):
+    UPSTREAM_ERRORS.inc(upstream="chroma")
+    logger.exception(f"Error getting POIs from ChromaDB: {str(e)}")
+    # Fallback to LLM generation
+    LLM_FALLBACKS.inc(reason="retrieval_error")
+    logger.info(f"Falling back to LLM generation for {destination_city}...")
+
+def _retrieve_pois(destination_city: str, user_prefs: Dict, k: int = None, max_pois: int = None):
+    """City POIs from ChromaDB, falling back to LLM generation. Returns (pois, error)."""
     # First try to get POIs from ChromaDB
     try:
-        retriever, db = get_chroma_retriever(k=20)
-        query = f"{destination_city} travel points of interest. Interests: {', '.join(user_prefs.get('interests',[]))}"
-        
-        # Try both methods for compatibility with different langchain versions
-        try:
-            docs = retriever.get_relevant_documents(query)
-        except AttributeError:
-            # Try invoke method for newer langchain versions
-            docs = retriever.invoke(query)
-        
-        # Handle different response formats
-        if docs:
-            pois = []
-            for d in docs:
-                if hasattr(d, 'metadata'):
-                    pois.append(d.metadata)
-                elif isinstance(d, dict):
-                    pois.append(d.get('metadata', d))
-                else:
-                    # If document itself is the metadata
-                    pois.append(d if isinstance(d, dict) else {})
-        else:
-            pois = []
-        
-        # Filter POIs to only include ones from the requested city (case-insensitive, exact match)
-        # This is CRITICAL - we must only use POIs that exactly match the requested city
-        unfiltered_count = len(pois)
-        filtered_pois = []
-        for p in pois:
-            poi_city = p.get('city', '').lower().strip()
-            dest_city = destination_city.lower().strip()
-            if poi_city == dest_city:
-                filtered_pois.append(p)
-        
-        print(f"ChromaDB returned {unfiltered_count} POIs, filtered to {len(filtered_pois)} POIs for city '{destination_city}'")
-        
-        # Only use filtered POIs if we found exact city matches
-        if filtered_pois:
-            pois = filtered_pois
-            print(f"Using {len(pois)} POIs from ChromaDB for {destination_city}")
-        else:
-            # No exact city match found in ChromaDB - must generate with LLM
-            pois = []
-            print(f"No exact city match in ChromaDB for '{destination_city}' (found {unfiltered_count} unmatched POIs from other cities)")
+        query = _retrieval_query(destination_city, user_prefs)
+        # City predicate is pushed down into Chroma as a metadata filter
+        with span("retrieval", city=destination_city):
+            docs = search_city_pois(query, destination_city, k=k or RETRIEVAL_K)
+        pois = _city_pois_from_docs(docs, destination_city)
         
         # If no matching POIs in ChromaDB, generate with LLM
         if not pois:
-            print(f"No POIs found in ChromaDB for {destination_city}, generating with LLM...")
-            generated_pois = generate_pois_with_llm(destination_city, user_prefs)
-            if generated_pois and len(generated_pois) > 0:
-                print(f"Generated {len(generated_pois)} POIs with LLM for {destination_city}")
-                pois = generated_pois
-            else:
-                print(f"LLM generation failed or returned no POIs for {destination_city}")
-                # Return error immediately to avoid going through the rest of the function
-                return {
-                    "error": f"Could not find or generate POIs for {destination_city}. LLM generation may have failed. Please check server logs for details or try a different city."
-                }
+            LLM_FALLBACKS.inc(reason="no_city_pois")
+            logger.info(f"No POIs found in ChromaDB for {destination_city}, generating with LLM...")
+            pois = get_or_generate_pois(destination_city, user_prefs, max_pois)
+            if not pois:
+                return None, _no_city_pois_error(destination_city)
+            logger.info(f"Generated {len(pois)} POIs with LLM for {destination_city}")
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Error getting POIs from ChromaDB: {str(e)}")
-        print(error_details)
-        # Fallback to LLM generation
-        print(f"Falling back to LLM generation for {destination_city}...")
-        generated_pois = generate_pois_with_llm(destination_city, user_prefs)
-        if generated_pois and len(generated_pois) > 0:
-            pois = generated_pois
-            print(f"LLM fallback successful: Generated {len(pois)} POIs for {destination_city}")
-        else:
-            return {
-                "error": f"Failed to retrieve POIs from ChromaDB and LLM generation also failed for {destination_city}. Error: {str(e)}. Please check server logs for details."
-            }
-    
-    if not pois or len(pois) == 0:
-        return {
-            "error": f"No POIs found or generated for {destination_city}. ChromaDB search failed and LLM generation returned no results. Please check server logs or try a different city."
-        }
-
-    ranked = rank_pois(pois, user_prefs)
-
-    # Improved day distribution algorithm
-    # Calculate total time needed for all POIs
-    total_time_needed = 0
-    for idx, p in enumerate(ranked):
-        dur = p.get("duration_mins", 60)
-        travel = 0
-        if idx > 0:
-            prev = ranked[idx - 1]
-            travel = estimate_travel_time_minutes(
-                {"lat": prev.get("lat", 0), "lng": prev.get("lng", 0)},
-                {"lat": p.get("lat", 0), "lng": p.get("lng", 0)}
-            )
-        total_time_needed += travel + dur
-    
-    # Estimate number of days needed
-    minutes_per_day = day_hours * 60
-    estimated_days = max(1, int((total_time_needed / minutes_per_day) + 0.5))
-    
-    # Distribute POIs more evenly across days
-    results = []
-    current_day = []
-    current_minutes = minutes_per_day
-    day_start_minutes = 0  # Track start time for the day (9 AM = 540 minutes from midnight)
-    day_start_hour = 9  # Start at 9 AM
-    
-    for idx, p in enumerate(ranked):
-        dur = p.get("duration_mins", 60)
-        travel = 0
-        if current_day:
-            last = current_day[-1]
-            travel = estimate_travel_time_minutes(
-                {"lat": last.get("lat", 0), "lng": last.get("lng", 0)},
-                {"lat": p.get("lat", 0), "lng": p.get("lng", 0)}
-            )
-        
-        # Calculate start time for this activity
-        if current_day:
-            # Start time = previous activity end time + travel time
-            last_activity = current_day[-1]
-            last_end_time = last_activity.get("end_time_minutes", day_start_hour * 60)
-            start_time_minutes = last_end_time + travel
-        else:
-            # First activity of the day starts at day_start_hour
-            start_time_minutes = day_start_hour * 60
-        
-        # Check if this activity fits within the daily time limit
-        day_end_minutes = (day_start_hour + day_hours) * 60
-        required = travel + dur
-        
-        # Check if we can fit this activity in the current day
-        # Also check if adding this would make the day too unbalanced compared to others
-        remaining_pois = len(ranked) - idx - 1
-        current_day_count = len(current_day)
-        avg_pois_per_day = len(ranked) / estimated_days if estimated_days > 0 else len(ranked)
-        remaining_days = estimated_days - len(results) - 1  # Days not yet started
-        
-        # Calculate if we should start a new day
-        # Start new day if:
-        # 1. Current day doesn't have enough time for this activity
-        # 2. Activity would exceed the day's time limit
-        # 3. Current day has significantly more activities than average AND we have days left
-        # 4. Current day is nearly full (less than 25% time left) AND we have days left AND remaining POIs can be distributed
-        should_start_new_day = False
-        if current_minutes < required:
-            should_start_new_day = True
-        elif start_time_minutes + dur > day_end_minutes:
-            # Activity would exceed day limit
-            should_start_new_day = True
-        elif remaining_days > 0:
-            # Try to balance: if current day has way more than average, start new day
-            if current_day_count > avg_pois_per_day * 1.3 and remaining_pois >= remaining_days:
-                should_start_new_day = True
-            # If day is nearly full and we have many days left, start new day
-            elif current_minutes < minutes_per_day * 0.25 and remaining_pois > remaining_days * 2:
-                should_start_new_day = True
-        
-        if should_start_new_day and current_day:
-            # Save current day and start new one
-            results.append(current_day)
-            current_day = []
-            current_minutes = minutes_per_day
-            start_time_minutes = day_start_hour * 60
-        
-        # Recalculate end time after potentially starting a new day
-        end_time_minutes = start_time_minutes + dur
-        
-        # Ensure end time doesn't exceed day limit (adjust duration if needed)
-        if end_time_minutes > day_end_minutes:
-            # Adjust duration to fit within day limit
-            dur = max(30, day_end_minutes - start_time_minutes)  # At least 30 minutes
-            end_time_minutes = start_time_minutes + dur
-            required = travel + dur  # Update required time with adjusted duration
-        
-        # Convert minutes to time string (HH:MM format)
-        start_hour = int(start_time_minutes // 60)
-        start_min = int(start_time_minutes % 60)
-        end_hour = int(end_time_minutes // 60)
-        end_min = int(end_time_minutes % 60)
-        
-        # Handle hour overflow (e.g., 25:00 -> 01:00 next day)
-        if start_hour >= 24:
-            start_hour = start_hour % 24
-        if end_hour >= 24:
-            end_hour = end_hour % 24
-        
-        start_time = f"{start_hour:02d}:{start_min:02d}"
-        end_time = f"{end_hour:02d}:{end_min:02d}"
+        _log_retrieval_error(e, destination_city)
+        pois = get_or_generate_pois(destination_city, user_prefs, max_pois)
+        if not pois:
+            return None, _retrieval_failed_error(destination_city, e)
+        logger.info(f"LLM fallback successful: Generated {len(pois)} POIs for {destination_city}")
+    return pois, None
+
+async def _aretrieve_pois(destination_city: str, user_prefs: Dict, max_pois: int = None):
+    """Async _retrieve_pois; the query embedding and LLM fallback are awaited"""
+    try:
+        query = _retrieval_query(destination_city, user_prefs)
+        async with _retrieval_semaphore:
+            with span("retrieval", city=destination_city):
+                docs = await asearch_city_pois(query, destination_city, k=RETRIEVAL_K)
+        pois = _city_pois_from_docs(docs, destination_city)
         
-        # Add activity to current day
-        # Use adjusted duration if it was modified to fit within day limit
-        activity_data = {
-            **p,
-            "duration_mins": dur,  # Use potentially adjusted duration
+        if not pois:
+            LLM_FALLBACKS.inc(reason="no_city_pois")
+            logger.info(f"No POIs found in ChromaDB for {destination_city}, generating with LLM...")
+            pois = await aget_or_generate_pois(destination_city, user_prefs, max_pois)
+            if not pois:
+                return None, _no_city_pois_error(destination_city)
+            logger.info(f"Generated {len(pois)} POIs with LLM for {destination_city}")
+    except Exception as e:
+        _log_retrieval_error(e, destination_city)
+        pois = await aget_or_generate_pois(destination_city, user_prefs, max_pois)
+        if not pois:
+            return None, _retrieval_failed_error(destination_city, e)
+        logger.info(f"LLM fallback successful: Generated {len(pois)} POIs for {destination_city}")
+    return pois, None
+
+def _format_minutes(minutes) -> str:
+    # Handle hour overflow (e.g., 25:00 -> 01:00 next day)
+    hour = int(minutes // 60) % 24
+    minute = int(minutes % 60)
+    return f"{hour:02d}:{minute:02d}"
+
+def _place_stops(route, table: PoiTable, durations, travel_matrix, day_start_minutes, day_end_minutes,
+                 clock=None, last_idx=None):
+    """Timing pass of _pack_day: ([(idx, start minutes, duration, travel), ...], leftover indices)"""
+    placed = []
+    leftovers = []
+    clock = day_start_minutes if clock is None else clock
+    windows = table.windows
+    for idx in route:
+        dur = durations[idx]
+        travel = int(travel_matrix[last_idx, idx]) if last_idx is not None else 0
+        arrival = clock + travel
+        start_time_minutes = windows[idx].earliest_start(arrival, dur, latest_end=day_end_minutes)
+        if start_time_minutes is None and last_idx is None:
+            # Alone in the day: shorten the visit to the longest open stretch (at least 30 minutes)
+            slot_start, slot_length = windows[idx].longest_slot(arrival, day_end_minutes)
+            if slot_start is not None and slot_length >= 30:
+                start_time_minutes, dur = slot_start, min(dur, slot_length)
+        if start_time_minutes is None:
+            leftovers.append(idx)
+            continue
+        placed.append((idx, start_time_minutes, dur, travel))
+        clock = start_time_minutes + dur
+        last_idx = idx
+    return placed, leftovers
+
+def _steps(table: PoiTable, placed):
+    steps = []
+    for idx, start_time_minutes, dur, travel in placed:
+        start_time = _format_minutes(start_time_minutes)
+        # Dicts are only materialized here, for the response
+        p = table.records[idx]
+        steps.append({
+            "name": p.get("name", ""),
+            "category": p.get("category", ""),
+            "duration_mins": dur,
             "travel_from_prev_mins": travel,
+            "lat": p.get("lat", 0),
+            "lng": p.get("lng", 0),
+            "desc": p.get("desc", ""),
+            "time": start_time,  # For frontend compatibility
             "start_time": start_time,
-            "end_time": end_time,
-            "start_time_minutes": start_time_minutes,
-            "end_time_minutes": end_time_minutes
-        }
-        current_day.append(activity_data)
-        
-        # Update remaining minutes for the day
-        current_minutes -= (travel + dur)
-    
-    # Add the last day if it has activities
-    if current_day:
-        results.append(current_day)
+            "end_time": _format_minutes(start_time_minutes + dur)
+        })
+    return steps
 
-    # Build itinerary with time information
-    itinerary = []
-    for idx, day in enumerate(results, start=1):
-        steps = []
-        for stop in day:
-            steps.append({
-                "name": stop.get("name", ""),
-                "category": stop.get("category", ""),
-                "duration_mins": stop.get("duration_mins", 60),
-                "travel_from_prev_mins": stop.get("travel_from_prev_mins", 0),
-                "lat": stop.get("lat", 0),
-                "lng": stop.get("lng", 0),
-                "desc": stop.get("desc", ""),
-                "time": stop.get("start_time", "09:00"),  # For frontend compatibility
-                "start_time": stop.get("start_time", "09:00"),
-                "end_time": stop.get("end_time", "10:00")
-            })
-        itinerary.append({"day": idx, "steps": steps})
-    
-    return {"city": destination_city, "itinerary": itinerary}
+def _pack_day(route, table: PoiTable, durations, travel_matrix, day_start_minutes, day_end_minutes,
+              clock=None, last_idx=None):
+    """Place stops in route order, skipping any that are closed or don't fit.
+    Pass clock and last_idx to continue a day after stops already placed.
+    Returns (steps, leftover indices)."""
+    placed, leftovers = _place_stops(route, table, durations, travel_matrix, day_start_minutes, day_end_minutes,
+                                     clock=clock, last_idx=last_idx)
+    return _steps(table, placed), leftovers
+
+def _pack_day_by_rank(route, table: PoiTable, durations, travel_matrix, day_start_minutes, day_end_minutes,
+                      deadline):
+    """_pack_day, then repair the route so the stops left over are the
+    lowest-ranked ones (indices are in rank order): each skipped stop, best
+    first, is tried at every earlier position, dropping the lowest-ranked
+    placed stops to make room, and the repair is kept if it places a
+    higher-ranked set of stops. Returns (placed indices, steps, leftover indices)."""
+    stops = sorted(route)
+
+    def pack(candidate, removed=()):
+        placed, leftovers = _place_stops(candidate, table, durations, travel_matrix, day_start_minutes,
+                                         day_end_minutes)
+        leftovers = set(leftovers) | set(removed)
+        # Leaving out a higher-ranked stop is worse than any number of lower-ranked ones, then less travel wins
+        key = (tuple(i in leftovers for i in stops), sum(stop[3] for stop in placed))
+        return key, placed, leftovers
+
+    route = list(route)
+    best_key, best_placed, best_leftovers = pack(route)
+    best_route, best_removed = route, []
+    for idx in sorted(best_leftovers):
+        if time.perf_counter() >= deadline:
+            break
+        if idx not in best_leftovers or idx in best_removed:
+            continue
+        if pack([idx])[2]:
+            continue  # Closed all day: fits nowhere
+        # Tried against the route as it was before this stop; the best may change inside the loop
+        base = [i for i in best_route if i != idx]
+        base_removed = list(best_removed)
+        for position in range(len(base) + 1):
+            candidate = base[:position] + [idx] + base[position:]
+            removed = list(base_removed)
+            key, placed, leftovers = pack(candidate, removed)
+            while idx in leftovers:
+                movable = [i for i in candidate if i > idx and i not in leftovers]
+                if not movable:
+                    break
+                removed.append(max(movable))
+                candidate = [i for i in candidate if i != removed[-1]]
+                key, placed, leftovers = pack(candidate, removed)
+            if key < best_key:
+                best_key, best_placed, best_leftovers = key, placed, leftovers
+                best_route, best_removed = candidate, removed
+    return [stop[0] for stop in best_placed], _steps(table, best_placed), sorted(best_leftovers)
+
+def build_itinerary(destination_city: str, ranked, travel_matrix, day_hours=8, dates: Dict = None):
+    """Schedule ranked POIs (dicts or a PoiTable) into days using a precomputed travel-time matrix (indexed like ranked).
+
+    Stops are only placed inside their opening hours. When dates give the trip
+    length, no more days than that are planned and whatever doesn't fit is
+    listed under "unscheduled".
+    """
+    unscheduled = []
+    itinerary = list(iter_itinerary_days(ranked, travel_matrix, day_hours, dates, unscheduled))
+    result = {"city": destination_city, "itinerary": itinerary}
+    if unscheduled:
+        result["unscheduled"] = unscheduled
+    return result
+
+def iter_itinerary_days(ranked, travel_matrix, day_hours=8, dates: Dict = None, unscheduled: List = None):
+    """Yield {"day", "steps"} objects one at a time as each day is packed.
+
+    Names of POIs that could not be placed are appended to `unscheduled`
+    once the generator is exhausted.
+    """
+    minutes_per_day = day_hours * 60
+    day_start_minutes = DAY_START_MINUTES
+    day_end_minutes = day_start_minutes + minutes_per_day
+    available_days = trip_days(dates)
+
+    table = as_table(ranked)
+    durations = table.duration.tolist()
+    # Geographic day split + short route per day, instead of visiting in rank order
+    routes = plan_day_routes(durations, travel_matrix, minutes_per_day, max_days=available_days)
+
+    day = 0
+    matrix_rows = None
+    carry = []  # Stops that didn't fit their planned day, retried on the next one
+    routed = {idx for route in routes for idx in route}
+    left_out = [idx for idx in range(len(table)) if idx not in routed]
+    scheduled = set()
+    while routes or carry:
+        if available_days and day >= available_days:
+            left_out.extend(carry)
+            for route in routes:
+                left_out.extend(route)
+            break
+        route = routes.pop(0) if routes else []
+        if carry:
+            if matrix_rows is None:
+                matrix_rows = travel_matrix.tolist()
+            route = order_day(carry + route, matrix_rows, time.perf_counter() + 0.001)
+        placed, steps, leftovers = _pack_day_by_rank(route, table, durations, travel_matrix, day_start_minutes,
+                                                     day_end_minutes, time.perf_counter() + 0.002)
+        assert not set(placed) & set(leftovers), "stop both placed and left over"
+        assert not set(placed) & scheduled, "stop scheduled on two days"
+        scheduled.update(placed)
+        if not steps:
+            # Nothing in this batch can be visited on any day
+            left_out.extend(leftovers)
+            carry = []
+            continue
+        day += 1
+        carry = leftovers
+        yield {"day": day, "steps": steps}
+
+    if unscheduled is not None:
+        unscheduled.extend(table.records[idx].get("name", "") for idx in sorted(left_out))
+
+async def astream_itinerary(destination_city: str, dates: Dict, user_prefs: Dict, day_hours=8):
+    """Async generator of planning events for streaming responses.
+
+    Emits {"event": "progress", ...} as each stage starts or finishes, one
+    {"event": "day", ...} per packed day, then {"event": "done", ...}; or
+    {"event": "error", "error": ...} if the plan can't be made. Identical
+    trips in flight share one plan; a stream that joins one late gets its
+    days once the plan is ready.
+    """
+    key = plan_request_key(destination_city, dates, user_prefs, day_hours)
+    result = _cached_itinerary(key, destination_city)
+    streamed_days = 0
+    if result is not None:
+        yield {"event": "progress", "stage": "cached", "city": destination_city}
+    else:
+        yield {"event": "progress", "stage": "retrieving_pois", "city": destination_city}
+        events = asyncio.Queue()
+        plan = asyncio.ensure_future(async_plan_flight.do(key, _aplan_itinerary, destination_city, dates, user_prefs,
+                                                          day_hours=day_hours, on_event=events.put_nowait))
+        # Only the stream that starts the plan receives its events as they happen
+        next_event = None
+        try:
+            while not plan.done():
+                next_event = next_event or asyncio.ensure_future(events.get())
+                await asyncio.wait({next_event, plan}, return_when=asyncio.FIRST_COMPLETED)
+                if next_event.done():
+                    event, next_event = next_event.result(), None
+                    streamed_days += event["event"] == "day"
+                    yield event
+        finally:
+            if next_event is not None:
+                next_event.cancel()
+        while not events.empty():
+            event = events.get_nowait()
+            streamed_days += event["event"] == "day"
+            yield event
+        result = _cache_itinerary(key, plan.result())
+        if "error" in result:
+            yield {"event": "error", **result}
+            return
+
+    # Days the plan produced before this stream joined it, or all of them when cached
+    for day in result["itinerary"][streamed_days:]:
+        yield {"event": "day", "city": destination_city, **day}
+    yield {"event": "done", "city": destination_city, "days": len(result["itinerary"]),
+           "unscheduled": result.get("unscheduled", [])}
@@ -0,0 +1,142 @@
+"""Batch trip planning: trips are grouped by city so each city's POIs are
+retrieved and its travel-time matrix built once, then per-trip scheduling
+fans out over a process pool."""
+import os
+import threading
+import contextvars
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Dict
+import numpy as np
+import agent
+from agent import build_itinerary, RETRIEVAL_K, DEFAULT_NEAR_RADIUS_KM
+from chroma_store import normalize_city
+from tools import travel_time_matrix, haversine_from
+from poi_table import PoiTable
+from settings import llm_configured
+from observability import get_logger, span
+
+logger = get_logger("batch")
+
+# Candidate POIs retrieved per city; each trip ranks these and keeps RETRIEVAL_K
+BATCH_CITY_POOL_SIZE = int(os.getenv("BATCH_CITY_POOL_SIZE", "60"))
+BATCH_CITY_WORKERS = int(os.getenv("BATCH_CITY_WORKERS", "4"))
+BATCH_PROCESS_WORKERS = int(os.getenv("BATCH_PROCESS_WORKERS", str(os.cpu_count() or 1)))
+# Below this many trips, scheduling runs in-process (pool dispatch costs more than it saves)
+BATCH_PROCESS_MIN_TRIPS = int(os.getenv("BATCH_PROCESS_MIN_TRIPS", "64"))
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn, not fork: the parent holds threads and open SQLite handles
+            _process_pool = ProcessPoolExecutor(
+                max_workers=max(1, BATCH_PROCESS_WORKERS),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _process_pool
+
+def shutdown_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+
+def _schedule_trip(job):
+    destination, ranked, travel_matrix, day_hours, dates = job
+    try:
+        return build_itinerary(destination, ranked, travel_matrix, day_hours, dates)
+    except Exception as e:
+        logger.exception(f"Error scheduling batch trip to {destination}: {str(e)}")
+        return {"error": f"Failed to plan itinerary: {str(e)}"}
+
+def _prepare_city(destination: str, trips: List[Dict]):
+    """Retrieve one POI pool for all trips to a city and its travel matrix. Returns (pool, matrix, error)."""
+    interests = sorted({str(i).lower().strip() for t in trips for i in t.get("interests", []) if str(i).strip()})
+    pool, error = agent._retrieve_pois(destination, {"interests": interests}, k=BATCH_CITY_POOL_SIZE)
+    if error:
+        return None, None, error
+    logger.info(f"Batch: {len(pool)} POIs for {destination} shared by {len(trips)} trips")
+    table = PoiTable(pool)
+    with span("travel_matrix", pois=len(table)):
+        matrix = travel_time_matrix(table)
+    return table, matrix, None
+
+def _trip_job(trip: Dict, table: PoiTable, matrix):
+    """Rank the city table for one trip and slice the shared matrix to its top POIs"""
+    order = table.rank_order(trip.get("interests", []))
+    near = trip.get("near")
+    if near:
+        radius_km = float(near.get("radius_km", DEFAULT_NEAR_RADIUS_KM))
+        distances = haversine_from(float(near["lat"]), float(near["lng"]), table.lat[order], table.lng[order])
+        order = order[distances <= radius_km]
+        if not len(order):
+            raise ValueError(f"No POIs found within {radius_km} km of the requested location in {trip['destination']}")
+    idx = order[:RETRIEVAL_K]
+    return (trip["destination"], table.take(idx), matrix[np.ix_(idx, idx)], trip.get("day_hours", 8), trip.get("dates"))
+
+def plan_trip_batch(trips: List[Dict]):
+    """Plan many trips ({destination, dates, interests, day_hours}).
+
+    Returns one result per trip in input order: an itinerary, or an
+    {"error": ...} dict for trips that couldn't be planned.
+    """
+    if not llm_configured():
+        return [{"error": "OpenAI API key not configured. Please set OPENAI_API_KEY environment variable."} for _ in trips]
+
+    by_city = {}
+    for i, trip in enumerate(trips):
+        by_city.setdefault(normalize_city(trip["destination"]), []).append(i)
+
+    results = [None] * len(trips)
+    city_data = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCH_CITY_WORKERS, len(by_city) or 1))) as pool:
+        futures = {
+            # copy_context() so city work logs under the caller's request id
+            city: pool.submit(contextvars.copy_context().run, _prepare_city, trips[indices[0]]["destination"], [trips[i] for i in indices])
+            for city, indices in by_city.items()
+        }
+        for city, future in futures.items():
+            try:
+                city_data[city] = future.result()
+            except Exception as e:
+                logger.exception(f"Batch: failed to prepare {city}: {str(e)}")
+                city_data[city] = (None, None, {"error": f"Failed to plan itinerary: {str(e)}"})
+
+    jobs = []
+    job_indices = []
+    for city, indices in by_city.items():
+        pois, matrix, error = city_data[city]
+        for i in indices:
+            if error:
+                results[i] = error
+                continue
+            try:
+                jobs.append(_trip_job(trips[i], pois, matrix))
+                job_indices.append(i)
+            except Exception as e:
+                results[i] = {"error": f"Failed to plan itinerary: {str(e)}"}
+
+    with span("scheduling", trips=len(jobs)):
+        scheduled = _schedule_jobs(jobs)
+    for i, result in zip(job_indices, scheduled):
+        results[i] = result
+    return results
+
+def _schedule_jobs(jobs):
+    scheduled = None
+    if len(jobs) >= BATCH_PROCESS_MIN_TRIPS and BATCH_PROCESS_WORKERS > 1:
+        chunksize = max(1, len(jobs) // (BATCH_PROCESS_WORKERS * 4))
+        try:
+            scheduled = list(_get_process_pool().map(_schedule_trip, jobs, chunksize=chunksize))
+        except Exception as e:
+            # e.g. a worker died; the pool is unusable, so rebuild it next time
+            logger.warning(f"Batch: process pool failed, scheduling in-process: {str(e)}")
+            shutdown_process_pool()
+    if scheduled is None:
+        scheduled = [_schedule_trip(job) for job in jobs]
+    return scheduled
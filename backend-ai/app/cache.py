@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from observability import get_logger
+
+logger = get_logger("cache")
+
+MISSING = object()
+
+class LRUCache:
+    """Thread-safe in-memory LRU with an optional per-entry TTL (seconds)."""
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        """Pass expires_at to keep an expiry from elsewhere (e.g. a disk tier)"""
+        if expires_at is None:
+            ttl = self.ttl if ttl is None else ttl
+            expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set_many(self, items, ttl=None):
+        for key, value in items:
+            self.set(key, value, ttl=ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class SqliteCache:
+    """On-disk key/value store with TTL and size-bounded eviction.
+
+    Values are stored as JSON. The database runs in WAL mode so several
+    worker processes can share one file. Eviction (expired rows first, then
+    the oldest rows above ``max_entries``) runs every ``evict_every`` writes.
+    """
+
+    def __init__(self, path, table="cache", max_entries=100000, ttl=None, evict_every=500):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, expires_at REAL)"
+            )
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_created ON {table}(created_at)")
+            self._conn.commit()
+
+    def get(self, key, default=MISSING):
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def get_entry(self, key):
+        """(value, expires_at) when the key is present and fresh, else None"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return json.loads(value), expires_at
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, expires_at),
+            )
+            self._conn.commit()
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                self._evict()
+
+    def get_many(self, keys):
+        """Return {key: value} for the keys that are present and fresh."""
+        return {key: value for key, (value, _) in self.get_many_entries(keys).items()}
+
+    def get_many_entries(self, keys):
+        """Return {key: (value, expires_at)} for the keys that are present and fresh."""
+        found = {}
+        now = time.time()
+        keys = list(keys)
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT key, value, expires_at FROM {self.table} WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+            for key, value, expires_at in rows:
+                if expires_at is None or expires_at > now:
+                    found[key] = (json.loads(value), expires_at)
+        return found
+
+    def set_many(self, items, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        rows = [(key, json.dumps(value), now, expires_at) for key, value in items]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            before = self._writes
+            self._writes += len(rows)
+            if self._writes // self.evict_every != before // self.evict_every:
+                self._evict()
+
+    def _evict(self):
+        self._conn.execute(
+            f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+        )
+        count = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY created_at ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+        self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def delete_prefix(self, prefix):
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key LIKE ? ESCAPE '\\'", (escaped + "%",))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+class TieredCache:
+    """In-memory LRU in front of an optional SqliteCache, with hit/miss counters."""
+
+    def __init__(self, name, memory, disk=None):
+        self.name = name
+        self.memory = memory
+        self.disk = disk
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        value = self.memory.get(key)
+        if value is not MISSING:
+            self.memory_hits += 1
+            return value
+        if self.disk is not None:
+            try:
+                entry = self.disk.get_entry(key)
+            except sqlite3.Error as e:
+                logger.warning(f"{self.name} cache disk read failed: {str(e)}")
+                entry = None
+            if entry is not None:
+                self.disk_hits += 1
+                # Keep the disk expiry so a promoted entry doesn't outlive the one on disk
+                value, expires_at = entry
+                self.memory.set(key, value, expires_at=expires_at)
+                return value
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        self.memory.set(key, value, ttl=ttl)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value, ttl=ttl)
+            except sqlite3.Error as e:
+                logger.warning(f"{self.name} cache disk write failed: {str(e)}")
+
+    def get_many(self, keys):
+        """Return {key: value} for every key found in either tier."""
+        found = {}
+        remaining = []
+        for key in keys:
+            value = self.memory.get(key)
+            if value is MISSING:
+                remaining.append(key)
+            else:
+                found[key] = value
+        self.memory_hits += len(found)
+        from_disk = {}
+        if remaining and self.disk is not None:
+            try:
+                from_disk = self.disk.get_many_entries(remaining)
+            except sqlite3.Error as e:
+                logger.warning(f"{self.name} cache disk read failed: {str(e)}")
+            for key, (value, expires_at) in from_disk.items():
+                self.memory.set(key, value, expires_at=expires_at)
+                found[key] = value
+            self.disk_hits += len(from_disk)
+        self.misses += len(remaining) - len(from_disk)
+        return found
+
+    def set_many(self, items, ttl=None):
+        items = list(items)
+        self.memory.set_many(items, ttl=ttl)
+        if self.disk is not None:
+            try:
+                self.disk.set_many(items, ttl=ttl)
+            except sqlite3.Error as e:
+                logger.warning(f"{self.name} cache disk write failed: {str(e)}")
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def delete_prefix(self, prefix):
+        self.memory.delete_prefix(prefix)
+        if self.disk is not None:
+            self.disk.delete_prefix(prefix)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+        }
+
+def build_cache(name, path, memory_size, disk_size, ttl, shared=False):
+    """TieredCache with a disk tier at ``path`` (pass an empty path for memory only).
+
+    With shared=True the memory tier is only used when the disk tier can't
+    be opened, so deletes made by any process sharing the file are seen at once.
+    """
+    disk = None
+    if path:
+        try:
+            disk = SqliteCache(path, table=name, max_entries=disk_size, ttl=ttl)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not open {name} cache at {path}, using memory only: {str(e)}")
+    if shared and disk is not None:
+        memory_size = 0
+    return TieredCache(name, LRUCache(maxsize=memory_size, ttl=ttl), disk)
+
+def lazy_cache(name, path, memory_size, disk_size, ttl, shared=False):
+    """Getter for a build_cache(...) made on first call, so importing the
+    module that declares it opens no SQLite file."""
+    cache = None
+    lock = threading.Lock()
+
+    def get():
+        nonlocal cache
+        if cache is None:
+            with lock:
+                if cache is None:
+                    cache = build_cache(name, path, memory_size, disk_size, ttl, shared=shared)
+        return cache
+    return get
@@ -1,44 +1,266 @@
 import os
-from langchain_openai import OpenAIEmbeddings
-from langchain_chroma import Chroma
-from dotenv import load_dotenv
-from pathlib import Path
-
-# Load environment variables from .env file
-# Try current directory first, then parent directory (backend-ai/)
-env_path = Path(__file__).parent / '.env'
-if not env_path.exists():
-    env_path = Path(__file__).parent.parent / '.env'
-load_dotenv(env_path)
+import re
+import time
+import threading
+import settings  # noqa: F401  (loads .env before the os.getenv calls below)
+from observability import get_logger
+
+logger = get_logger("chroma_store")
 
 CHROMA_DIR = os.getenv("CHROMA_DIR", "./chroma_db")
+# "openai" (default) or "local" for the offline hashing embedder
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai").strip().lower()
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", "384"))
 
-def get_chroma_retriever(k=6):
-    try:
-        api_key = os.getenv("OPENAI_API_KEY")
-        base_url = os.getenv("OPENAI_BASE_URL")
-        
-        # Configure embeddings with optional OpenRouter support
-        if base_url:
-            # Using OpenRouter or custom endpoint
-            # Note: For embeddings via OpenRouter, you may need to use a specific embedding model
-            # Default to text-embedding-ada-002 which works with most OpenAI-compatible APIs
-            embeddings = OpenAIEmbeddings(
-                base_url=base_url,
-                api_key=api_key,
-                model="text-embedding-ada-002"
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "./cache/embeddings")
+EMBEDDING_CACHE_MEMORY_SIZE = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "20000"))
+EMBEDDING_CACHE_DISK_SIZE = int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", "200000"))
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+def _build_embeddings():
+    if EMBEDDING_PROVIDER == "local":
+        from local_embeddings import HashingEmbeddings
+        return HashingEmbeddings(dim=LOCAL_EMBEDDING_DIM)
+    if EMBEDDING_PROVIDER != "openai":
+        raise ValueError(f"Unknown EMBEDDING_PROVIDER '{EMBEDDING_PROVIDER}' (expected 'openai' or 'local')")
+
+    from langchain_openai import OpenAIEmbeddings
+    api_key = os.getenv("OPENAI_API_KEY")
+    base_url = os.getenv("OPENAI_BASE_URL")
+
+    # Configure embeddings with optional OpenRouter support
+    if base_url:
+        # Using OpenRouter or custom endpoint
+        # Note: For embeddings via OpenRouter, you may need to use a specific embedding model
+        # Default to text-embedding-ada-002 which works with most OpenAI-compatible APIs
+        return OpenAIEmbeddings(
+            base_url=base_url,
+            api_key=api_key,
+            model="text-embedding-ada-002"
+        )
+    # Using standard OpenAI endpoint
+    return OpenAIEmbeddings()
+
+def get_embeddings():
+    """Shared cache-backed embeddings used by both ingestion and queries"""
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            # Imported here: langchain_core and numpy make up most of this module's import time
+            from embedding_cache import CachedEmbeddings
+            underlying = _build_embeddings()
+            _embeddings = CachedEmbeddings(
+                underlying,
+                model_name=getattr(underlying, "model", type(underlying).__name__),
+                cache_dir=EMBEDDING_CACHE_DIR,
+                memory_size=EMBEDDING_CACHE_MEMORY_SIZE,
+                disk_size=EMBEDDING_CACHE_DISK_SIZE,
             )
-        else:
-            # Using standard OpenAI endpoint
-            embeddings = OpenAIEmbeddings()
-        
-        persist_directory = CHROMA_DIR
-        db = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
-        retriever = db.as_retriever(search_type="similarity", search_kwargs={"k": k})
+        return _embeddings
+
+def collection_name():
+    """Chroma collection for the configured provider; vectors of different models can't share one"""
+    if EMBEDDING_PROVIDER == "local":
+        return f"langchain_local_{LOCAL_EMBEDDING_DIM}"
+    return "langchain"
+
+def poi_text(p):
+    """Text that gets embedded for a POI"""
+    return f"{p['name']}. {p.get('desc', '')}. Category: {p.get('category', '')}. City: {p['city']}"
+
+def normalize_city(city) -> str:
+    """Canonical form of a city name, stored as `city_norm` metadata for filtered retrieval"""
+    return " ".join(str(city).lower().split())
+
+def slugify(value):
+    return re.sub(r'[^a-z0-9]+', '_', str(value).lower()).strip('_')
+
+class ChromaStoreManager:
+    """Process-wide owner of the persistent Chroma store.
+
+    The store and its embeddings client are opened once and shared by every
+    request. Retrievers are cached per ``k``. If ``CHROMA_DIR`` changes the
+    store is reopened on the next access.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (persist_directory, db, retrievers) swapped as one tuple so readers
+        # never see a directory paired with another directory's store
+        self._state = None
+
+    def _current_directory(self):
+        return os.getenv("CHROMA_DIR", CHROMA_DIR)
+
+    def _open(self, persist_directory):
+        # Imported here: langchain_chroma pulls in chromadb, which is slow to import
+        from langchain_chroma import Chroma
+        logger.info(f"Opening ChromaDB at {persist_directory} (collection {collection_name()})")
+        db = Chroma(collection_name=collection_name(), persist_directory=persist_directory, embedding_function=get_embeddings())
+        return (persist_directory, db, {})
+
+    def _get_state(self):
+        persist_directory = self._current_directory()
+        state = self._state
+        if state is not None and state[0] == persist_directory:
+            return state
+        with self._lock:
+            state = self._state
+            if state is None or state[0] != persist_directory:
+                state = self._open(persist_directory)
+                self._state = state
+            return state
+
+    def get_store(self):
+        return self._get_state()[1]
+
+    def get_retriever(self, k=6):
+        _, db, retrievers = self._get_state()
+        retriever = retrievers.get(k)
+        if retriever is None:
+            with self._lock:
+                retriever = retrievers.get(k)
+                if retriever is None:
+                    retriever = db.as_retriever(search_type="similarity", search_kwargs={"k": k})
+                    retrievers[k] = retriever
         return retriever, db
+
+    def warm_up(self):
+        """Open the store and touch the collection without an embedding call."""
+        db = self.get_store()
+        sample = db.get(limit=1, include=["metadatas"])
+        if sample["ids"] and "city_norm" not in (sample["metadatas"][0] or {}):
+            backfill_city_index(db)
+        return db
+
+    def reset(self):
+        """Drop the open store so the next access reopens it (e.g. after a reload)."""
+        with self._lock:
+            self._state = None
+
+store_manager = ChromaStoreManager()
+
+def get_chroma_retriever(k=6):
+    try:
+        return store_manager.get_retriever(k)
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Error initializing ChromaDB: {str(e)}")
-        print(error_details)
+        logger.exception(f"Error initializing ChromaDB: {str(e)}")
         raise Exception(f"Failed to initialize ChromaDB: {str(e)}. Make sure ChromaDB directory exists and has data.")
+
+def upsert_generated_pois(destination_city, pois):
+    """Embed LLM-generated POIs and upsert them so later requests take the retrieval path"""
+    city = destination_city.strip()
+    generated_at = time.time()
+    texts, metadatas, ids = [], [], []
+    for p in pois:
+        poi_id = f"llm_{slugify(city)}_{slugify(p.get('name', ''))}"
+        metadata = {
+            "id": poi_id,
+            "name": str(p.get("name", "Unknown")),
+            "city": city,
+            "city_norm": normalize_city(city),
+            "category": str(p.get("category", "general")),
+            "desc": str(p.get("desc", "")),
+            "duration_mins": int(p.get("duration_mins", 60) or 60),
+            "lat": float(p.get("lat", 0.0) or 0.0),
+            "lng": float(p.get("lng", 0.0) or 0.0),
+            "source": "llm",
+            "generated_at": generated_at,
+        }
+        texts.append(poi_text(metadata))
+        metadatas.append(metadata)
+        ids.append(poi_id)
+    if not ids:
+        return 0
+    # Generated names can repeat; keep the last occurrence of each id
+    unique = {poi_id: (text, metadata) for poi_id, text, metadata in zip(ids, texts, metadatas)}
+    db = store_manager.get_store()
+    db.add_texts(
+        [text for text, _ in unique.values()],
+        metadatas=[metadata for _, metadata in unique.values()],
+        ids=list(unique.keys()),
+    )
+    return len(unique)
+
+def delete_generated_pois(destination_city=None):
+    """Remove LLM-generated POIs from Chroma, for one city or all of them"""
+    db = store_manager.get_store()
+    where = {"source": "llm"}
+    if destination_city:
+        where = {"$and": [where, {"city_norm": normalize_city(destination_city)}]}
+    ids = db.get(where=where, include=[])["ids"]
+    if ids:
+        db.delete(ids=ids)
+    return len(ids)
+
+def backfill_city_index(db=None, batch_size=500):
+    """Add `city_norm` metadata to documents loaded before it existed"""
+    db = db or store_manager.get_store()
+    offset = 0
+    updated = 0
+    while True:
+        page = db.get(include=["metadatas"], limit=batch_size, offset=offset)
+        if not page["ids"]:
+            break
+        ids, metadatas = [], []
+        for poi_id, metadata in zip(page["ids"], page["metadatas"]):
+            metadata = dict(metadata or {})
+            if "city_norm" not in metadata and metadata.get("city"):
+                metadata["city_norm"] = normalize_city(metadata["city"])
+                ids.append(poi_id)
+                metadatas.append(metadata)
+        if ids:
+            db._collection.update(ids=ids, metadatas=metadatas)
+            updated += len(ids)
+        offset += len(page["ids"])
+    if updated:
+        logger.info(f"Backfilled city_norm metadata on {updated} ChromaDB documents")
+    return updated
+
+def search_city_pois(query, city, k=20, page=0):
+    """Top-k documents for query restricted to one city via a Chroma `where` filter.
+
+    page selects results k*page .. k*(page+1) for cities with more than k
+    POIs. Stores without `city_norm` metadata fall back to an unfiltered
+    search, so callers must still check the city.
+    """
+    db = store_manager.get_store()
+    vector = db.embeddings.embed_query(query)
+    docs = db.similarity_search_by_vector(vector, k=k * (page + 1), filter={"city_norm": normalize_city(city)})
+    if not docs and page == 0:
+        docs = db.similarity_search_by_vector(vector, k=k)
+    return docs[k * page:]
+
+async def asearch_city_pois(query, city, k=20, page=0):
+    """Async search_city_pois"""
+    db = store_manager.get_store()
+    vector = await db.embeddings.aembed_query(query)
+    docs = await db.asimilarity_search_by_vector(vector, k=k * (page + 1), filter={"city_norm": normalize_city(city)})
+    if not docs and page == 0:
+        docs = await db.asimilarity_search_by_vector(vector, k=k)
+    return docs[k * page:]
+
+def iter_city_pois(city, page_size=500):
+    """Yield every POI metadata dict stored for a city, one page at a time"""
+    db = store_manager.get_store()
+    offset = 0
+    while True:
+        page = db.get(where={"city_norm": normalize_city(city)}, include=["metadatas"], limit=page_size, offset=offset)
+        if not page["metadatas"]:
+            break
+        yield from page["metadatas"]
+        offset += len(page["metadatas"])
+
+def iter_city_vectors(city, page_size=500):
+    """Yield (metadata, embedding) for every POI stored for a city, one page at a time"""
+    collection = store_manager.get_store()._collection
+    offset = 0
+    while True:
+        page = collection.get(where={"city_norm": normalize_city(city)}, include=["metadatas", "embeddings"],
+                              limit=page_size, offset=offset)
+        if not page["metadatas"]:
+            break
+        yield from zip(page["metadatas"], page["embeddings"])
+        offset += len(page["metadatas"])
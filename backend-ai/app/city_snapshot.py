@@ -0,0 +1,282 @@
+"""Compiled per-city snapshots for the planning hot path.
+
+`python city_snapshot.py Paris Tokyo` reads each city's POIs and their
+embeddings from ChromaDB and writes under SNAPSHOT_DIR:
+
+    <city>-<build>/   lat, lng, duration, open, close, category_mask and
+                      embeddings, one .npy each; with --maps also neighbors
+                      and neighbor_minutes (N x k)
+    <city>.json       sidecar: POI records, category vocabulary, build info
+
+The sidecar is replaced last, atomically, so readers never see a partial
+build. Workers open the arrays with np.load(mmap_mode="r"), so every uvicorn
+process shares one copy in the page cache and opening a city costs one JSON
+parse per build. Planning uses a city's snapshot instead of ChromaDB and the
+Distance Matrix API.
+
+Travel times are haversine estimates computed per plan. With --maps, Distance
+Matrix times are fetched once for each POI's SNAPSHOT_TRAVEL_NEIGHBORS
+nearest POIs (N x k billed elements, not N x N) and override the estimate.
+
+Reloading a city's POIs (ingestion, /load_sample_data, removing generated
+POIs) stamps <city>.reloaded; a snapshot built before that is not used until
+the city is rebuilt.
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+from typing import Optional
+import numpy as np
+from chroma_store import iter_city_vectors, normalize_city, slugify, collection_name
+from poi_table import PoiTable
+from tools import estimate_travel_matrix, fetch_travel_times, haversine_from
+from observability import get_logger
+
+logger = get_logger("city_snapshot")
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "./snapshots")
+SNAPSHOT_FORMAT = 2
+# Nearest POIs per POI whose Distance Matrix times a --maps build stores
+SNAPSHOT_TRAVEL_NEIGHBORS = int(os.getenv("SNAPSHOT_TRAVEL_NEIGHBORS", "32"))
+_COLUMNS = ("lat", "lng", "duration", "open", "close")
+_TRAVEL_MAX = np.iinfo(np.int16).max
+
+def _sidecar_path(directory, city):
+    return os.path.join(directory, f"{slugify(normalize_city(city))}.json")
+
+def _reload_stamp_path(directory, city):
+    return os.path.join(directory, f"{slugify(normalize_city(city))}.reloaded")
+
+def _nearest_neighbors(lat, lng, k):
+    """Indices of each POI's k nearest other POIs (N x min(k, N - 1))"""
+    from sklearn.neighbors import BallTree
+    coords = np.radians(np.column_stack([lat, lng]))
+    _, idx = BallTree(coords, metric="haversine").query(coords, k=min(k + 1, len(coords)))
+    keep = idx != np.arange(len(coords))[:, None]
+    # Itself can be crowded out by POIs at the same spot; then drop the farthest instead
+    keep[keep.all(axis=1), -1] = False
+    return idx[keep].reshape(len(coords), -1)
+
+class CitySnapshot:
+    """One city's compiled POIs; arrays are read-only memory maps"""
+
+    def __init__(self, sidecar_path):
+        with open(sidecar_path, encoding="utf-8") as f:
+            sidecar = json.load(f)
+        if sidecar.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"unsupported snapshot format {sidecar.get('format')}")
+        directory = os.path.join(os.path.dirname(sidecar_path), sidecar["arrays"])
+        load = lambda name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+        self.city = sidecar["city"]
+        self.build = sidecar["build"]
+        self.built_at = sidecar["built_at"]
+        self.mode = sidecar["mode"]
+        self.embedding_space = sidecar["embedding_space"]
+        self.table = PoiTable.from_columns(sidecar["records"], *(load(name) for name in _COLUMNS),
+                                           sidecar["vocabulary"], load("category_mask"))
+        self.embeddings = load("embeddings")
+        self.neighbors = self.neighbor_minutes = None
+        if sidecar["travel"] == "maps":
+            self.neighbors = load("neighbors")
+            self.neighbor_minutes = load("neighbor_minutes")
+
+    def __len__(self):
+        return len(self.table)
+
+    def search(self, query_vector, k) -> np.ndarray:
+        """Rows of the k POIs most similar to the query, best first"""
+        query = np.asarray(query_vector, dtype=np.float32)
+        similarity = self.embeddings @ (query / (np.linalg.norm(query) or 1.0))
+        k = min(k, len(similarity))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.argpartition(-similarity, k - 1)[:k]
+        return rows[np.argsort(-similarity[rows], kind="stable")]
+
+    def within_radius(self, lat, lng, radius_km) -> np.ndarray:
+        """Rows of the POIs within radius_km of (lat, lng), nearest first"""
+        distance = haversine_from(float(lat), float(lng), self.table.lat, self.table.lng)
+        rows = np.flatnonzero(distance <= radius_km)
+        return rows[np.argsort(distance[rows], kind="stable")]
+
+    def ranked(self, rows, interests, k=None):
+        """(ranked PoiTable, snapshot rows in the same order) for the given rows"""
+        candidates = self.table.take(rows)
+        order = candidates.rank_order(interests)[:k]
+        return candidates.take(order), np.asarray(rows)[order]
+
+    def travel_matrix(self, rows) -> np.ndarray:
+        """Travel minutes between the given rows, indexed like them: haversine
+        estimates, overridden by stored Distance Matrix times between neighbours"""
+        rows = np.asarray(rows, dtype=np.int64)
+        matrix = estimate_travel_matrix(self.table.lat[rows], self.table.lng[rows], self.mode)
+        if self.neighbors is not None and len(rows) > 1:
+            order = np.argsort(rows, kind="stable")
+            sorted_rows = rows[order]
+            neighbors = np.asarray(self.neighbors[rows])
+            positions = np.clip(np.searchsorted(sorted_rows, neighbors), 0, len(rows) - 1)
+            i, k = np.nonzero(sorted_rows[positions] == neighbors)
+            matrix[i, order[positions[i, k]]] = np.asarray(self.neighbor_minutes[rows])[i, k]
+        np.fill_diagonal(matrix, 0)
+        return matrix
+
+class SnapshotStore:
+    """Snapshots opened on first use and reopened when their city is rebuilt"""
+
+    def __init__(self, directory=SNAPSHOT_DIR):
+        self.directory = directory
+        self._snapshots = {}  # sidecar path -> ((sidecar mtime, reload stamp mtime), CitySnapshot or None)
+        self._lock = threading.Lock()
+
+    def get(self, city) -> Optional[CitySnapshot]:
+        """The city's snapshot, or None when it has none (or one built for other embeddings)"""
+        if not self.directory:
+            return None
+        path = _sidecar_path(self.directory, city)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        try:
+            reloaded_at = os.stat(_reload_stamp_path(self.directory, city)).st_mtime
+        except OSError:
+            reloaded_at = None
+        mtime = (mtime, reloaded_at)
+        entry = self._snapshots.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        with self._lock:
+            entry = self._snapshots.get(path)
+            if entry is not None and entry[0] == mtime:
+                return entry[1]
+            try:
+                snapshot = CitySnapshot(path)
+            except (OSError, ValueError, KeyError) as e:
+                # Not cached: a rebuild may be swapping files right now
+                logger.warning(f"Could not open snapshot for {city}: {str(e)}")
+                return None
+            if snapshot.embedding_space != collection_name():
+                logger.warning(f"Ignoring snapshot for {city}: built for {snapshot.embedding_space} embeddings, "
+                               f"not {collection_name()}")
+                snapshot = None
+            elif reloaded_at is not None and reloaded_at > snapshot.built_at:
+                logger.warning(f"Ignoring snapshot {snapshot.build} for {city}: its POIs were reloaded "
+                               f"after it was built; rebuild it with city_snapshot.py")
+                snapshot = None
+            else:
+                logger.info(f"Opened snapshot {snapshot.build} for {city}: {len(snapshot)} POIs")
+            self._snapshots[path] = (mtime, snapshot)
+            return snapshot
+
+    def mark_reloaded(self, cities=None):
+        """Record that these cities' POIs (every city with a snapshot when None)
+        changed, so snapshots built before now are no longer used"""
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        if cities is None:
+            paths = [os.path.join(self.directory, name[:-len(".json")] + ".reloaded")
+                     for name in os.listdir(self.directory) if name.endswith(".json")]
+        else:
+            paths = [_reload_stamp_path(self.directory, city) for city in set(cities)]
+        for path in paths:
+            with open(path, "w") as f:
+                f.write(str(time.time()))
+
+    def stats(self):
+        return {entry[1].city: {"build": entry[1].build, "pois": len(entry[1])}
+                for entry in list(self._snapshots.values()) if entry[1] is not None}
+
+city_snapshots = SnapshotStore()
+
+def build_snapshot(city, directory=SNAPSHOT_DIR, mode="walking", maps=False, neighbors=SNAPSHOT_TRAVEL_NEIGHBORS):
+    """Compile one city's snapshot from ChromaDB. With maps=True, Distance
+    Matrix times to each POI's `neighbors` nearest POIs are stored (billed per
+    pair); otherwise travel times are haversine estimates."""
+    if maps and not os.getenv("MAPS_API_KEY"):
+        raise ValueError("maps=True needs MAPS_API_KEY")
+    built_at = time.time()  # before reading, so a reload during the build marks it stale
+    records, vectors = [], []
+    for metadata, embedding in iter_city_vectors(city):
+        records.append(dict(metadata))
+        vectors.append(embedding)
+    if not records:
+        raise ValueError(f"No POIs stored for {city}")
+
+    start = time.perf_counter()
+    table = PoiTable(records)
+    embeddings = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings /= np.where(norms > 0, norms, 1.0)
+    columns = {"lat": table.lat, "lng": table.lng, "duration": table.duration, "open": table.open,
+               "close": table.close, "category_mask": table.category_mask, "embeddings": embeddings}
+    unresolved = 0
+    if maps and len(records) > 1:
+        nearest = _nearest_neighbors(table.lat, table.lng, neighbors)
+        found = fetch_travel_times(records, nearest, mode)
+        minutes = np.zeros(nearest.shape, dtype=np.int16)
+        for (i, k), j in np.ndenumerate(nearest):
+            if j < 0:
+                continue
+            if (i, int(j)) in found:
+                minutes[i, k] = min(found[(i, int(j))], _TRAVEL_MAX)
+            else:
+                nearest[i, k] = -1  # falls back to the haversine estimate
+                unresolved += 1
+        if unresolved:
+            logger.warning(f"{unresolved} of {int((nearest >= 0).sum()) + unresolved} Distance Matrix times for "
+                           f"{city} could not be fetched; those pairs use haversine estimates")
+        columns["neighbors"] = nearest.astype(np.int32)
+        columns["neighbor_minutes"] = minutes
+
+    os.makedirs(directory, exist_ok=True)
+    key = slugify(normalize_city(city))
+    build = time.strftime("%Y%m%d%H%M%S") + f"{int(time.time() * 1000) % 1000:03d}"
+    arrays = f"{key}-{build}"
+    array_dir = os.path.join(directory, arrays)
+    os.makedirs(array_dir, exist_ok=True)
+    for name, values in columns.items():
+        np.save(os.path.join(array_dir, f"{name}.npy"), np.ascontiguousarray(values))
+
+    sidecar = {
+        "format": SNAPSHOT_FORMAT,
+        "city": records[0].get("city") or city,
+        "build": build,
+        "arrays": arrays,
+        "built_at": built_at,
+        "mode": mode,
+        "travel": "maps" if "neighbors" in columns else "haversine",
+        "travel_unresolved": unresolved,
+        "embedding_space": collection_name(),
+        "vocabulary": table.vocabulary,
+        "records": records,
+    }
+    path = _sidecar_path(directory, city)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(sidecar, f)
+    os.replace(path + ".tmp", path)
+
+    # Workers still mapping an older build keep its pages until they reopen
+    for name in os.listdir(directory):
+        if name.startswith(f"{key}-") and name != arrays:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    logger.info(f"Built snapshot {build} for {city}: {len(records)} POIs in {time.perf_counter() - start:.2f}s")
+    return {"city": sidecar["city"], "build": build, "pois": len(records), "path": path}
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile per-city POI snapshots from ChromaDB")
+    parser.add_argument("cities", nargs="+")
+    parser.add_argument("--dir", default=SNAPSHOT_DIR, help=f"output directory (default: {SNAPSHOT_DIR})")
+    parser.add_argument("--mode", default="walking", choices=["walking", "transit", "driving"])
+    parser.add_argument("--maps", action="store_true",
+                        help="store Distance Matrix times to each POI's nearest POIs (billed; needs MAPS_API_KEY)")
+    parser.add_argument("--neighbors", type=int, default=SNAPSHOT_TRAVEL_NEIGHBORS,
+                        help=f"nearest POIs per POI with --maps (default: {SNAPSHOT_TRAVEL_NEIGHBORS})")
+    args = parser.parse_args()
+    for city in args.cities:
+        build_snapshot(city, directory=args.dir, mode=args.mode, maps=args.maps, neighbors=args.neighbors)
+
+if __name__ == "__main__":
+    main()
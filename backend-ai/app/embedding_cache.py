@@ -0,0 +1,221 @@
+import os
+import re
+import hashlib
+import sqlite3
+import threading
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from cache import MISSING, LRUCache
+from observability import get_logger
+
+logger = get_logger("embedding_cache")
+
+class VectorFileStore:
+    """Append-only float32 vector file plus a SQLite index of key -> row.
+
+    Rows are read through a read-only memory map, so several worker
+    processes share one copy in the page cache. Writers serialize on the
+    SQLite write lock (BEGIN IMMEDIATE), which also covers the file append.
+    Nothing is evicted: once ``max_entries`` rows are stored, new vectors
+    are no longer written.
+    """
+
+    def __init__(self, directory, namespace, max_entries=200000):
+        os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self._full = False
+        self.vectors_path = os.path.join(directory, f"{namespace}.f32")
+        self._conn = sqlite3.connect(
+            os.path.join(directory, f"{namespace}.idx.sqlite"),
+            check_same_thread=False, timeout=10.0, isolation_level=None,
+        )
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self.dim = int(row[0]) if row else None
+        self._map = None
+        self._mapped_rows = 0
+
+    def _view(self, max_row):
+        if self._map is None or max_row >= self._mapped_rows:
+            if not os.path.exists(self.vectors_path):
+                return None
+            rows = os.path.getsize(self.vectors_path) // (self.dim * 4)
+            if rows == 0:
+                return None
+            self._map = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+            self._mapped_rows = rows
+        return self._map
+
+    def get_many(self, keys):
+        """Return {key: float32 vector} for the keys stored on disk"""
+        if self.dim is None:
+            return {}
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self._conn.execute(f"SELECT key, row FROM vectors WHERE key IN ({placeholders})", chunk).fetchall()
+                if not rows:
+                    continue
+                view = self._view(max(r for _, r in rows))
+            if view is None:
+                continue
+            for key, row in rows:
+                if row < view.shape[0]:
+                    found[key] = np.array(view[row])
+        return found
+
+    def put_many(self, items):
+        """Append (key, vector) pairs that aren't stored yet"""
+        items = [(key, np.asarray(vector, dtype=np.float32)) for key, vector in items]
+        if not items or self._full:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.dim is None:
+                    row = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+                    self.dim = int(row[0]) if row else len(items[0][1])
+                    self._conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('dim', ?)", (str(self.dim),))
+                items = [(key, vector) for key, vector in items if vector.shape == (self.dim,)]
+                placeholders = ",".join("?" * len(items))
+                present = {r[0] for r in self._conn.execute(
+                    f"SELECT key FROM vectors WHERE key IN ({placeholders})", [key for key, _ in items])} if items else set()
+                new_items = []
+                for key, vector in items:
+                    if key not in present:
+                        present.add(key)
+                        new_items.append((key, vector))
+                room = self.max_entries - self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+                if len(new_items) >= room:
+                    self._full = True
+                    logger.warning(f"Embedding cache at {self.vectors_path} holds {self.max_entries} vectors; "
+                                   f"new vectors stay in memory only")
+                    new_items = new_items[:max(0, room)]
+                if new_items:
+                    row_bytes = self.dim * 4
+                    with open(self.vectors_path, "ab") as f:
+                        start_row = f.tell() // row_bytes
+                        # Drop a partial row left by an interrupted writer
+                        f.truncate(start_row * row_bytes)
+                        f.write(np.stack([vector for _, vector in new_items]).tobytes())
+                    self._conn.executemany(
+                        "INSERT INTO vectors (key, row) VALUES (?, ?)",
+                        [(key, start_row + i) for i, (key, _) in enumerate(new_items)],
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper keyed by model + text hash.
+
+    Lookups go memory LRU -> on-disk vector store -> underlying model, and all
+    misses from one call are sent to the model as a single batch. Both tiers
+    hold float32 rows; lists are only built for the caller. Query embeddings
+    (one per distinct query string) are kept out of the disk tier.
+    """
+
+    def __init__(self, underlying: Embeddings, model_name: str, cache_dir: str = None, memory_size: int = 20000,
+                 disk_size: int = 200000):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.memory = LRUCache(maxsize=memory_size)
+        self.disk = None
+        if cache_dir:
+            namespace = re.sub(r'[^a-z0-9]+', '_', model_name.lower()).strip('_') or "default"
+            try:
+                self.disk = VectorFileStore(cache_dir, namespace, max_entries=disk_size)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Could not open embedding cache at {cache_dir}, using memory only: {str(e)}")
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()[:32]
+
+    def _lookup(self, texts):
+        """Returns (keys, {key: vector} found, {key: text} still missing)"""
+        keys = [self._key(t) for t in texts]
+        found = {}
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key in found or key in pending:
+                continue
+            vector = self.memory.get(key)
+            if vector is MISSING:
+                pending[key] = text
+            else:
+                found[key] = vector
+                self.memory_hits += 1
+        if pending and self.disk is not None:
+            try:
+                from_disk = self.disk.get_many(pending.keys())
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Embedding cache read failed: {str(e)}")
+                from_disk = {}
+            for key, vector in from_disk.items():
+                self.memory.set(key, vector)
+                found[key] = vector
+                del pending[key]
+            self.disk_hits += len(from_disk)
+        self.misses += len(pending)
+        return keys, found, pending
+
+    def _store(self, found, missing_keys, vectors, persist=True):
+        items = [(key, np.asarray(vector, dtype=np.float32)) for key, vector in zip(missing_keys, vectors)]
+        for key, vector in items:
+            self.memory.set(key, vector)
+            found[key] = vector
+        if persist and self.disk is not None:
+            try:
+                self.disk.put_many(items)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Embedding cache write failed: {str(e)}")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, pending = self._lookup(texts)
+        if pending:
+            self._store(found, list(pending.keys()), self.underlying.embed_documents(list(pending.values())))
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        keys, found, pending = self._lookup([text])
+        if pending:
+            self._store(found, keys, [self.underlying.embed_query(text)], persist=False)
+        return found[keys[0]].tolist()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, pending = self._lookup(texts)
+        if pending:
+            self._store(found, list(pending.keys()), await self.underlying.aembed_documents(list(pending.values())))
+        return [found[key].tolist() for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        keys, found, pending = self._lookup([text])
+        if pending:
+            self._store(found, keys, [await self.underlying.aembed_query(text)], persist=False)
+        return found[keys[0]].tolist()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_entries": len(self.disk) if self.disk is not None else 0,
+        }
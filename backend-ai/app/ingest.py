@@ -0,0 +1,264 @@
+import os
+import csv
+import json
+import time
+import argparse
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from chroma_store import get_embeddings, poi_text, normalize_city, store_manager, slugify
+from poi_sync import SyncSummary, changed_pois, stamp_hashes, delete_missing
+from spatial import spatial_indexes
+from agent import invalidate_itineraries
+from city_snapshot import city_snapshots
+from observability import get_logger
+
+logger = get_logger("ingest")
+
+DEFAULT_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+DEFAULT_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+PROGRESS_EVERY_SECS = 5.0
+
+def iter_poi_rows(path, fmt=None):
+    """Stream rows from a JSONL or CSV file without loading it into memory"""
+    fmt = fmt or ("csv" if path.lower().endswith(".csv") else "jsonl")
+    with open(path, newline="" if fmt == "csv" else None, encoding="utf-8") as f:
+        if fmt == "csv":
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+def prepare_poi(row):
+    """Row -> Chroma metadata dict with scalar values, or None if the row is unusable"""
+    name = str(row.get("name") or "").strip()
+    city = str(row.get("city") or "").strip()
+    if not name or not city:
+        return None
+    try:
+        metadata = {
+            "id": str(row.get("id") or f"{slugify(city)}_{slugify(name)}"),
+            "name": name,
+            "city": city,
+            "city_norm": normalize_city(city),
+            "category": str(row.get("category") or "general"),
+            "desc": str(row.get("desc") or ""),
+            "duration_mins": int(float(row.get("duration_mins") or 60)),
+            "lat": float(row.get("lat") or 0.0),
+            "lng": float(row.get("lng") or 0.0),
+        }
+    except (TypeError, ValueError):
+        return None
+    for field in ("open", "close"):
+        if row.get(field):
+            metadata[field] = str(row[field])
+    return metadata
+
+def _file_signature(source_path):
+    stat = os.stat(source_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def _read_checkpoint(checkpoint_path, source_path):
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return 0
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("source") != os.path.abspath(source_path):
+        return 0
+    if checkpoint.get("file") != _file_signature(source_path):
+        logger.info(f"Ignoring checkpoint for {source_path}: the file changed since it was written")
+        return 0
+    return int(checkpoint.get("rows_done", 0))
+
+def _write_checkpoint(checkpoint_path, source_path, rows_done):
+    if not checkpoint_path:
+        return
+    tmp = checkpoint_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"source": os.path.abspath(source_path), "file": _file_signature(source_path),
+                   "rows_done": rows_done, "updated_at": time.time()}, f)
+    os.replace(tmp, checkpoint_path)
+
+def _remove_checkpoint(checkpoint_path):
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+def _batches(rows, batch_size, skip, on_skipped=None):
+    """Yield (rows_consumed_after_batch, [metadata, ...]) chunks, skipping already-ingested rows"""
+    batch = []
+    consumed = 0
+    for row in rows:
+        consumed += 1
+        if consumed <= skip:
+            if on_skipped is not None:
+                on_skipped(row)
+            continue
+        poi = prepare_poi(row)
+        if poi is not None:
+            batch.append(poi)
+        if len(batch) >= batch_size:
+            yield consumed, batch
+            batch = []
+    if batch or consumed > skip:
+        yield consumed, batch
+
+class IngestProgress:
+    def __init__(self, source):
+        self.source = source
+        self.status = "running"
+        self.rows_done = 0
+        self.pois_upserted = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        self.error = None
+        self.diff = SyncSummary()
+
+    def as_dict(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "source": self.source,
+            "status": self.status,
+            "rows_done": self.rows_done,
+            "pois_upserted": self.pois_upserted,
+            "elapsed_secs": round(elapsed, 2),
+            "pois_per_sec": round(self.pois_upserted / elapsed, 1) if elapsed > 0 else 0.0,
+            "error": self.error,
+            "diff": self.diff.as_dict(),
+        }
+
+def ingest_file(path, fmt=None, batch_size=DEFAULT_BATCH_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                checkpoint_path=None, resume=True, progress=None, sync=False, source=None):
+    """Embed and upsert POIs from a JSONL/CSV file in batches.
+
+    Up to `concurrency` batches are embedded at once; reading pauses until
+    the oldest batch is upserted, so memory stays bounded by
+    batch_size * concurrency. The checkpoint records rows fully upserted, so
+    an interrupted run resumes where it stopped; it is removed once the file
+    is fully ingested and ignored if the file has changed since.
+
+    Every POI is tagged with `source` (the file name by default) and a
+    content hash. With sync=True, POIs whose hash is unchanged are not
+    re-embedded and `source` documents missing from the file are deleted;
+    this keeps the set of ids in memory.
+    """
+    progress = progress or IngestProgress(path)
+    source = source or os.path.basename(path)
+    seen_ids = set()
+    cities = set()  # of upserted POIs, whose snapshots go stale
+
+    def remember_skipped(row):
+        poi = prepare_poi(row)
+        if poi is not None:
+            seen_ids.add(poi["id"])
+
+    checkpoint_path = checkpoint_path if checkpoint_path is not None else path + ".checkpoint.json"
+    skip = _read_checkpoint(checkpoint_path, path) if resume else 0
+    progress.rows_done = skip
+    if skip:
+        logger.info(f"Resuming ingestion of {path} after {skip} rows")
+
+    embeddings = get_embeddings()
+    collection = store_manager.get_store()._collection
+    in_flight = deque()
+    last_report = time.time()
+
+    def flush_oldest():
+        nonlocal last_report
+        rows_done, batch, future = in_flight.popleft()
+        if batch:
+            vectors = future.result()
+            collection.upsert(
+                ids=[p["id"] for p in batch],
+                embeddings=vectors,
+                metadatas=batch,
+                documents=[poi_text(p) for p in batch],
+            )
+            progress.pois_upserted += len(batch)
+            cities.update(p["city"] for p in batch)
+        progress.rows_done = rows_done
+        _write_checkpoint(checkpoint_path, path, rows_done)
+        if time.time() - last_report >= PROGRESS_EVERY_SECS:
+            stats = progress.as_dict()
+            logger.info(f"Ingested {stats['pois_upserted']} POIs ({stats['rows_done']} rows) at {stats['pois_per_sec']} POIs/s")
+            last_report = time.time()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            rows = _batches(iter_poi_rows(path, fmt), batch_size, skip, on_skipped=remember_skipped if sync else None)
+            for rows_done, batch in rows:
+                # Chroma rejects duplicate ids within one upsert
+                batch = list({p["id"]: {**p, "source": source} for p in batch}.values())
+                if sync:
+                    seen_ids.update(p["id"] for p in batch)
+                    batch = changed_pois(collection, batch, progress.diff) if batch else batch
+                else:
+                    stamp_hashes(batch)
+                future = pool.submit(embeddings.embed_documents, [poi_text(p) for p in batch]) if batch else None
+                in_flight.append((rows_done, batch, future))
+                if len(in_flight) >= max(1, concurrency):
+                    flush_oldest()
+            while in_flight:
+                flush_oldest()
+        if sync:
+            delete_missing(collection, source, seen_ids, progress.diff)
+        progress.status = "done"
+        _remove_checkpoint(checkpoint_path)
+    except Exception as e:
+        progress.status = "error"
+        progress.error = str(e)
+        raise
+    finally:
+        progress.finished_at = time.time()
+        stats = progress.as_dict()
+        logger.info(f"Ingestion {progress.status}: {stats['pois_upserted']} POIs in {stats['elapsed_secs']}s ({stats['pois_per_sec']} POIs/s)")
+        if sync:
+            logger.info(f"Sync diff for {source}: {stats['diff']}")
+        if progress.diff.deleted:
+            # Deleted documents may belong to any city
+            city_snapshots.mark_reloaded()
+            spatial_indexes.invalidate()
+            invalidate_itineraries()
+        elif cities:
+            city_snapshots.mark_reloaded(cities)
+            for city in cities:
+                spatial_indexes.invalidate(city)
+                invalidate_itineraries(city)
+    return progress.as_dict()
+
+# Background ingestion jobs started from the API, by job id
+ingest_jobs = {}
+
+def start_ingest_job(path, **kwargs):
+    job_id = uuid.uuid4().hex[:12]
+    progress = IngestProgress(path)
+    ingest_jobs[job_id] = progress
+
+    def run():
+        try:
+            ingest_file(path, progress=progress, **kwargs)
+        except Exception as e:
+            logger.exception(f"Ingestion job {job_id} failed: {str(e)}")
+
+    threading.Thread(target=run, name=f"ingest-{job_id}", daemon=True).start()
+    return job_id
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream POIs from a JSONL or CSV file into ChromaDB")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default=None)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file (default: <path>.checkpoint.json)")
+    parser.add_argument("--no-resume", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--sync", action="store_true", help="only embed new/changed POIs and delete removed ones")
+    parser.add_argument("--source", default=None, help="source label for the POIs (default: file name)")
+    args = parser.parse_args()
+    ingest_file(args.path, fmt=args.format, batch_size=args.batch_size, concurrency=args.concurrency,
+                checkpoint_path=args.checkpoint, resume=not args.no_resume, sync=args.sync, source=args.source)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import json
+from typing import Dict, List
+
+class JsonObjectStream:
+    """Pulls complete top-level JSON objects out of text that arrives in chunks.
+
+    Feed it model output token by token; each `{...}` is parsed as soon as
+    its closing brace arrives. Anything outside objects (array brackets,
+    commas, code fences, chatter) is ignored, and an object that fails to
+    parse is skipped without affecting the ones around it.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._buffer = []
+        self.skipped = 0
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """Consume a chunk and return the objects it completed"""
+        completed = []
+        for ch in chunk:
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth = 1
+                    self._buffer = [ch]
+                continue
+            self._buffer.append(ch)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        obj = json.loads("".join(self._buffer))
+                    except json.JSONDecodeError:
+                        self.skipped += 1
+                    else:
+                        if isinstance(obj, dict):
+                            completed.append(obj)
+                    self._buffer = []
+        return completed
+
+    @property
+    def pending(self) -> bool:
+        """True while an object has been opened but not closed (e.g. truncated output)"""
+        return self._depth > 0
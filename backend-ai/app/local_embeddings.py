@@ -0,0 +1,59 @@
+import re
+import zlib
+from functools import lru_cache
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+class HashingEmbeddings(Embeddings):
+    """CPU-only embeddings: hashed word unigrams/bigrams and character trigrams.
+
+    No model download and no network. Each feature is hashed (crc32) to a
+    signed bucket, counts are log-scaled and rows L2-normalized, so cosine
+    similarity works like a bag-of-words match. A whole batch is
+    accumulated into one NumPy matrix.
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+        self.model = f"local-hashing-{dim}"
+        self._bucket = lru_cache(maxsize=200000)(self._hash_feature)
+
+    def _hash_feature(self, feature: str):
+        h = zlib.crc32(feature.encode("utf-8"))
+        return h % self.dim, 1.0 if (h >> 31) & 1 else -1.0
+
+    def _features(self, text: str):
+        words = _TOKEN_RE.findall(text.lower())
+        features = list(words)
+        features.extend(f"{a} {b}" for a, b in zip(words, words[1:]))
+        for w in words:
+            padded = f"<{w}>"
+            features.extend(f"#{padded[i:i + 3]}" for i in range(len(padded) - 2))
+        return features
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        rows, cols, signs = [], [], []
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                col, sign = self._bucket(feature)
+                rows.append(row)
+                cols.append(col)
+                signs.append(sign)
+        flat = np.asarray(rows, dtype=np.int64) * self.dim + np.asarray(cols, dtype=np.int64)
+        matrix = np.bincount(flat, weights=signs, minlength=len(texts) * self.dim)
+        matrix = matrix.reshape(len(texts), self.dim).astype(np.float32)
+        matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self._embed(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
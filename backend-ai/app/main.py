@@ -1,42 +1,279 @@
 import os
-from fastapi import FastAPI
-from pydantic import BaseModel
-from agent import plan_itinerary
-from chroma_store import get_chroma_retriever
-from dotenv import load_dotenv
-from pathlib import Path
-
-# Load environment variables from .env file
-# Try current directory first, then parent directory (backend-ai/)
-env_path = Path(__file__).parent / '.env'
-if not env_path.exists():
-    env_path = Path(__file__).parent.parent / '.env'
-load_dotenv(env_path)
+import json
+import time
+import uuid
+import threading
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, Field
+from typing import Optional, List
+from agent import (
+    aplan_itinerary, astream_itinerary, get_generated_poi_cache, invalidate_generated_pois,
+    get_itinerary_cache,
+    plan_flight, poi_generation_flight, async_plan_flight, async_poi_generation_flight,
+)
+from chroma_store import get_chroma_retriever, store_manager, delete_generated_pois, get_embeddings
+from tools import get_travel_cache, aclose_async_http_client
+from batch import plan_trip_batch, shutdown_process_pool
+from replan import replan_itinerary
+from city_snapshot import city_snapshots
+from spatial import spatial_indexes
+from settings import get_llm, WARM_UP_MODE
+from upstream import deadline, REQUEST_TIMEOUT_SECS
+from observability import get_logger, registry, counter_lines, request_id_var, HTTP_REQUESTS, HTTP_SECONDS
+
 app = FastAPI(title="Tour Planner AI")
+logger = get_logger("main")
+
+def _request_timeout(header):
+    """Seconds this request may take: X-Request-Timeout if given, never more than REQUEST_TIMEOUT_SECS"""
+    try:
+        return min(REQUEST_TIMEOUT_SECS, max(0.0, float(header))) if header else REQUEST_TIMEOUT_SECS
+    except ValueError:
+        return REQUEST_TIMEOUT_SECS
+
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    """Tag logs with a request id (X-Request-ID, or a new one) and record request metrics"""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:16]
+    token = request_id_var.set(request_id)
+    start = time.perf_counter()
+    status = 500
+    try:
+        # Upstream calls made for this request give up once its time budget is spent
+        budget = _request_timeout(request.headers.get("x-request-timeout"))
+        with deadline(budget):
+            response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        # Label by route template, not raw path, to keep the series count bounded
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        elapsed = time.perf_counter() - start
+        HTTP_REQUESTS.inc(method=request.method, route=route, status=status)
+        HTTP_SECONDS.observe(elapsed, method=request.method, route=route)
+        request_id_var.reset(token)
+
+def warm_up_clients():
+    """Build the chat model and open the Chroma store (and its embeddings) so the first /plan_trip doesn't pay for it"""
+    start = time.perf_counter()
+    try:
+        get_llm()
+        store_manager.warm_up()
+        logger.info(f"Clients warmed up in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        # Not fatal: clients are built lazily on first use
+        logger.warning(f"Warm-up failed: {str(e)}")
+
+@app.on_event("startup")
+def start_warm_up():
+    if WARM_UP_MODE == "blocking":
+        warm_up_clients()
+    elif WARM_UP_MODE != "off":
+        # Serve /health right away; requests that arrive first wait on the same client locks
+        threading.Thread(target=warm_up_clients, name="warm-up", daemon=True).start()
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await aclose_async_http_client()
+    shutdown_process_pool()
 
 class TripRequest(BaseModel):
     destination: str
     dates: dict
     interests: list
     day_hours: int = 8
+    near: Optional[dict] = None  # {"lat", "lng", "radius_km"}: only plan POIs around this point
 
 @app.post("/plan_trip")
-def plan_trip(req: TripRequest):
+async def plan_trip(req: TripRequest):
     try:
-        prefs = {"interests": req.interests}
-        res = plan_itinerary(req.destination, req.dates, prefs, day_hours=req.day_hours)
+        prefs = {"interests": req.interests, "near": req.near}
+        res = await aplan_itinerary(req.destination, req.dates, prefs, day_hours=req.day_hours)
         return res
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Error in plan_trip: {str(e)}")
-        print(error_details)
+        logger.exception(f"Error in plan_trip: {str(e)}")
         return {"error": f"Failed to plan itinerary: {str(e)}"}
 
+def _stream_line(event: dict, fmt: str) -> str:
+    payload = json.dumps(event, default=str)
+    if fmt == "sse":
+        return f"event: {event.get('event', 'message')}\ndata: {payload}\n\n"
+    return payload + "\n"
+
+@app.post("/plan_trip/stream")
+async def plan_trip_stream(req: TripRequest, format: str = "ndjson"):
+    """Like /plan_trip, but streams progress events and each day as soon as it is scheduled.
+    format=ndjson (one JSON object per line) or format=sse (text/event-stream)."""
+    fmt = "sse" if format == "sse" else "ndjson"
+
+    async def events():
+        try:
+            prefs = {"interests": req.interests, "near": req.near}
+            async for event in astream_itinerary(req.destination, req.dates, prefs, day_hours=req.day_hours):
+                yield _stream_line(event, fmt)
+        except Exception as e:
+            logger.exception(f"Error in plan_trip_stream: {str(e)}")
+            yield _stream_line({"event": "error", "error": f"Failed to plan itinerary: {str(e)}"}, fmt)
+
+    media_type = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+class TripBatchRequest(BaseModel):
+    trips: List[TripRequest]
+
+@app.post("/plan_trips")
+def plan_trips(req: TripBatchRequest):
+    """Plan many trips at once; POIs and travel times are fetched once per city.
+    Results are in request order, with {"error": ...} for trips that failed."""
+    try:
+        results = plan_trip_batch([trip.model_dump() for trip in req.trips])
+        return {"results": results}
+    except Exception as e:
+        logger.exception(f"Error in plan_trips: {str(e)}")
+        return {"error": f"Failed to plan itineraries: {str(e)}"}
+
+class ReplanDelta(BaseModel):
+    drop: List[str] = []  # names of stops to remove
+    add_interests: List[str] = []
+    day_hours: Optional[int] = None
+
+class ReplanRequest(BaseModel):
+    trip: TripRequest  # the trip the itinerary was planned for
+    itinerary: dict  # a /plan_trip or /replan result
+    delta: ReplanDelta
+
+@app.post("/replan")
+def replan(req: ReplanRequest):
+    """Apply an edit to a planned itinerary. Reuses the plan's POIs and travel
+    times and only re-times the days the edit touches (listed in "changed_days").
+    For further edits, send the trip with the added interests and new day_hours."""
+    try:
+        trip = req.trip
+        prefs = {"interests": trip.interests, "near": trip.near}
+        return replan_itinerary(trip.destination, trip.dates, prefs, trip.day_hours, req.itinerary,
+                                drop=req.delta.drop, add_interests=req.delta.add_interests,
+                                new_day_hours=req.delta.day_hours)
+    except Exception as e:
+        logger.exception(f"Error in replan: {str(e)}")
+        return {"error": f"Failed to replan itinerary: {str(e)}"}
+
 @app.get("/health")
 def health():
     return {"status":"ok"}
 
+# Public POI fields; stored metadata also carries sync bookkeeping (content_hash, city_norm, source)
+NEARBY_FIELDS = ("id", "name", "category", "desc", "duration_mins", "lat", "lng", "open", "close", "distance_km")
+
+@app.get("/nearby")
+def nearby(city: str, lat: float, lng: float, radius_km: Optional[float] = None, k: int = 10):
+    """POIs in a city closest to (lat, lng): the k nearest, or all within radius_km (up to k), nearest first"""
+    try:
+        index = spatial_indexes.get(city)
+        if radius_km is not None:
+            results = index.within_radius(lat, lng, radius_km, limit=k)
+        else:
+            results = index.nearest(lat, lng, k=k)
+        results = [{field: poi[field] for field in NEARBY_FIELDS if field in poi} for poi in results]
+        return {"city": city, "count": len(results), "results": results}
+    except Exception as e:
+        logger.exception(f"Error in nearby: {str(e)}")
+        return {"error": f"Failed to search nearby POIs: {str(e)}"}
+
+@app.get("/cache_stats")
+def cache_stats():
+    """Hit/miss counters for the in-process caches and request coalescing"""
+    return {
+        "travel_times": get_travel_cache().stats(),
+        "generated_pois": get_generated_poi_cache().stats(),
+        "itineraries": get_itinerary_cache().stats(),
+        "embeddings": get_embeddings().stats(),
+        "snapshots": city_snapshots.stats(),
+        "coalescing": {
+            "plan_itinerary": plan_flight.stats(),
+            "generate_pois": poi_generation_flight.stats(),
+            "plan_itinerary_async": async_plan_flight.stats(),
+            "generate_pois_async": async_poi_generation_flight.stats(),
+        },
+    }
+
+def _cache_metric_lines():
+    caches = {"travel_times": get_travel_cache().stats(), "generated_pois": get_generated_poi_cache().stats(),
+              "itineraries": get_itinerary_cache().stats(), "embeddings": get_embeddings().stats()}
+    flights = {"plan_itinerary": plan_flight.stats(), "generate_pois": poi_generation_flight.stats(),
+               "plan_itinerary_async": async_plan_flight.stats(), "generate_pois_async": async_poi_generation_flight.stats()}
+    lines = counter_lines("tourplanner_cache_hits_total", "Cache hits by cache and tier", [
+        ({"cache": name, "tier": tier}, stats[f"{tier}_hits"]) for name, stats in caches.items() for tier in ("memory", "disk")])
+    lines += counter_lines("tourplanner_cache_misses_total", "Cache misses by cache", [
+        ({"cache": name}, stats["misses"]) for name, stats in caches.items()])
+    lines += counter_lines("tourplanner_coalesced_requests_total", "Requests served by an identical in-flight call", [
+        ({"flight": name}, stats["deduplicated"]) for name, stats in flights.items()])
+    return lines
+
+registry.register_collector(_cache_metric_lines)
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text-format metrics: stage and request latency histograms, cache, fallback, error and token counters"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+class PoiCacheInvalidation(BaseModel):
+    city: Optional[str] = None  # None invalidates every city
+    remove_from_chromadb: bool = True
+
+@app.post("/invalidate_poi_cache")
+def invalidate_poi_cache(req: PoiCacheInvalidation):
+    """Forget LLM-generated POIs so the next request regenerates them"""
+    try:
+        invalidate_generated_pois(req.city)
+        removed = delete_generated_pois(req.city) if req.remove_from_chromadb else 0
+        spatial_indexes.invalidate(req.city)
+        if removed:
+            city_snapshots.mark_reloaded([req.city] if req.city else None)
+        target = req.city or "all cities"
+        return {"status": "success", "message": f"Invalidated generated POIs for {target}", "removed_from_chromadb": removed}
+    except Exception as e:
+        logger.exception(f"Error invalidating POI cache: {str(e)}")
+        return {"status": "error", "error": f"Failed to invalidate POI cache: {str(e)}"}
+
+# Bulk ingestion only reads files under this directory
+INGEST_DIR = os.getenv("INGEST_DIR", "./data")
+# A job holds batch_size * concurrency POIs and their embeddings in memory
+MAX_INGEST_BATCH_SIZE = int(os.getenv("MAX_INGEST_BATCH_SIZE", "2048"))
+MAX_INGEST_CONCURRENCY = int(os.getenv("MAX_INGEST_CONCURRENCY", "16"))
+
+class IngestRequest(BaseModel):
+    path: str  # relative to INGEST_DIR
+    format: Optional[str] = None  # "jsonl" or "csv"; guessed from the extension if omitted
+    batch_size: int = Field(256, ge=1, le=MAX_INGEST_BATCH_SIZE)
+    concurrency: int = Field(4, ge=1, le=MAX_INGEST_CONCURRENCY)
+    resume: bool = True
+    sync: bool = False  # embed only new/changed POIs and delete ones no longer in the file
+
+@app.post("/ingest_pois")
+def ingest_pois(req: IngestRequest):
+    """Start a background job that streams a POI file into ChromaDB"""
+    from ingest import start_ingest_job
+    base = os.path.realpath(INGEST_DIR)
+    path = os.path.realpath(os.path.join(base, req.path))
+    if not path.startswith(base + os.sep):
+        return {"status": "error", "error": f"Path must be inside {INGEST_DIR}"}
+    if not os.path.isfile(path):
+        return {"status": "error", "error": f"File not found: {req.path}"}
+    job_id = start_ingest_job(path, fmt=req.format, batch_size=req.batch_size,
+                              concurrency=req.concurrency, resume=req.resume, sync=req.sync)
+    return {"status": "started", "job_id": job_id}
+
+@app.get("/ingest_status/{job_id}")
+def ingest_status(job_id: str):
+    """Progress and throughput of an ingestion job"""
+    from ingest import ingest_jobs
+    progress = ingest_jobs.get(job_id)
+    if progress is None:
+        return {"status": "error", "error": f"Unknown ingestion job {job_id}"}
+    return progress.as_dict()
+
 @app.get("/check_chromadb")
 def check_chromadb():
     """Check if ChromaDB has data"""
@@ -90,11 +327,10 @@ def load_sample_data():
         from poi_loader import load_sample_into_chroma
         import os
         persist_directory = os.getenv("CHROMA_DIR", "./chroma_db")
-        load_sample_into_chroma(persist_directory=persist_directory)
-        return {"status": "success", "message": f"Loaded sample POIs into ChromaDB at {persist_directory}"}
+        summary = load_sample_into_chroma(persist_directory=persist_directory)
+        # Reopen the shared store so it sees the freshly loaded collection
+        store_manager.reset()
+        return {"status": "success", "message": f"Loaded sample POIs into ChromaDB at {persist_directory}", "diff": summary}
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Error loading sample data: {str(e)}")
-        print(error_details)
+        logger.exception(f"Error loading sample data: {str(e)}")
         return {"status": "error", "error": f"Failed to load sample data: {str(e)}"}
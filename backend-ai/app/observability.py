@@ -0,0 +1,211 @@
+"""Structured logging, timing spans and Prometheus-format metrics.
+
+Metrics live in a small in-process registry rendered in the Prometheus text
+exposition format by /metrics, so no client library is needed. Log lines are
+JSON (or plain text with LOG_FORMAT=text) and carry the current request id.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+import settings  # noqa: F401  (loads .env before LOG_LEVEL / LOG_FORMAT are read)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# ---------------------------------------------------------------- logging
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None) or request_id_var.get()
+        if request_id:
+            entry["request_id"] = request_id
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        request_id = request_id_var.get()
+        fields = getattr(record, "fields", None) or {}
+        extra = " ".join(f"{k}={v}" for k, v in fields.items())
+        line = f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname:<7} " \
+               f"{'[' + request_id + '] ' if request_id else ''}{record.getMessage()}{' ' + extra if extra else ''}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+_root = logging.getLogger("tourplanner")
+if not _root.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+    _root.addHandler(_handler)
+    _root.setLevel(LOG_LEVEL)
+    _root.propagate = False
+
+def get_logger(name):
+    return logging.getLogger(f"tourplanner.{name}")
+
+def log_fields(**fields):
+    """`extra=` payload for structured fields: logger.info("msg", extra=log_fields(city=...))"""
+    return {"fields": fields}
+
+# ---------------------------------------------------------------- metrics
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = [(n, v) for n, v in zip(labelnames, key)]
+    if extra:
+        pairs.extend(extra)
+    if not pairs:
+        return ""
+    escaped = [(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for n, v in pairs]
+    return "{" + ",".join(f'{n}="{v}"' for n, v in escaped) + "}"
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if idx < len(self.buckets):
+                series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {round(series[-2], 6)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, fn):
+        """fn() -> list of exposition lines, called on every scrape (e.g. for existing stats() counters)"""
+        self._collectors.append(fn)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for fn in self._collectors:
+            try:
+                lines.extend(fn())
+            except Exception as e:
+                get_logger("metrics").warning(f"Metrics collector failed: {str(e)}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    "tourplanner_stage_seconds", "Time spent in each planning stage", ["stage"]))
+STAGE_ERRORS = registry.register(Counter(
+    "tourplanner_stage_errors_total", "Planning stages that raised", ["stage"]))
+HTTP_REQUESTS = registry.register(Counter(
+    "tourplanner_http_requests_total", "HTTP requests by route and status", ["method", "route", "status"]))
+HTTP_SECONDS = registry.register(Histogram(
+    "tourplanner_http_request_seconds", "HTTP request latency by route", ["method", "route"]))
+LLM_FALLBACKS = registry.register(Counter(
+    "tourplanner_llm_fallbacks_total", "Plans that fell back to LLM POI generation", ["reason"]))
+UPSTREAM_ERRORS = registry.register(Counter(
+    "tourplanner_upstream_errors_total", "Failed calls to upstream services", ["upstream"]))
+LLM_TOKENS = registry.register(Counter(
+    "tourplanner_llm_tokens_total", "LLM tokens used", ["kind"]))
+
+def counter_lines(name, documentation, samples):
+    """Exposition lines for a counter from [(labels dict, value), ...]"""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} counter"]
+    for labels, value in samples:
+        lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+    return lines
+
+@contextmanager
+def span(stage, **fields):
+    """Time a planning stage into tourplanner_stage_seconds and log it at debug level"""
+    logger = get_logger("span")
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{stage} took {elapsed * 1000:.1f} ms", extra=log_fields(stage=stage, duration_ms=round(elapsed * 1000, 2), **fields))
+
+def record_token_usage(usage):
+    """Add a LangChain usage_metadata dict ({"input_tokens", "output_tokens", ...}) to the token counter"""
+    if not usage:
+        return
+    LLM_TOKENS.inc(int(usage.get("input_tokens", 0) or 0), kind="prompt")
+    LLM_TOKENS.inc(int(usage.get("output_tokens", 0) or 0), kind="completion")
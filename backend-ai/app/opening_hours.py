@@ -0,0 +1,88 @@
+from bisect import bisect_right
+from datetime import date
+from typing import Dict, Optional
+
+MINUTES_PER_DAY = 24 * 60
+
+def parse_hhmm(value) -> Optional[int]:
+    """'09:30' -> 570. Returns None for anything that isn't HH:MM."""
+    try:
+        hours, minutes = str(value).strip().split(":")[:2]
+        total = int(hours) * 60 + int(minutes)
+    except (ValueError, AttributeError):
+        return None
+    if not 0 <= total <= MINUTES_PER_DAY:
+        return None
+    return total
+
+class OpeningWindows:
+    """Sorted, merged [start, end) minute intervals for one POI on one day.
+
+    Minutes are counted from the day's midnight and may run past 1440 for
+    places that close after midnight. Lookups bisect on the interval starts.
+    """
+
+    def __init__(self, intervals):
+        merged = []
+        for start, end in sorted(intervals):
+            if end <= start:
+                continue
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = [s for s, _ in merged]
+        self.ends = [e for _, e in merged]
+
+    def earliest_start(self, t, duration, latest_end=None):
+        """Earliest start >= t at which a visit of `duration` fits in one window
+        (and ends by latest_end, if given). None if there is no such slot."""
+        k = max(0, bisect_right(self.starts, t) - 1)
+        for idx in range(k, len(self.starts)):
+            start = max(t, self.starts[idx])
+            if latest_end is not None and start + duration > latest_end:
+                return None
+            if start + duration <= self.ends[idx]:
+                return start
+        return None
+
+    def longest_slot(self, t, latest_end):
+        """(start, minutes) of the longest open stretch between t and latest_end."""
+        best = (None, 0)
+        k = max(0, bisect_right(self.starts, t) - 1)
+        for idx in range(k, len(self.starts)):
+            start = max(t, self.starts[idx])
+            if start >= latest_end:
+                break
+            length = min(self.ends[idx], latest_end) - start
+            if length > best[1]:
+                best = (start, length)
+        return best
+
+ALWAYS_OPEN = OpeningWindows([(0, 2 * MINUTES_PER_DAY)])
+
+def poi_windows(poi: Dict) -> OpeningWindows:
+    """Opening windows from a POI's open/close fields; POIs without hours are always open."""
+    return hours_windows(parse_hhmm(poi.get("open")), parse_hhmm(poi.get("close")))
+
+def hours_windows(opens: Optional[int], closes: Optional[int]) -> OpeningWindows:
+    """Opening windows from open/close minutes; unknown hours mean always open."""
+    if opens is None or closes is None:
+        return ALWAYS_OPEN
+    if closes > opens:
+        return OpeningWindows([(opens, closes)])
+    # Closes after midnight (e.g. 06:00-01:00): tonight's late hours plus
+    # the tail of yesterday's session this morning
+    return OpeningWindows([(0, closes), (opens, closes + MINUTES_PER_DAY)])
+
+def trip_days(dates: Dict) -> Optional[int]:
+    """Number of days covered by {'start': 'YYYY-MM-DD', 'end': 'YYYY-MM-DD'}, or None if unknown."""
+    if not isinstance(dates, dict):
+        return None
+    try:
+        start = date.fromisoformat(str(dates.get("start", ""))[:10])
+        end = date.fromisoformat(str(dates.get("end", ""))[:10])
+    except ValueError:
+        return None
+    days = (end - start).days + 1
+    return days if days > 0 else None
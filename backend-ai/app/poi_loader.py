@@ -1,15 +1,11 @@
-import os
-from langchain_openai import OpenAIEmbeddings
 from langchain_chroma import Chroma
-from dotenv import load_dotenv
-from pathlib import Path
+from chroma_store import get_embeddings, poi_text, normalize_city, collection_name
+from poi_sync import sync_pois, stamp_hashes
+from spatial import spatial_indexes
+from city_snapshot import city_snapshots
+from observability import get_logger
 
-# Load environment variables from .env file
-# Try current directory first, then parent directory (backend-ai/)
-env_path = Path(__file__).parent / '.env'
-if not env_path.exists():
-    env_path = Path(__file__).parent.parent / '.env'
-load_dotenv(env_path)
+logger = get_logger("poi_loader")
 
 SAMPLE_POIS = [
     # Paris POIs
@@ -42,33 +38,43 @@ SAMPLE_POIS = [
     {"id":"tokyo_tower","name":"Tokyo Tower","city":"Tokyo","category":"architecture,landmarks","desc":"Red Eiffel Tower-inspired communications tower with observation decks.","lat":35.6586,"lng":139.7454,"open":"09:00","close":"22:00","duration_mins":90},
 ]
 
-def load_sample_into_chroma(persist_directory="./chroma_db"):
-    api_key = os.getenv("OPENAI_API_KEY")
-    base_url = os.getenv("OPENAI_BASE_URL")
-    
-    # Configure embeddings with optional OpenRouter support
-    if base_url:
-        # Using OpenRouter or custom endpoint
-        embeddings = OpenAIEmbeddings(
-            base_url=base_url,
-            api_key=api_key,
-            model="text-embedding-ada-002"
-        )
-    else:
-        # Using standard OpenAI endpoint
-        embeddings = OpenAIEmbeddings()
+def _invalidate_derived():
+    # Removed sample POIs may belong to any city, so drop everything built from the store
+    from agent import invalidate_itineraries  # agent imports most modules; keep this one light
+    spatial_indexes.invalidate()
+    city_snapshots.mark_reloaded()
+    invalidate_itineraries()
+
+def load_sample_into_chroma(persist_directory="./chroma_db", incremental=True):
+    """Load SAMPLE_POIS into Chroma.
+
+    In incremental mode only new or changed POIs are embedded and sample POIs
+    that were removed from the list are deleted. Returns a diff summary.
+    """
+    embeddings = get_embeddings()
     
+    # Normalized city lets retrieval filter by city inside Chroma
+    pois = [{**p, "city_norm": normalize_city(p["city"])} for p in SAMPLE_POIS]
+    if incremental:
+        db = Chroma(collection_name=collection_name(), persist_directory=persist_directory, embedding_function=embeddings)
+        summary = sync_pois(db._collection, embeddings, pois, source="sample")
+        logger.info(f"Synced sample POIs into Chroma at {persist_directory}: {summary}")
+        _invalidate_derived()
+        return summary
+
     texts = []
     metadatas = []
     ids = []
-    for p in SAMPLE_POIS:
-        text = f"{p['name']}. {p['desc']}. Category: {p['category']}. City: {p['city']}"
-        texts.append(text)
+    for p in stamp_hashes([{**p, "source": "sample"} for p in pois]):
+        texts.append(poi_text(p))
         metadatas.append(p)
         ids.append(p['id'])
-    db = Chroma.from_texts(texts, embeddings, ids=ids, persist_directory=persist_directory, metadatas=metadatas)
+    db = Chroma.from_texts(texts, embeddings, ids=ids, collection_name=collection_name(),
+                           persist_directory=persist_directory, metadatas=metadatas)
     # Persist is automatic with persist_directory parameter in newer versions
-    print("Loaded sample POIs into Chroma at", persist_directory)
+    logger.info(f"Loaded sample POIs into Chroma at {persist_directory}")
+    _invalidate_derived()
+    return {"added": len(ids), "updated": 0, "unchanged": 0, "deleted": 0}
 
 if __name__ == "__main__":
     load_sample_into_chroma()
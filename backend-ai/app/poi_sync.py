@@ -0,0 +1,88 @@
+import json
+import hashlib
+from chroma_store import poi_text
+
+HASH_FIELD = "content_hash"
+
+def content_hash(poi):
+    """Hash of everything that ends up in Chroma for a POI: embedded text plus metadata"""
+    metadata = {k: v for k, v in poi.items() if k != HASH_FIELD}
+    payload = poi_text(poi) + "\n" + json.dumps(metadata, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+class SyncSummary:
+    def __init__(self):
+        self.added = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+
+    def as_dict(self):
+        return {"added": self.added, "updated": self.updated, "unchanged": self.unchanged, "deleted": self.deleted}
+
+def stamp_hashes(batch):
+    for p in batch:
+        p[HASH_FIELD] = content_hash(p)
+    return batch
+
+def changed_pois(collection, batch, summary):
+    """Stamp content hashes on batch and return only POIs that are new or whose hash changed"""
+    stamp_hashes(batch)
+    existing = collection.get(ids=[p["id"] for p in batch], include=["metadatas"])
+    known = {poi_id: (metadata or {}).get(HASH_FIELD) for poi_id, metadata in zip(existing["ids"], existing["metadatas"])}
+    changed = []
+    for p in batch:
+        if p["id"] not in known:
+            summary.added += 1
+            changed.append(p)
+        elif known[p["id"]] != p[HASH_FIELD]:
+            summary.updated += 1
+            changed.append(p)
+        else:
+            summary.unchanged += 1
+    return changed
+
+def delete_missing(collection, source, seen_ids, summary, page_size=1000):
+    """Delete documents from `source` whose ids were not seen in this sync"""
+    stale = []
+    offset = 0
+    while True:
+        page = collection.get(where={"source": source}, include=[], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        stale.extend(poi_id for poi_id in page["ids"] if poi_id not in seen_ids)
+        offset += len(page["ids"])
+    for start in range(0, len(stale), page_size):
+        collection.delete(ids=stale[start:start + page_size])
+    summary.deleted += len(stale)
+    return stale
+
+def sync_pois(collection, embeddings, pois, source, batch_size=256):
+    """Make the `source` documents in collection match pois, embedding only what changed"""
+    summary = SyncSummary()
+    seen_ids = set()
+    batch = []
+
+    def flush():
+        changed = changed_pois(collection, batch, summary)
+        if changed:
+            collection.upsert(
+                ids=[p["id"] for p in changed],
+                embeddings=embeddings.embed_documents([poi_text(p) for p in changed]),
+                metadatas=changed,
+                documents=[poi_text(p) for p in changed],
+            )
+
+    for p in pois:
+        p = {**p, "source": source}
+        if p["id"] in seen_ids:
+            continue
+        seen_ids.add(p["id"])
+        batch.append(p)
+        if len(batch) >= batch_size:
+            flush()
+            batch = []
+    if batch:
+        flush()
+    delete_missing(collection, source, seen_ids, summary)
+    return summary.as_dict()
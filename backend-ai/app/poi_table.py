@@ -0,0 +1,149 @@
+"""Columnar POI table for the planning hot path.
+
+Built once per request from POI dicts: coordinates, durations and opening
+hours live in NumPy arrays and categories in a bitmask over an interned
+vocabulary, so ranking is a handful of vectorized operations. The original
+dicts are kept as `records` and only touched when steps are serialized.
+"""
+from typing import Dict, List
+import numpy as np
+from opening_hours import parse_hhmm, hours_windows
+
+def _category_tokens(category) -> List[str]:
+    return [t for t in (c.strip() for c in str(category or "").lower().split(",")) if t]
+
+def _float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+class PoiTable:
+    """List-like (len, iteration and indexing return the POI dicts) view with column arrays"""
+
+    def __init__(self, pois: List[Dict]):
+        self.records = list(pois)
+        n = len(self.records)
+        self.lat = np.array([_float(p.get("lat", 0)) for p in self.records], dtype=float)
+        self.lng = np.array([_float(p.get("lng", 0)) for p in self.records], dtype=float)
+        self.duration = np.array([int(_float(p.get("duration_mins", 60), 60)) for p in self.records], dtype=np.int64)
+        opens = [parse_hhmm(p["open"]) if p.get("open") else None for p in self.records]
+        closes = [parse_hhmm(p["close"]) if p.get("close") else None for p in self.records]
+        # -1 marks unknown hours (always open)
+        self.open = np.array([-1 if o is None else o for o in opens], dtype=np.int16)
+        self.close = np.array([-1 if c is None else c for c in closes], dtype=np.int16)
+
+        self.vocabulary = {}
+        by_text = {}  # category strings repeat a lot; tokenize each distinct one once
+        masks = []
+        for p in self.records:
+            text = p.get("category", "")
+            mask = by_text.get(text)
+            if mask is None:
+                mask = 0
+                for t in _category_tokens(text):
+                    bit = self.vocabulary.get(t)
+                    if bit is None:
+                        bit = self.vocabulary[t] = len(self.vocabulary)
+                    mask |= 1 << bit
+                by_text[text] = mask
+            masks.append(mask)
+        words = max(1, (len(self.vocabulary) + 63) // 64)
+        if words == 1:
+            self.category_mask = np.array(masks, dtype=np.uint64).reshape(n, 1)
+        else:
+            self.category_mask = np.array(
+                [[(m >> (64 * w)) & 0xFFFFFFFFFFFFFFFF for w in range(words)] for m in masks], dtype=np.uint64
+            ).reshape(n, words)
+        self._windows = None
+
+    @classmethod
+    def from_columns(cls, records, lat, lng, duration, opens, closes, vocabulary, category_mask) -> "PoiTable":
+        """Table over prebuilt columns (e.g. memory-mapped from a city snapshot), nothing re-parsed"""
+        table = cls.__new__(cls)
+        table.records = records
+        table.lat, table.lng, table.duration = lat, lng, duration
+        table.open, table.close = opens, closes
+        table.vocabulary = vocabulary
+        table.category_mask = category_mask
+        table._windows = None
+        return table
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, idx):
+        return self.records[idx]
+
+    def _interest_mask(self, interest: str):
+        """Bitmask of vocabulary entries containing the interest (same substring rule as before)"""
+        mask = np.zeros(self.category_mask.shape[1], dtype=np.uint64)
+        for token, bit in self.vocabulary.items():
+            if interest in token:
+                mask[bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+        return mask
+
+    def scores(self, interests) -> np.ndarray:
+        """10 points per matching interest, minus visit length in hours"""
+        score = -self.duration / 60.0
+        for interest in interests or []:
+            interest = str(interest).lower()
+            if not interest:
+                score = score + 10
+                continue
+            mask = self._interest_mask(interest)
+            if mask.any():
+                score = score + 10 * (self.category_mask & mask).any(axis=1)
+        return score
+
+    def matches(self, interests) -> np.ndarray:
+        """Boolean per row: the category matches at least one of the interests"""
+        hit = np.zeros(len(self.records), dtype=bool)
+        for interest in interests or []:
+            mask = self._interest_mask(str(interest).lower())
+            if mask.any():
+                hit |= (self.category_mask & mask).any(axis=1)
+        return hit
+
+    def rank_order(self, interests) -> np.ndarray:
+        """Indices best-first; ties keep input order"""
+        return np.argsort(-self.scores(interests), kind="stable")
+
+    def take(self, indices) -> "PoiTable":
+        """New table with the rows at indices, in that order (no re-parsing)"""
+        indices = np.asarray(indices, dtype=np.int64)
+        table = PoiTable.__new__(PoiTable)
+        table.records = [self.records[i] for i in indices.tolist()]
+        table.lat = self.lat[indices]
+        table.lng = self.lng[indices]
+        table.duration = self.duration[indices]
+        table.open = self.open[indices]
+        table.close = self.close[indices]
+        table.vocabulary = self.vocabulary
+        table.category_mask = self.category_mask[indices]
+        table._windows = None if self._windows is None else [self._windows[i] for i in indices.tolist()]
+        return table
+
+    def ranked(self, interests) -> "PoiTable":
+        return self.take(self.rank_order(interests))
+
+    @property
+    def windows(self):
+        """OpeningWindows per row, shared between rows with the same hours"""
+        if self._windows is None:
+            by_hours = {}
+            windows = []
+            for hours in zip(self.open.tolist(), self.close.tolist()):
+                w = by_hours.get(hours)
+                if w is None:
+                    o, c = hours
+                    w = by_hours[hours] = hours_windows(None if o < 0 else o, None if c < 0 else c)
+                windows.append(w)
+            self._windows = windows
+        return self._windows
+
+def as_table(pois) -> PoiTable:
+    return pois if isinstance(pois, PoiTable) else PoiTable(pois)
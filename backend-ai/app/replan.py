@@ -0,0 +1,228 @@
+"""Incremental re-planning: apply an edit (drop stops, add interests, change
+day_hours) to an itinerary that was already planned.
+
+The ranked candidates and travel matrix behind the original plan come from
+agent.plan_contexts, so an edit costs no retrieval, LLM or travel estimates.
+Within a day, stops before the first change keep their times and only the
+rest of the day is re-timed; days the edit doesn't touch come back as they were.
+"""
+from typing import Dict, List
+import agent
+from agent import plan_request_key, plan_contexts, pois_needed, _pack_day, DAY_START_MINUTES
+from cache import MISSING
+from city_snapshot import city_snapshots
+from tools import travel_time_matrix
+from poi_table import PoiTable
+from opening_hours import parse_hhmm, MINUTES_PER_DAY
+from observability import get_logger, span
+
+logger = get_logger("replan")
+
+def _norm(name) -> str:
+    return str(name or "").strip().lower()
+
+def _step_minutes(value) -> int:
+    """Step time -> minutes since midnight of the day it belongs to (times
+    before the day starts are past midnight)"""
+    minutes = parse_hhmm(value)
+    if minutes is None:
+        raise ValueError(f"invalid step time {value!r}")
+    return minutes + MINUTES_PER_DAY if minutes < DAY_START_MINUTES else minutes
+
+def _candidates(destination_city: str, dates: Dict, user_prefs: Dict, day_hours):
+    """Ranked candidate POIs for a trip, the way plan_itinerary retrieves them. Returns (table, error)."""
+    snapshot = city_snapshots.get(destination_city)
+    if snapshot is not None:
+        ranked, _, error = agent._snapshot_candidates(snapshot, destination_city, user_prefs)
+        return ranked, error
+    pois, error = agent._retrieve_pois(destination_city, user_prefs, max_pois=pois_needed(dates, day_hours))
+    if error:
+        return None, error
+    return agent._rank_candidates(destination_city, pois, user_prefs)
+
+def _plan_context(destination_city: str, dates: Dict, user_prefs: Dict, day_hours):
+    """(ranked table, travel matrix) the trip was planned with; rebuilt without
+    scheduling when this worker no longer has it. Returns (context, error)."""
+    key = plan_request_key(destination_city, dates, user_prefs, day_hours)
+    context = plan_contexts.get(key)
+    if context is not MISSING:
+        return context, None
+    logger.info(f"No plan context for {destination_city}, rebuilding candidates and travel matrix")
+    snapshot = city_snapshots.get(destination_city)
+    if snapshot is not None:
+        ranked, travel_matrix, error = agent._snapshot_candidates(snapshot, destination_city, user_prefs)
+        if error:
+            return None, error
+        context = (ranked, travel_matrix)
+        plan_contexts.set(key, context)
+        return context, None
+    ranked, error = _candidates(destination_city, dates, user_prefs, day_hours)
+    if error:
+        return None, error
+    with span("travel_matrix", pois=len(ranked)):
+        context = (ranked, travel_time_matrix(ranked))
+    plan_contexts.set(key, context)
+    return context, None
+
+def _step_record(step: Dict) -> Dict:
+    """POI dict for a step whose POI isn't among the candidates (no hours: always open)"""
+    return {k: step.get(k) for k in ("name", "category", "desc", "lat", "lng", "duration_mins")}
+
+class _Day:
+    """One day of the itinerary being edited: (table index, step) pairs in visiting order"""
+
+    def __init__(self, number, stops):
+        self.number = number
+        self.stops = stops
+        self.changed = False
+
+class _Replanner:
+    def __init__(self, table: PoiTable, travel_matrix, day_hours):
+        self.table = table
+        self.matrix = travel_matrix
+        self.durations = table.duration.tolist()
+        self.day_end = DAY_START_MINUTES + day_hours * 60
+
+    def pack_from(self, day: _Day, position: int, route: List[int]):
+        """Pack route after the first `position` stops of day, which keep their times.
+        Returns (stops, leftover indices)."""
+        prefix = day.stops[:position]
+        clock = _step_minutes(prefix[-1][1]["end_time"]) if prefix else None
+        last_idx = prefix[-1][0] if prefix else None
+        steps, leftovers = _pack_day(route, self.table, self.durations, self.matrix,
+                                     DAY_START_MINUTES, self.day_end, clock=clock, last_idx=last_idx)
+        skipped = set(leftovers)
+        placed = [idx for idx in route if idx not in skipped]
+        return prefix + list(zip(placed, steps)), leftovers
+
+    def retime(self, day: _Day, position: int):
+        """Re-time day from position onward; returns the stops that no longer fit"""
+        stops, leftovers = self.pack_from(day, position, [idx for idx, _ in day.stops[position:]])
+        day.stops = stops
+        day.changed = True
+        return leftovers
+
+    def insertion_cost(self, day: _Day, position: int, idx: int) -> int:
+        m = self.matrix
+        prev = day.stops[position - 1][0] if position > 0 else None
+        nxt = day.stops[position][0] if position < len(day.stops) else None
+        cost = (int(m[prev, idx]) if prev is not None else 0) + (int(m[idx, nxt]) if nxt is not None else 0)
+        if prev is not None and nxt is not None:
+            cost -= int(m[prev, nxt])
+        return cost
+
+    def insert(self, days: List[_Day], idx: int) -> bool:
+        """Put idx where it adds the least travel without pushing any later stop
+        out of its day or opening hours. False if it fits nowhere."""
+        options = sorted(
+            ((self.insertion_cost(day, position, idx), day.number, position, day)
+             for day in days for position in range(len(day.stops) + 1)),
+            key=lambda option: option[:3],
+        )
+        for _, _, position, day in options:
+            stops, leftovers = self.pack_from(day, position, [idx] + [i for i, _ in day.stops[position:]])
+            if not leftovers:
+                day.stops = stops
+                day.changed = True
+                return True
+        return False
+
+def replan_itinerary(destination_city: str, dates: Dict, user_prefs: Dict, day_hours, previous: Dict,
+                     drop: List[str] = (), add_interests: List[str] = (), new_day_hours=None):
+    """Edit a planned itinerary instead of planning the trip again.
+
+    destination_city, dates, user_prefs and day_hours describe the trip
+    `previous` was planned for. Dropped stops are removed; with a shorter
+    day, stops running past its end are moved to another day where they fit
+    or listed under "unscheduled". Then POIs matching the added interests,
+    displaced stops and previously unscheduled POIs are inserted, in that
+    order, wherever they add the least travel. Returns the itinerary with
+    "changed_days" listing the days that differ, or {"error": ...}.
+    """
+    days_in = previous.get("itinerary") if isinstance(previous, dict) else None
+    if not isinstance(days_in, list):
+        return {"error": "itinerary must be a result of /plan_trip or /replan"}
+    context, error = _plan_context(destination_city, dates, user_prefs, day_hours)
+    if error:
+        return error
+    table, travel_matrix = context
+
+    interests = list(user_prefs.get("interests", []))
+    known = {_norm(i) for i in interests}
+    added = [str(i).strip() for i in add_interests if _norm(i) and _norm(i) not in known]
+    new_prefs = {**user_prefs, "interests": interests + added}
+    hours = new_day_hours or day_hours
+
+    # New candidates: POIs retrieved for the added interests, and stops the
+    # candidates don't include (e.g. the context was rebuilt from newer data)
+    names = {_norm(p.get("name")) for p in table.records}
+    extra = []
+    if added:
+        ranked, error = _candidates(destination_city, dates, new_prefs, hours)
+        if error:
+            return error
+        for p in ranked.records:
+            if _norm(p.get("name")) not in names:
+                names.add(_norm(p.get("name")))
+                extra.append(p)
+    for day in days_in:
+        for step in day.get("steps", []):
+            if _norm(step.get("name")) not in names:
+                names.add(_norm(step.get("name")))
+                extra.append(_step_record(step))
+    if extra:
+        table = PoiTable(table.records + extra)
+        with span("travel_matrix", pois=len(table)):
+            travel_matrix = travel_time_matrix(table)
+    # Follow-up edits arrive with the updated trip
+    plan_contexts.set(plan_request_key(destination_city, dates, new_prefs, hours), (table, travel_matrix))
+
+    index = {}
+    for i, p in enumerate(table.records):
+        index.setdefault(_norm(p.get("name")), i)
+    dropped = {_norm(name) for name in drop if _norm(name)}
+
+    with span("scheduling", pois=len(table)):
+        planner = _Replanner(table, travel_matrix, hours)
+        days = [_Day(day.get("day", n + 1), [(index[_norm(s.get("name"))], s) for s in day.get("steps", [])])
+                for n, day in enumerate(days_in)]
+        displaced = []
+        for day in days:
+            positions = [k for k, (_, step) in enumerate(day.stops) if _norm(step.get("name")) in dropped]
+            first_change = positions[0] if positions else None
+            if positions:
+                day.stops = [stop for stop in day.stops if _norm(stop[1].get("name")) not in dropped]
+            if hours < day_hours:
+                overrun = next((k for k, (_, step) in enumerate(day.stops)
+                                if _step_minutes(step["end_time"]) > planner.day_end), None)
+                if overrun is not None:
+                    first_change = overrun if first_change is None else min(first_change, overrun)
+            if first_change is not None:
+                displaced.extend(planner.retime(day, first_change))
+
+        used = {idx for day in days for idx, _ in day.stops}
+        excluded = used | {index[name] for name in dropped if name in index}
+        # (index, listed as unscheduled if it can't be placed)
+        pool = []
+        if added:
+            matches = table.matches(added)
+            pool.extend((int(i), False) for i in table.rank_order(added) if matches[i])
+        pool.extend((idx, True) for idx in displaced)
+        pool.extend((index[_norm(name)], True) for name in previous.get("unscheduled", []) if _norm(name) in index)
+
+        unscheduled = []
+        for idx, owed in pool:
+            if idx in excluded:
+                continue
+            excluded.add(idx)
+            if not planner.insert(days, idx) and owed:
+                unscheduled.append(table.records[idx].get("name", ""))
+
+    result = {
+        "city": destination_city,
+        "itinerary": [{"day": day.number, "steps": [step for _, step in day.stops]} for day in days],
+        "changed_days": [day.number for day in days if day.changed],
+    }
+    if unscheduled:
+        result["unscheduled"] = unscheduled
+    return result
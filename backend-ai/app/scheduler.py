@@ -0,0 +1,221 @@
+"""Day scheduling on a precomputed travel-time matrix: capacity-aware k-medoids
+to split POIs into days, then nearest-neighbour + 2-opt/Or-opt within each day,
+all bounded by a time budget."""
+import os
+import math
+import time
+import numpy as np
+
+SCHEDULER_TIME_BUDGET_MS = float(os.getenv("SCHEDULER_TIME_BUDGET_MS", "3"))
+CLUSTER_ITERATIONS = 5
+
+def _route_cost(route, m):
+    return sum(m[a][b] for a, b in zip(route, route[1:]))
+
+def estimate_days(arr, durations, minutes_per_day):
+    """Days needed: visit time plus each stop's cheapest hop from another stop."""
+    n = len(durations)
+    if n > 1:
+        masked = arr + np.diag(np.full(n, np.inf))
+        hops = masked.min(axis=0).sum()
+    else:
+        hops = 0
+    return max(1, math.ceil((sum(durations) + hops) / minutes_per_day))
+
+def select_by_rank(arr, durations, capacity):
+    """Indices 0..n-1 (priority order) taken best first while their visit time
+    plus cheapest hop from a stop already taken fits in capacity minutes."""
+    n = len(durations)
+    sym = np.minimum(arr, arr.T)
+    nearest = np.full(n, np.inf)
+    shortest = min(durations)
+    selected = []
+    load = 0.0
+    for i in range(n):
+        hop = nearest[i] if selected else 0.0
+        if load + durations[i] + hop > capacity:
+            continue
+        selected.append(i)
+        load += durations[i] + hop
+        if capacity - load < shortest:
+            break
+        nearest = np.minimum(nearest, sym[i])
+    return selected
+
+def _farthest_point_seeds(sym, k):
+    seeds = [0]
+    nearest = sym[0].copy()
+    while len(seeds) < k:
+        nearest[seeds] = -1
+        candidate = int(np.argmax(nearest))
+        if nearest[candidate] < 0:
+            break
+        seeds.append(candidate)
+        nearest = np.minimum(nearest, sym[candidate])
+    return seeds
+
+def cluster_days(arr, durations, n_days, capacity, deadline=None):
+    """Split POI indices 0..n-1 into at most n_days geographic groups whose load fits capacity where possible.
+
+    Indices are in priority order; groups come back ordered by their
+    highest-priority member and keep that order internally.
+    """
+    n = len(durations)
+    if n_days <= 1 or n <= 1:
+        return [list(range(n))]
+    sym = (arr + arr.T) / 2.0
+    medoids = _farthest_point_seeds(sym, min(n_days, n))
+    assignment = None
+    for _ in range(CLUSTER_ITERATIONS):
+        dist = sym[:, medoids]
+        ranked_medoids = np.argsort(dist, axis=1)
+        sorted_dist = np.take_along_axis(dist, ranked_medoids, axis=1)
+        # Assign the POIs with the most to lose first (largest regret)
+        regret = sorted_dist[:, 1] - sorted_dist[:, 0] if len(medoids) > 1 else np.zeros(n)
+        load = [0.0] * len(medoids)
+        new_assignment = [0] * n
+        for i in np.argsort(-regret, kind="stable").tolist():
+            choice = ranked_medoids[i, 0]
+            for rank_pos, c in enumerate(ranked_medoids[i].tolist()):
+                if load[c] + durations[i] + sorted_dist[i, rank_pos] <= capacity:
+                    choice = c
+                    break
+            new_assignment[i] = int(choice)
+            load[choice] += durations[i] + sorted_dist[i, 0]
+        if new_assignment == assignment:
+            break
+        assignment = new_assignment
+        members = {}
+        for i, c in enumerate(assignment):
+            members.setdefault(c, []).append(i)
+        # New medoid: the member with the smallest total travel to the rest of its group
+        medoids = [group[int(np.argmin(sym[np.ix_(group, group)].sum(axis=1)))] for group in members.values()]
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+    groups = {}
+    for i, c in enumerate(assignment):
+        groups.setdefault(c, []).append(i)
+    return sorted(groups.values(), key=lambda g: g[0])
+
+def nearest_neighbor_route(nodes, m, start):
+    route = [start]
+    remaining = set(nodes)
+    remaining.discard(start)
+    while remaining:
+        last = route[-1]
+        nxt = min(remaining, key=lambda j: m[last][j])
+        route.append(nxt)
+        remaining.discard(nxt)
+    return route
+
+def two_opt(route, m, deadline):
+    """Reverse segments of an open path while that shortens it (handles asymmetric matrices)."""
+    n = len(route)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        # Prefix sums of forward and backward edge costs make each move O(1)
+        fwd = [0] * n
+        bwd = [0] * n
+        for k in range(1, n):
+            fwd[k] = fwd[k - 1] + m[route[k - 1]][route[k]]
+            bwd[k] = bwd[k - 1] + m[route[k]][route[k - 1]]
+        for i in range(0, n - 1):
+            for j in range(i + 1, n):
+                # Reverse route[i..j]
+                before = (m[route[i - 1]][route[i]] if i > 0 else 0) + (m[route[j]][route[j + 1]] if j < n - 1 else 0)
+                after = (m[route[i - 1]][route[j]] if i > 0 else 0) + (m[route[i]][route[j + 1]] if j < n - 1 else 0)
+                inner_before = fwd[j] - fwd[i]
+                inner_after = bwd[j] - bwd[i]
+                if after + inner_after < before + inner_before:
+                    route[i:j + 1] = route[i:j + 1][::-1]
+                    improved = True
+                    break
+            if improved or time.perf_counter() >= deadline:
+                break
+    return route
+
+def or_opt(route, m, deadline, max_segment=3):
+    """Move runs of 1-3 consecutive stops to a cheaper position in the path."""
+    n = len(route)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for seg_len in range(1, min(max_segment, n - 1) + 1):
+            for i in range(0, n - seg_len + 1):
+                j = i + seg_len - 1
+                seg = route[i:j + 1]
+                prev = route[i - 1] if i > 0 else None
+                nxt = route[j + 1] if j < n - 1 else None
+                removed = (m[prev][seg[0]] if prev is not None else 0) + (m[seg[-1]][nxt] if nxt is not None else 0)
+                bridged = m[prev][nxt] if prev is not None and nxt is not None else 0
+                rest = route[:i] + route[j + 1:]
+                best_gain, best_pos = 0, None
+                for pos in range(0, len(rest) + 1):
+                    if pos == i:
+                        continue
+                    a = rest[pos - 1] if pos > 0 else None
+                    b = rest[pos] if pos < len(rest) else None
+                    broken = m[a][b] if a is not None and b is not None else 0
+                    added = (m[a][seg[0]] if a is not None else 0) + (m[seg[-1]][b] if b is not None else 0)
+                    gain = (removed - bridged) - (added - broken)
+                    if gain > best_gain:
+                        best_gain, best_pos = gain, pos
+                if best_pos is not None:
+                    route[:] = rest[:best_pos] + seg + rest[best_pos:]
+                    improved = True
+                    break
+            if improved or time.perf_counter() >= deadline:
+                break
+    return route
+
+def order_day(nodes, m, deadline):
+    """Short open path through nodes: best nearest-neighbour start, then 2-opt and Or-opt."""
+    if len(nodes) <= 2:
+        if len(nodes) == 2 and m[nodes[1]][nodes[0]] < m[nodes[0]][nodes[1]]:
+            return [nodes[1], nodes[0]]
+        return list(nodes)
+    best = None
+    for start in nodes:
+        route = nearest_neighbor_route(nodes, m, start)
+        if best is None or _route_cost(route, m) < _route_cost(best, m):
+            best = route
+        if time.perf_counter() >= deadline:
+            break
+    best = two_opt(best, m, deadline)
+    best = or_opt(best, m, deadline)
+    return best
+
+def plan_day_routes(durations, travel_matrix, minutes_per_day, time_budget_ms=None, max_days=None):
+    """Group POI indices into days and order each day.
+
+    durations[i] is the visit length of POI i and travel_matrix[i, j] the
+    minutes from i to j. Indices are assumed to be in priority order (best
+    first). max_days caps the number of groups (e.g. the trip length); then
+    only the best POIs that fit in max_days are routed, so what gets left
+    out is the lowest-priority POIs rather than the ends of the routes.
+    Returns a list of ordered index lists, one per day.
+    """
+    n = len(durations)
+    if n == 0:
+        return []
+    budget = SCHEDULER_TIME_BUDGET_MS if time_budget_ms is None else time_budget_ms
+    deadline = time.perf_counter() + budget / 1000.0
+    arr = np.asarray(travel_matrix, dtype=float)
+    m = arr.tolist()
+    selected = list(range(n))
+    n_days = estimate_days(arr, durations, minutes_per_day)
+    if max_days and n_days > max_days:
+        n_days = max_days
+        selected = select_by_rank(arr, durations, max_days * minutes_per_day)
+        arr = arr[np.ix_(selected, selected)]
+        durations = [durations[i] for i in selected]
+        m = arr.tolist()
+    groups = cluster_days(arr, durations, n_days, minutes_per_day, deadline)
+    routes = []
+    for g_idx, group in enumerate(groups):
+        # Give each remaining day an equal share of the remaining budget
+        remaining = max(0.0, deadline - time.perf_counter())
+        day_deadline = time.perf_counter() + remaining / (len(groups) - g_idx)
+        routes.append([selected[i] for i in order_day(group, m, day_deadline)])
+    return routes
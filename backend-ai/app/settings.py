@@ -0,0 +1,56 @@
+"""One-time configuration and lazily built clients.
+
+.env is loaded here, once, before any module reads os.getenv. The chat model
+is only constructed (and langchain_openai only imported) on first use or by
+the server's startup warm-up, so importing the app and serving /health stay
+cheap on a cold worker.
+"""
+import os
+import threading
+from pathlib import Path
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+# Try current directory first, then parent directory (backend-ai/)
+env_path = Path(__file__).parent / '.env'
+if not env_path.exists():
+    env_path = Path(__file__).parent.parent / '.env'
+load_dotenv(env_path)
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+# How the server warms clients on startup: "background" (serve immediately,
+# build clients in a thread), "blocking" (build before serving) or "off" (first use)
+WARM_UP_MODE = os.getenv("WARM_UP_MODE", "background").strip().lower()
+
+_llm = None
+_llm_lock = threading.Lock()
+
+def llm_configured() -> bool:
+    """True when a chat model is or can be built, without building it"""
+    return _llm is not None or bool(OPENAI_API_KEY)
+
+def get_llm():
+    """Shared chat model (OpenAI or an OpenAI-compatible endpoint such as OpenRouter); None without an API key"""
+    global _llm
+    if _llm is None and OPENAI_API_KEY:
+        with _llm_lock:
+            if _llm is None:
+                from langchain_openai import ChatOpenAI
+                from upstream import llm_upstream
+                # Retries and timeouts are applied by llm_upstream, not the client
+                options = dict(temperature=0.0, model=OPENAI_MODEL, stream_usage=True,
+                               timeout=llm_upstream.timeout, max_retries=0)
+                if OPENAI_BASE_URL:
+                    # ChatOpenAI uses chat/completions endpoint which OpenRouter requires
+                    _llm = ChatOpenAI(base_url=OPENAI_BASE_URL, api_key=OPENAI_API_KEY, **options)
+                else:
+                    _llm = ChatOpenAI(**options)
+    return _llm
+
+def set_llm(llm):
+    """Use this chat model instead of the configured one (e.g. an offline stand-in)"""
+    global _llm
+    with _llm_lock:
+        _llm = llm
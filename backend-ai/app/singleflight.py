@@ -0,0 +1,82 @@
+import asyncio
+import threading
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into one execution.
+
+    The first caller for a key runs the function; callers that arrive while it
+    is in flight block and receive the same result (or exception). Results are
+    shared objects, so callers must treat them as read-only.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.deduplicated = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.deduplicated += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._calls)
+        return {"executed": self.executed, "deduplicated": self.deduplicated, "in_flight": in_flight}
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines running on one event loop."""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self.executed = 0
+        self.deduplicated = 0
+
+    async def do(self, key, fn, *args, **kwargs):
+        future = self._calls.get(key)
+        if future is not None:
+            self.deduplicated += 1
+            # shield() so a cancelled waiter doesn't cancel the shared work
+            return await asyncio.shield(future)
+
+        self.executed += 1
+        future = asyncio.ensure_future(fn(*args, **kwargs))
+        self._calls[key] = future
+        future.add_done_callback(lambda f: self._calls.pop(key, None) if self._calls.get(key) is f else None)
+        return await asyncio.shield(future)
+
+    def stats(self):
+        return {"executed": self.executed, "deduplicated": self.deduplicated, "in_flight": len(self._calls)}
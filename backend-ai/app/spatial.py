@@ -0,0 +1,95 @@
+"""Per-city spatial indexes over POI coordinates (ball tree on radians with
+the haversine metric) for radius, k-nearest and bounding-box lookups."""
+import os
+from typing import Dict, List
+import numpy as np
+from cache import MISSING, LRUCache
+from chroma_store import iter_city_pois, normalize_city
+from observability import get_logger
+
+logger = get_logger("spatial")
+
+EARTH_RADIUS_KM = 6371.0
+SPATIAL_INDEX_CACHE_SIZE = int(os.getenv("SPATIAL_INDEX_CACHE_SIZE", "64"))
+SPATIAL_INDEX_TTL_SECS = int(os.getenv("SPATIAL_INDEX_TTL_SECS", "3600"))
+
+class CityIndex:
+    """Immutable spatial index over one city's POIs"""
+
+    def __init__(self, pois: List[Dict]):
+        self.pois = [p for p in pois if _has_coords(p)]
+        coords = np.array([[float(p["lat"]), float(p["lng"])] for p in self.pois], dtype=float).reshape(-1, 2)
+        self.coords = coords
+        # sklearn is slow to import; only pay for it once an index is built
+        from sklearn.neighbors import BallTree
+        self._tree = BallTree(np.radians(coords), metric="haversine") if len(coords) else None
+
+    def __len__(self):
+        return len(self.pois)
+
+    def _results(self, idx, dist_rad):
+        return [{**self.pois[i], "distance_km": round(float(d) * EARTH_RADIUS_KM, 3)} for i, d in zip(idx, dist_rad)]
+
+    def within_radius(self, lat, lng, radius_km, limit=None):
+        """POIs within radius_km of (lat, lng), nearest first, each with distance_km"""
+        if self._tree is None:
+            return []
+        point = np.radians([[float(lat), float(lng)]])
+        idx, dist = self._tree.query_radius(point, r=radius_km / EARTH_RADIUS_KM, return_distance=True, sort_results=True)
+        idx, dist = idx[0], dist[0]
+        if limit is not None:
+            idx, dist = idx[:limit], dist[:limit]
+        return self._results(idx, dist)
+
+    def nearest(self, lat, lng, k=10):
+        """The k POIs closest to (lat, lng), nearest first, each with distance_km"""
+        if self._tree is None or k <= 0:
+            return []
+        point = np.radians([[float(lat), float(lng)]])
+        dist, idx = self._tree.query(point, k=min(k, len(self.pois)))
+        return self._results(idx[0], dist[0])
+
+    def within_bbox(self, min_lat, min_lng, max_lat, max_lng):
+        """POIs inside a lat/lng box (no antimeridian wrap)"""
+        if not len(self.coords):
+            return []
+        lat, lng = self.coords[:, 0], self.coords[:, 1]
+        mask = (lat >= min_lat) & (lat <= max_lat) & (lng >= min_lng) & (lng <= max_lng)
+        return [self.pois[i] for i in np.flatnonzero(mask)]
+
+def _has_coords(poi):
+    try:
+        lat, lng = float(poi.get("lat")), float(poi.get("lng"))
+    except (TypeError, ValueError):
+        return False
+    # 0,0 is the "unknown" default used across the app
+    return -90 <= lat <= 90 and -180 <= lng <= 180 and (lat, lng) != (0.0, 0.0)
+
+class SpatialIndexManager:
+    """City indexes built lazily from ChromaDB metadata and kept in an LRU.
+
+    Entries expire after SPATIAL_INDEX_TTL_SECS; call invalidate() when a
+    city's POIs are reloaded.
+    """
+
+    def __init__(self):
+        self._indexes = LRUCache(maxsize=SPATIAL_INDEX_CACHE_SIZE, ttl=SPATIAL_INDEX_TTL_SECS)
+
+    def get(self, city) -> CityIndex:
+        key = normalize_city(city)
+        index = self._indexes.get(key)
+        if index is MISSING:
+            index = CityIndex(list(iter_city_pois(city)))
+            logger.info(f"Built spatial index for {city}: {len(index)} POIs")
+            # Empty cities aren't cached so POIs written back later show up
+            if len(index):
+                self._indexes.set(key, index)
+        return index
+
+    def invalidate(self, city=None):
+        if city:
+            self._indexes.delete(normalize_city(city))
+        else:
+            self._indexes.clear()
+
+spatial_indexes = SpatialIndexManager()
@@ -1,7 +1,61 @@
-import os, math, requests
+import os, math, asyncio, requests
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from requests.adapters import HTTPAdapter
+from cache import MISSING, lazy_cache
+from observability import get_logger
+from upstream import maps_upstream, UpstreamError, UpstreamStatusError
 
 MAPS_KEY = os.getenv("MAPS_API_KEY", "")
 
+logger = get_logger("tools")
+DISTANCE_MATRIX_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+# Distance Matrix API allows at most 100 elements (origins x destinations) per request
+MATRIX_BLOCK = 10
+# ... and at most 25 destinations
+MATRIX_MAX_DESTINATIONS = 25
+MATRIX_WORKERS = int(os.getenv("MAPS_MATRIX_WORKERS", "4"))
+SPEED_KMPH = {"walking":5, "transit":20, "driving":40}
+
+# Distance Matrix results are cached by rounded coordinates + mode.
+# Set TRAVEL_CACHE_PATH to an empty string to keep the cache in memory only.
+TRAVEL_CACHE_PRECISION = int(os.getenv("TRAVEL_CACHE_PRECISION", "4"))  # ~11 m
+get_travel_cache = lazy_cache(
+    "travel_times",
+    os.getenv("TRAVEL_CACHE_PATH", "./cache/travel_cache.sqlite"),
+    memory_size=int(os.getenv("TRAVEL_CACHE_MEMORY_SIZE", "50000")),
+    disk_size=int(os.getenv("TRAVEL_CACHE_DISK_SIZE", "1000000")),
+    ttl=int(os.getenv("TRAVEL_CACHE_TTL_SECS", str(7 * 24 * 3600))),
+)
+
+# Pooled HTTP session so cache misses reuse connections to the Maps API
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max(4, MATRIX_WORKERS)))
+
+# Async client for the non-blocking pipeline, created on first use inside the event loop.
+# Concurrency, rate limits, timeouts and retries for Maps calls come from upstream.maps_upstream.
+MAPS_MAX_CONCURRENCY = int(os.getenv("MAPS_MAX_CONCURRENCY", "16"))
+_async_http_client = None
+
+def get_async_http_client():
+    global _async_http_client
+    if _async_http_client is None:
+        import httpx  # only the async Maps path needs it
+        limits = httpx.Limits(max_connections=MAPS_MAX_CONCURRENCY, max_keepalive_connections=MAPS_MAX_CONCURRENCY)
+        _async_http_client = httpx.AsyncClient(limits=limits)
+    return _async_http_client
+
+async def aclose_async_http_client():
+    global _async_http_client
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+        _async_http_client = None
+
+def travel_cache_key(a, b, mode):
+    p = TRAVEL_CACHE_PRECISION
+    return f"{round(a[0], p)},{round(a[1], p)}|{round(b[0], p)},{round(b[1], p)}|{mode}"
+
 def haversine(lat1, lon1, lat2, lon2):
     R = 6371.0
     phi1 = math.radians(lat1)
@@ -11,18 +65,208 @@ def haversine(lat1, lon1, lat2, lon2):
     a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
     return 2 * R * math.asin(math.sqrt(a))
 
+def haversine_matrix(lats, lngs):
+    """Pairwise great-circle distances in km for arrays of coordinates (N x N)."""
+    R = 6371.0
+    phi = np.radians(np.asarray(lats, dtype=float))
+    lam = np.radians(np.asarray(lngs, dtype=float))
+    dphi = phi[None, :] - phi[:, None]
+    dlambda = lam[None, :] - lam[:, None]
+    a = np.sin(dphi/2)**2 + np.cos(phi)[:, None]*np.cos(phi)[None, :]*np.sin(dlambda/2)**2
+    return 2 * R * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def haversine_from(lat, lng, lats, lngs):
+    """Great-circle distances in km from one point to arrays of coordinates."""
+    R = 6371.0
+    phi1 = math.radians(lat)
+    phi2 = np.radians(np.asarray(lats, dtype=float))
+    dphi = phi2 - phi1
+    dlambda = np.radians(np.asarray(lngs, dtype=float)) - math.radians(lng)
+    a = np.sin(dphi/2)**2 + math.cos(phi1)*np.cos(phi2)*np.sin(dlambda/2)**2
+    return 2 * R * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
 def estimate_travel_time_minutes(a, b, mode="walking"):
     if MAPS_KEY:
-        url = "https://maps.googleapis.com/maps/api/distancematrix/json"
+        key = travel_cache_key((a['lat'], a['lng']), (b['lat'], b['lng']), mode)
+        cached = get_travel_cache().get(key)
+        if cached is not MISSING:
+            return cached
         params = {"origins":f"{a['lat']},{a['lng']}", "destinations":f"{b['lat']},{b['lng']}", "key": MAPS_KEY, "mode": mode}
-        r = requests.get(url, params=params)
-        if r.ok:
-            data = r.json()
+        try:
+            data = maps_upstream.call(_get_matrix_json, params)
+            secs = data['rows'][0]['elements'][0]['duration']['value']
+            minutes = int(secs/60)
+            get_travel_cache().set(key, minutes)
+            return minutes
+        except UpstreamError as e:
+            logger.warning(f"Distance Matrix request failed, using haversine estimate: {str(e)}")
+        except Exception:
+            pass
+    dist_km = haversine(a['lat'], a['lng'], b['lat'], b['lng'])
+    speed_kmph = SPEED_KMPH.get(mode,20)
+    return max(5, int((dist_km / speed_kmph)*60))
+
+def _block_params(coords, rows, cols, mode):
+    return {
+        "origins": "|".join(f"{coords[i][0]},{coords[i][1]}" for i in rows),
+        "destinations": "|".join(f"{coords[j][0]},{coords[j][1]}" for j in cols),
+        "key": MAPS_KEY,
+        "mode": mode,
+    }
+
+def _parse_block(data, rows, cols):
+    found = {}
+    for ri, row in zip(rows, data.get('rows', [])):
+        for ci, element in zip(cols, row.get('elements', [])):
             try:
-                secs = data['rows'][0]['elements'][0]['duration']['value']
-                return int(secs/60)
+                found[(ri, ci)] = int(element['duration']['value']/60)
             except Exception:
                 pass
-    dist_km = haversine(a['lat'], a['lng'], b['lat'], b['lng'])
-    speed_kmph = {"walking":5, "transit":20, "driving":40}.get(mode,20)
-    return max(5, int((dist_km / speed_kmph)*60))
+    return found
+
+def _check_matrix_response(status_code, data):
+    if status_code >= 400:
+        raise UpstreamStatusError(status_code)
+    # Quota errors come back as 200 with a status field; worth retrying after a backoff
+    if data.get("status") in ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR"):
+        raise UpstreamStatusError(429 if data["status"] == "OVER_QUERY_LIMIT" else 503, data["status"])
+    return data
+
+def _get_matrix_json(timeout, params):
+    r = http_session.get(DISTANCE_MATRIX_URL, params=params, timeout=timeout)
+    return _check_matrix_response(r.status_code, r.json() if r.ok else {})
+
+async def _aget_matrix_json(timeout, params):
+    r = await get_async_http_client().get(DISTANCE_MATRIX_URL, params=params, timeout=timeout)
+    return _check_matrix_response(r.status_code, r.json() if r.status_code < 400 else {})
+
+def _fetch_matrix_block(coords, rows, cols, mode):
+    """Query one origins x destinations block. Returns {(i, j): minutes} for the elements that resolved;
+    empty if the request failed, leaving the haversine estimate in place."""
+    try:
+        data = maps_upstream.call(_get_matrix_json, _block_params(coords, rows, cols, mode), cost=len(rows) * len(cols))
+    except UpstreamError as e:
+        logger.warning(f"Distance Matrix request failed: {str(e)}")
+        return {}
+    return _parse_block(data, rows, cols)
+
+async def _afetch_matrix_block(coords, rows, cols, mode):
+    try:
+        data = await maps_upstream.acall(_aget_matrix_json, _block_params(coords, rows, cols, mode), cost=len(rows) * len(cols))
+    except UpstreamError as e:
+        logger.warning(f"Distance Matrix request failed: {str(e)}")
+        return {}
+    return _parse_block(data, rows, cols)
+
+def estimate_travel_matrix(lats, lngs, mode="walking"):
+    """Haversine travel-minute estimates between every pair of coordinates (N x N),
+    same rules as estimate_travel_time_minutes without an API key."""
+    speed_kmph = SPEED_KMPH.get(mode,20)
+    return np.maximum(5, np.floor(haversine_matrix(lats, lngs) / speed_kmph * 60)).astype(int)
+
+def _fallback_matrix(coords, mode):
+    lats = np.array([c[0] for c in coords], dtype=float)
+    lngs = np.array([c[1] for c in coords], dtype=float)
+    return estimate_travel_matrix(lats, lngs, mode)
+
+def _pending_blocks(coords, matrix, mode):
+    """Fill matrix from the travel cache; return cache keys and the blocks that still need the API."""
+    n = len(coords)
+    keys = {(i, j): travel_cache_key(coords[i], coords[j], mode)
+            for i in range(n) for j in range(n) if i != j}
+    cached = get_travel_cache().get_many(keys.values())
+    missing = set()
+    for (i, j), key in keys.items():
+        if key in cached:
+            matrix[i, j] = cached[key]
+        else:
+            missing.add((i, j))
+    blocks = []
+    for r0 in range(0, n, MATRIX_BLOCK):
+        for c0 in range(0, n, MATRIX_BLOCK):
+            rows = list(range(r0, min(n, r0 + MATRIX_BLOCK)))
+            cols = list(range(c0, min(n, c0 + MATRIX_BLOCK)))
+            if any((i, j) in missing for i in rows for j in cols):
+                blocks.append((rows, cols))
+    return keys, blocks
+
+def _apply_fetched(matrix, keys, results):
+    fetched = []
+    for found in results:
+        for (i, j), minutes in found.items():
+            matrix[i, j] = minutes
+            if i != j:
+                fetched.append((keys[(i, j)], minutes))
+    get_travel_cache().set_many(fetched)
+
+def _fetch_matrix_blocks(coords, blocks, mode):
+    with ThreadPoolExecutor(max_workers=max(1, MATRIX_WORKERS)) as pool:
+        # copy_context() so each block sees the caller's request id and deadline
+        futures = [pool.submit(contextvars.copy_context().run, _fetch_matrix_block, coords, origins, targets, mode)
+                   for origins, targets in blocks]
+        return [future.result() for future in futures]
+
+def travel_time_matrix(pois, mode="walking"):
+    """Travel minutes between every pair of POIs as an N x N int array.
+
+    Starts from the vectorized haversine estimate (same rules as
+    estimate_travel_time_minutes) and, when MAPS_API_KEY is set, overwrites it
+    with cached or batched Distance Matrix results. The diagonal is always 0.
+    """
+    coords = [(p.get("lat", 0), p.get("lng", 0)) for p in pois]
+    if not coords:
+        return np.zeros((0, 0), dtype=int)
+    matrix = _fallback_matrix(coords, mode)
+
+    if MAPS_KEY and len(coords) > 1:
+        # Serve what we can from the travel cache; only blocks with a miss hit the API
+        keys, blocks = _pending_blocks(coords, matrix, mode)
+        if blocks:
+            results = _fetch_matrix_blocks(coords, blocks, mode)
+            _apply_fetched(matrix, keys, results)
+
+    np.fill_diagonal(matrix, 0)
+    return matrix
+
+def fetch_travel_times(pois, destinations, mode="walking"):
+    """Distance Matrix minutes from each POI i to the POIs listed in destinations[i],
+    as {(i, j): minutes}. Served from the travel cache where possible; pairs the
+    API didn't resolve (errors, rate limiting) are missing. Needs MAPS_API_KEY."""
+    coords = [(p.get("lat", 0), p.get("lng", 0)) for p in pois]
+    keys = {(i, int(j)): travel_cache_key(coords[i], coords[int(j)], mode)
+            for i, targets in enumerate(destinations) for j in targets if 0 <= int(j) != i}
+    cached = get_travel_cache().get_many(keys.values())
+    found = {pair: cached[key] for pair, key in keys.items() if key in cached}
+    missing = {}
+    for i, j in keys:
+        if (i, j) not in found:
+            missing.setdefault(i, []).append(j)
+    # One origin per request, so only the pairs asked for are billed
+    blocks = [([i], targets[start:start + MATRIX_MAX_DESTINATIONS])
+              for i, targets in missing.items() for start in range(0, len(targets), MATRIX_MAX_DESTINATIONS)]
+    if blocks and MAPS_KEY:
+        results = _fetch_matrix_blocks(coords, blocks, mode)
+        fetched = []
+        for result in results:
+            for pair, minutes in result.items():
+                found[pair] = minutes
+                fetched.append((keys[pair], minutes))
+        get_travel_cache().set_many(fetched)
+    return found
+
+async def atravel_time_matrix(pois, mode="walking"):
+    """Async travel_time_matrix: Distance Matrix blocks are fetched concurrently
+    over a pooled httpx client, bounded by MAPS_MAX_CONCURRENCY."""
+    coords = [(p.get("lat", 0), p.get("lng", 0)) for p in pois]
+    if not coords:
+        return np.zeros((0, 0), dtype=int)
+    matrix = _fallback_matrix(coords, mode)
+
+    if MAPS_KEY and len(coords) > 1:
+        keys, blocks = _pending_blocks(coords, matrix, mode)
+        if blocks:
+            results = await asyncio.gather(*(_afetch_matrix_block(coords, rows, cols, mode) for rows, cols in blocks))
+            _apply_fetched(matrix, keys, results)
+
+    np.fill_diagonal(matrix, 0)
+    return matrix
@@ -0,0 +1,273 @@
+"""Shared call policy for upstream services (the LLM and the Distance Matrix API).
+
+Each Upstream bounds concurrency (separately for worker threads and the event
+loop), rate-limits with a token bucket, retries failures with full-jitter
+exponential backoff and never waits past the current request's deadline.
+Callers catch UpstreamError and degrade: haversine travel estimates, cached
+POIs, or an {"error": ...} result.
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from observability import get_logger, registry, Counter, Histogram, UPSTREAM_ERRORS
+
+logger = get_logger("upstream")
+
+# Default time budget for one incoming request; clients can lower it with X-Request-Timeout
+REQUEST_TIMEOUT_SECS = float(os.getenv("REQUEST_TIMEOUT_SECS", "60"))
+# Absolute time.monotonic() by which the current request must be answered
+deadline_var = contextvars.ContextVar("upstream_deadline", default=None)
+
+UPSTREAM_SECONDS = registry.register(Histogram(
+    "tourplanner_upstream_seconds", "Latency of individual upstream call attempts", ["upstream"]))
+UPSTREAM_RETRIES = registry.register(Counter(
+    "tourplanner_upstream_retries_total", "Upstream calls retried after a failure", ["upstream"]))
+UPSTREAM_HEDGES = registry.register(Counter(
+    "tourplanner_upstream_hedges_total", "Hedged second attempts fired", ["upstream"]))
+UPSTREAM_REJECTED = registry.register(Counter(
+    "tourplanner_upstream_rejected_total", "Calls not made: rate limit or deadline", ["upstream", "reason"]))
+
+class UpstreamError(Exception):
+    """An upstream call failed for good (retries exhausted, rate limited, or out of time)"""
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+class UpstreamStatusError(Exception):
+    """Unsuccessful response; retried only when the status says trying again can help"""
+
+    def __init__(self, status, message=""):
+        super().__init__(f"status {status}{': ' + message if message else ''}")
+        self.status = status
+        self.retryable = status == 429 or status >= 500
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, UpstreamStatusError):
+        return e.retryable
+    # Malformed output (ValueError, incl. JSONDecodeError) comes back the same at temperature 0
+    return not isinstance(e, (ValueError, UpstreamError))
+
+@contextmanager
+def deadline(seconds):
+    """Run the block with a deadline `seconds` from now (an earlier enclosing deadline wins)"""
+    at = time.monotonic() + seconds
+    current = deadline_var.get()
+    token = deadline_var.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        deadline_var.reset(token)
+
+def remaining():
+    """Seconds left before the current deadline, or None when there is none"""
+    at = deadline_var.get()
+    return None if at is None else at - time.monotonic()
+
+class TokenBucket:
+    """rate tokens/second, up to burst saved up. A caller that finds the bucket
+    empty reserves a token and is told how long to wait for it."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, cost=1, max_wait=None):
+        """Seconds to wait before using the reserved tokens, or None (nothing reserved) if that exceeds max_wait"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait_secs = 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+            if max_wait is not None and wait_secs > max_wait:
+                return None
+            self.tokens -= cost
+            return wait_secs
+
+class Upstream:
+    def __init__(self, name, max_concurrency, rate_per_sec=0.0, burst=1, timeout=30.0, retries=2,
+                 backoff_base=0.25, backoff_max=4.0):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.bucket = TokenBucket(rate_per_sec, burst) if rate_per_sec > 0 else None
+        self._thread_slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self._async_slots = asyncio.Semaphore(max(1, max_concurrency))
+
+    @classmethod
+    def from_env(cls, name, prefix, max_concurrency, rate_per_sec, burst, timeout, retries):
+        """Policy with each setting overridable as {prefix}_MAX_CONCURRENCY, _RATE_PER_SEC, _BURST, _TIMEOUT_SECS, _RETRIES"""
+        env = lambda key, default: os.getenv(f"{prefix}_{key}", str(default))
+        return cls(
+            name,
+            max_concurrency=int(env("MAX_CONCURRENCY", max_concurrency)),
+            rate_per_sec=float(env("RATE_PER_SEC", rate_per_sec)),
+            burst=float(env("BURST", burst)),
+            timeout=float(env("TIMEOUT_SECS", timeout)),
+            retries=int(env("RETRIES", retries)),
+        )
+
+    def attempt_timeout(self):
+        """This upstream's timeout, cut short by the request deadline"""
+        left = remaining()
+        if left is None:
+            return self.timeout
+        if left <= 0:
+            UPSTREAM_REJECTED.inc(upstream=self.name, reason="deadline")
+            raise DeadlineExceeded(f"{self.name}: request deadline exceeded")
+        return min(self.timeout, left)
+
+    def _token_wait(self, timeout, cost):
+        if self.bucket is None:
+            return 0.0
+        wait_secs = self.bucket.reserve(cost, max_wait=timeout)
+        if wait_secs is None:
+            UPSTREAM_REJECTED.inc(upstream=self.name, reason="rate_limited")
+            raise UpstreamError(f"{self.name}: rate limited for longer than {timeout:.1f}s")
+        return wait_secs
+
+    def _backoff(self, attempt):
+        """Full jitter: uniform in [0, min(max, base * 2^attempt)]"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _after_failure(self, attempt, e):
+        """Delay before the next attempt, or None to give up"""
+        UPSTREAM_ERRORS.inc(upstream=self.name)
+        if attempt >= self.retries or not _retryable(e):
+            return None
+        delay = self._backoff(attempt)
+        left = remaining()
+        if left is not None and delay >= left:
+            return None
+        UPSTREAM_RETRIES.inc(upstream=self.name)
+        logger.info(f"{self.name} call failed ({str(e)}), retry {attempt + 1}/{self.retries} in {delay:.2f}s")
+        return delay
+
+    def call(self, fn, *args, cost=1, **kwargs):
+        """fn(timeout, *args, **kwargs) under this policy; fn must honour timeout.
+        cost is the number of rate-limit tokens one attempt uses. Raises UpstreamError."""
+        attempt = 0
+        while True:
+            timeout = self.attempt_timeout()
+            time.sleep(self._token_wait(timeout, cost))
+            timeout = self.attempt_timeout()
+            if not self._thread_slots.acquire(timeout=timeout):
+                raise UpstreamError(f"{self.name}: no free connection slot within {timeout:.1f}s")
+            start = time.perf_counter()
+            try:
+                return fn(timeout, *args, **kwargs)
+            except Exception as e:
+                error = e
+            finally:
+                self._thread_slots.release()
+                UPSTREAM_SECONDS.observe(time.perf_counter() - start, upstream=self.name)
+            delay = self._after_failure(attempt, error)
+            if delay is None:
+                raise UpstreamError(f"{self.name} call failed after {attempt + 1} attempt(s): {str(error)}") from error
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, fn, *args, cost=1, **kwargs):
+        """Async call: await fn(timeout, *args, **kwargs). The attempt is also cancelled
+        if it overruns timeout by more than a second."""
+        attempt = 0
+        while True:
+            timeout = self.attempt_timeout()
+            await asyncio.sleep(self._token_wait(timeout, cost))
+            timeout = self.attempt_timeout()
+            try:
+                await asyncio.wait_for(self._async_slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise UpstreamError(f"{self.name}: no free connection slot within {timeout:.1f}s") from None
+            start = time.perf_counter()
+            try:
+                return await asyncio.wait_for(fn(timeout, *args, **kwargs), timeout + 1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = e
+            finally:
+                self._async_slots.release()
+                UPSTREAM_SECONDS.observe(time.perf_counter() - start, upstream=self.name)
+            delay = self._after_failure(attempt, error)
+            if delay is None:
+                raise UpstreamError(f"{self.name} call failed after {attempt + 1} attempt(s): {str(error)}") from error
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def hedged(self, fn, *args, hedge_after=None, **kwargs):
+        """call(), plus a second concurrent attempt if the first has not finished
+        after hedge_after seconds; the first success wins.
+
+        fn(timeout, cancelled, *args, **kwargs) gets a threading.Event that is
+        set once the other attempt has won, and should stop work when it is.
+        """
+        cancelled = threading.Event()
+        if not hedge_after:
+            return self.call(fn, cancelled, *args, **kwargs)
+        submit = lambda: _get_hedge_pool().submit(contextvars.copy_context().run, self.call, fn, cancelled, *args, **kwargs)
+        pending = {submit()}
+        done, pending = wait(pending, timeout=hedge_after)
+        if not done:
+            UPSTREAM_HEDGES.inc(upstream=self.name)
+            pending.add(submit())
+        error = None
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    cancelled.set()
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                raise error
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    async def ahedged(self, fn, *args, hedge_after=None, **kwargs):
+        """Async hedged(): fn(timeout, *args, **kwargs); the losing attempt is cancelled"""
+        if not hedge_after:
+            return await self.acall(fn, *args, **kwargs)
+        pending = {asyncio.ensure_future(self.acall(fn, *args, **kwargs))}
+        done, pending = await asyncio.wait(pending, timeout=hedge_after)
+        if not done:
+            UPSTREAM_HEDGES.inc(upstream=self.name)
+            pending.add(asyncio.ensure_future(self.acall(fn, *args, **kwargs)))
+        error = None
+        try:
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+# Hedged sync attempts run here so the caller can wait on both
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "8"))
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+def _get_hedge_pool():
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+        return _hedge_pool
+
+llm_upstream = Upstream.from_env("llm", "LLM", max_concurrency=16, rate_per_sec=0, burst=1, timeout=45, retries=1)
+# Distance Matrix quota is counted in elements (origins x destinations), so maps tokens are elements
+maps_upstream = Upstream.from_env("maps", "MAPS", max_concurrency=16, rate_per_sec=1000, burst=1000, timeout=10, retries=2)
+# Fire a second LLM generation when the first hasn't finished after this many seconds (0 disables)
+LLM_HEDGE_AFTER_SECS = float(os.getenv("LLM_HEDGE_AFTER_SECS", "20"))
@@ -0,0 +1,269 @@
+"""Offline benchmarks for the planning pipeline.
+
+Runs every stage against fakes (recorded LLM completion, a local Distance
+Matrix stand-in, the local hashing embedder and a temporary ChromaDB), on
+synthetic city catalogs of increasing size, and reports latency percentiles,
+throughput and peak allocations per stage.
+
+    python benchmarks/bench_pipeline.py                      # compare with baseline.json
+    python benchmarks/bench_pipeline.py --save-baseline      # record a new baseline
+    python benchmarks/bench_pipeline.py --sizes 20,100 --repeat 10
+
+Exits with status 1 when a stage's p50 latency or peak allocation is more
+than --max-regression times its baseline. Timings are machine-specific, so
+record the baseline on the machine (or CI runner) that does the comparing.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+APP_DIR = BENCH_DIR.parent / "app"
+DEFAULT_BASELINE = BENCH_DIR / "baseline.json"
+
+def _configure_environment(workdir):
+    """Everything offline and in temp/memory; must run before the app modules are imported"""
+    os.environ.update({
+        "OPENAI_API_KEY": "offline-benchmark",
+        "EMBEDDING_PROVIDER": "local",
+        "EMBEDDING_CACHE_DIR": "",
+        "CHROMA_DIR": os.path.join(workdir, "chroma_db"),
+        "SNAPSHOT_DIR": os.path.join(workdir, "snapshots"),
+        "TRAVEL_CACHE_PATH": "",
+        "POI_CACHE_PATH": "",
+        "ITINERARY_CACHE_PATH": "",
+        "MAPS_API_KEY": "offline-benchmark",
+        # The fake Distance Matrix has no quota; measure the code, not the rate limiter
+        "MAPS_RATE_PER_SEC": "0",
+        "LOG_LEVEL": "WARNING",
+    })
+    sys.path.insert(0, str(APP_DIR))
+    sys.path.insert(0, str(BENCH_DIR))
+
+class _Quiet:
+    """Swallows anything written to stdout while a stage is being timed"""
+
+    def write(self, _):
+        return 0
+
+    def flush(self):
+        pass
+
+    def __enter__(self):
+        self._stdout = sys.stdout
+        sys.stdout = self
+        return self
+
+    def __exit__(self, *exc):
+        sys.stdout = self._stdout
+        return False
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * q / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def measure(fn, repeat, max_seconds, ops=1, setup=None):
+    """Time fn() up to `repeat` times (bounded by max_seconds) and measure peak allocations of one extra call"""
+    with _Quiet():
+        if setup:
+            setup()
+        fn()  # warm-up
+        timings = []
+        deadline = time.perf_counter() + max_seconds
+        for _ in range(repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1000.0)
+            if time.perf_counter() > deadline:
+                break
+        if setup:
+            setup()
+        tracemalloc.start()
+        base, _ = tracemalloc.get_traced_memory()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    timings.sort()
+    mean = sum(timings) / len(timings)
+    return {
+        "runs": len(timings),
+        "p50_ms": round(_percentile(timings, 50), 4),
+        "p95_ms": round(_percentile(timings, 95), 4),
+        "p99_ms": round(_percentile(timings, 99), 4),
+        "mean_ms": round(mean, 4),
+        "ops_per_sec": round(ops * 1000.0 / mean, 1) if mean > 0 else 0.0,
+        "peak_kib": round((peak - base) / 1024.0, 1),
+    }
+
+def load_catalog(store_manager, get_embeddings, pois, batch_size=1000):
+    collection = store_manager.get_store()._collection
+    embeddings = get_embeddings()
+    from chroma_store import poi_text
+    for start in range(0, len(pois), batch_size):
+        batch = pois[start:start + batch_size]
+        texts = [poi_text(p) for p in batch]
+        collection.upsert(ids=[p["id"] for p in batch], embeddings=embeddings.embed_documents(texts),
+                          metadatas=batch, documents=texts)
+
+def run(args):
+    import agent
+    import tools
+    import settings
+    from replan import replan_itinerary
+    from city_snapshot import build_snapshot
+    from chroma_store import store_manager, get_embeddings
+    from spatial import CityIndex
+    from fakes import FakeChatModel, FakeMapsSession, recorded_llm_response, synthetic_catalog
+
+    maps = FakeMapsSession(latency_ms=args.maps_latency_ms)
+    tools.http_session = maps
+    tools.MAPS_KEY = "offline-benchmark"
+    settings.set_llm(FakeChatModel(recorded_llm_response(), first_token_ms=args.llm_latency_ms))
+
+    results = {}
+
+    def record(name, stats):
+        results[name] = stats
+        print(f"{name:<34} p50 {stats['p50_ms']:>10.3f} ms  p95 {stats['p95_ms']:>10.3f} ms  "
+              f"p99 {stats['p99_ms']:>10.3f} ms  {stats['ops_per_sec']:>11.1f} ops/s  peak {stats['peak_kib']:>9.1f} KiB")
+
+    prefs = {"interests": ["art", "food", "history"]}
+    dates_for = lambda days: {"start": "2025-06-01", "end": f"2025-06-{days:02d}"}
+
+    record("llm_generation/15", measure(
+        lambda: agent.generate_pois_with_llm("Lisbon", prefs), args.repeat, args.max_seconds))
+    record("llm_generation_early_stop/10", measure(
+        lambda: agent.generate_pois_with_llm("Lisbon", prefs, max_pois=10), args.repeat, args.max_seconds))
+
+    for n in args.sizes:
+        city = f"Benchcity{n}"
+        catalog = synthetic_catalog(city, n, seed=n)
+        print(f"-- {city}: loading {n} POIs into ChromaDB")
+        with _Quiet():
+            load_catalog(store_manager, get_embeddings, catalog)
+        # Matrix and scheduling stages use the top-ranked min(n, --matrix-pois) POIs
+        m = min(n, args.matrix_pois)
+        ranked = agent.rank_pois(catalog, prefs)
+        subset = ranked[:m]
+
+        record(f"rank_pois/{n}", measure(lambda: agent.rank_pois(catalog, prefs), args.repeat, args.max_seconds))
+        record(f"retrieval/{n}", measure(lambda: agent._retrieve_pois(city, prefs), args.repeat, args.max_seconds))
+        index = CityIndex(catalog)
+        record(f"spatial_radius_1km/{n}", measure(
+            lambda: index.within_radius(catalog[0]["lat"], catalog[0]["lng"], 1.0), args.repeat, args.max_seconds))
+
+        record(f"travel_matrix_cold/{n}", measure(
+            lambda: tools.travel_time_matrix(subset), args.repeat, args.max_seconds, setup=lambda: tools.get_travel_cache().clear()))
+        record(f"travel_matrix_warm/{n}", measure(
+            lambda: tools.travel_time_matrix(subset), args.repeat, args.max_seconds))
+        pairs = [(subset[i], subset[(i * 7 + 3) % m]) for i in range(m)]
+        record(f"estimate_travel_time/{n}", measure(
+            lambda: [tools.estimate_travel_time_minutes(a, b) for a, b in pairs], args.repeat, args.max_seconds, ops=len(pairs)))
+
+        matrix = tools.travel_time_matrix(subset)
+        for days in args.days:
+            record(f"build_itinerary_{days}d/{n}", measure(
+                lambda: agent.build_itinerary(city, subset, matrix, 8, dates_for(days)), args.repeat, args.max_seconds))
+
+        record(f"plan_itinerary/{n}", measure(
+            lambda: agent._plan_itinerary(city, dates_for(3), prefs, 8), args.repeat, args.max_seconds))
+        record(f"plan_itinerary_cached/{n}", measure(
+            lambda: agent.plan_itinerary(city, dates_for(3), prefs, 8), args.repeat, args.max_seconds))
+        planned = agent.plan_itinerary(city, dates_for(3), prefs, 8)
+        first_stop = planned["itinerary"][0]["steps"][0]["name"]
+        record(f"replan_drop/{n}", measure(
+            lambda: replan_itinerary(city, dates_for(3), prefs, 8, planned, drop=[first_stop]), args.repeat, args.max_seconds))
+
+        # Last for this city: once the snapshot exists, planning uses it instead of ChromaDB
+        with _Quiet():
+            build_snapshot(city)
+        record(f"plan_itinerary_snapshot/{n}", measure(
+            lambda: agent._plan_itinerary(city, dates_for(3), prefs, 8), args.repeat, args.max_seconds))
+
+    return results
+
+def compare(results, baseline, max_regression):
+    """Return human-readable regression lines (empty when everything is within bounds)"""
+    regressions = []
+    for name, stats in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        # Absolute floors keep sub-0.25 ms / 64 KiB noise from tripping the check
+        if stats["p50_ms"] > base["p50_ms"] * max_regression and stats["p50_ms"] - base["p50_ms"] > 0.25:
+            regressions.append(f"{name}: p50 {base['p50_ms']:.3f} ms -> {stats['p50_ms']:.3f} ms "
+                               f"({stats['p50_ms'] / base['p50_ms']:.2f}x)")
+        if stats["peak_kib"] > base["peak_kib"] * max_regression and stats["peak_kib"] - base["peak_kib"] > 64:
+            regressions.append(f"{name}: peak {base['peak_kib']:.1f} KiB -> {stats['peak_kib']:.1f} KiB "
+                               f"({stats['peak_kib'] / max(base['peak_kib'], 1e-9):.2f}x)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline planning pipeline benchmarks")
+    parser.add_argument("--sizes", default="20,100,1000,10000", help="comma-separated catalog sizes")
+    parser.add_argument("--days", default="1,3,7", help="comma-separated trip lengths for build_itinerary")
+    parser.add_argument("--matrix-pois", type=int, default=100, help="max POIs in travel matrix / scheduling stages")
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--max-seconds", type=float, default=5.0, help="time cap per stage")
+    parser.add_argument("--maps-latency-ms", type=float, default=0.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    parser.add_argument("--save-baseline", action="store_true", help="write results to --baseline instead of comparing")
+    parser.add_argument("--max-regression", type=float, default=2.0, help="fail when a stage is this many times slower")
+    parser.add_argument("--json", default=None, help="also write results to this file")
+    args = parser.parse_args()
+    args.sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    args.days = [int(d) for d in args.days.split(",") if d.strip()]
+
+    workdir = tempfile.mkdtemp(prefix="tourplanner-bench-")
+    _configure_environment(workdir)
+    try:
+        results = run(args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "matrix_pois": args.matrix_pois,
+            "maps_latency_ms": args.maps_latency_ms,
+            "llm_latency_ms": args.llm_latency_ms,
+        },
+        "results": results,
+    }
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2, sort_keys=True))
+    if args.save_baseline:
+        Path(args.baseline).write_text(json.dumps(report, indent=2, sort_keys=True) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one")
+        return 0
+    baseline = json.loads(Path(args.baseline).read_text())["results"]
+    regressions = compare(results, baseline, args.max_regression)
+    if regressions:
+        print(f"\nREGRESSIONS (> {args.max_regression}x baseline):")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"\nNo regressions against {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
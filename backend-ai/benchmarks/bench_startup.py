@@ -0,0 +1,109 @@
+"""Cold-start benchmark: how long a fresh worker takes to import the app,
+run its startup hooks and answer its first requests.
+
+Each run is a separate interpreter (nothing warm in sys.modules), offline
+like bench_pipeline: local embeddings, a temporary ChromaDB and a recorded
+LLM completion.
+
+    python benchmarks/bench_startup.py                     # 5 runs per warm-up mode
+    python benchmarks/bench_startup.py --runs 10 --modes off,blocking
+
+Reports, per WARM_UP_MODE, the median and worst of:
+  import_s        import main
+  startup_s       FastAPI startup hooks
+  first_health_s  first GET /health
+  first_plan_s    first POST /plan_trip (cold Chroma, generated POIs)
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+APP_DIR = BENCH_DIR.parent / "app"
+METRICS = ("import_s", "startup_s", "first_health_s", "first_plan_s")
+
+def child():
+    """One cold start; prints the timings as JSON on the last line of stdout"""
+    import time
+    timings = {}
+    start = time.perf_counter()
+    import main
+    timings["import_s"] = time.perf_counter() - start
+
+    import settings
+    from fakes import FakeChatModel, recorded_llm_response
+    from fastapi.testclient import TestClient
+    settings.set_llm(FakeChatModel(recorded_llm_response()))
+
+    start = time.perf_counter()
+    client = TestClient(main.app)
+    client.__enter__()  # runs the startup hooks
+    timings["startup_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert client.get("/health").status_code == 200
+    timings["first_health_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    body = {"destination": "Lisbon", "dates": {"start": "2025-06-01", "end": "2025-06-02"}, "interests": ["art", "food"]}
+    result = client.post("/plan_trip", json=body).json()
+    timings["first_plan_s"] = time.perf_counter() - start
+    if "error" in result:
+        raise SystemExit(f"/plan_trip failed: {result['error']}")
+    client.__exit__(None, None, None)
+    print(json.dumps(timings))
+
+def run_once(mode):
+    workdir = tempfile.mkdtemp(prefix="tourplanner-startup-")
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "offline-benchmark",
+        "EMBEDDING_PROVIDER": "local",
+        "EMBEDDING_CACHE_DIR": "",
+        "CHROMA_DIR": os.path.join(workdir, "chroma_db"),
+        "TRAVEL_CACHE_PATH": "",
+        "POI_CACHE_PATH": "",
+        "MAPS_API_KEY": "",
+        "LOG_LEVEL": "WARNING",
+        "WARM_UP_MODE": mode,
+        "PYTHONPATH": os.pathsep.join([str(APP_DIR), str(BENCH_DIR)]),
+    })
+    try:
+        out = subprocess.run([sys.executable, __file__, "--child"], env=env, cwd=workdir,
+                             capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        raise SystemExit(f"Cold start failed (WARM_UP_MODE={mode}):\n{e.stdout}\n{e.stderr}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main():
+    if "--child" in sys.argv:
+        child()
+        return 0
+    parser = argparse.ArgumentParser(description="Worker cold-start benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modes", default="background,blocking,off", help="comma-separated WARM_UP_MODE values")
+    parser.add_argument("--json", default=None, help="also write results to this file")
+    args = parser.parse_args()
+
+    report = {}
+    for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+        runs = [run_once(mode) for _ in range(args.runs)]
+        report[mode] = {}
+        for metric in METRICS:
+            values = sorted(r[metric] for r in runs)
+            report[mode][metric] = {"median": round(values[len(values) // 2], 4), "max": round(values[-1], 4)}
+        cells = "  ".join(f"{m} {report[mode][m]['median']:.3f}s (max {report[mode][m]['max']:.3f})" for m in METRICS)
+        print(f"WARM_UP_MODE={mode:<10} {cells}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
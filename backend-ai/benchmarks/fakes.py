@@ -0,0 +1,126 @@
+"""Offline stand-ins for the LLM and the Distance Matrix API used by the benchmarks."""
+import math
+import random
+import time
+from pathlib import Path
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+CATEGORIES = [
+    "art", "history", "food", "nature", "architecture", "shopping", "landmarks",
+    "museums", "nightlife", "markets", "parks", "religion", "culture", "family",
+]
+
+def recorded_llm_response(name="llm_pois_response.txt"):
+    return (FIXTURES / name).read_text(encoding="utf-8")
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+
+class FakeChatModel:
+    """Replays a recorded completion, streamed in fixed-size chunks.
+
+    first_token_ms / chunk_ms add simulated latency so streaming and
+    early-stop behaviour can be measured; both default to 0.
+    """
+
+    def __init__(self, response_text, chunk_size=16, first_token_ms=0.0, chunk_ms=0.0):
+        self.response_text = response_text
+        self.chunk_size = chunk_size
+        self.first_token_ms = first_token_ms
+        self.chunk_ms = chunk_ms
+        self.calls = 0
+
+    def _chunks(self):
+        text = self.response_text
+        return [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+
+    def invoke(self, messages, **kwargs):
+        self.calls += 1
+        time.sleep((self.first_token_ms + self.chunk_ms * len(self._chunks())) / 1000.0)
+        return FakeMessage(self.response_text)
+
+    async def ainvoke(self, messages, **kwargs):
+        import asyncio
+        self.calls += 1
+        await asyncio.sleep((self.first_token_ms + self.chunk_ms * len(self._chunks())) / 1000.0)
+        return FakeMessage(self.response_text)
+
+    def stream(self, messages, **kwargs):
+        self.calls += 1
+        time.sleep(self.first_token_ms / 1000.0)
+        for chunk in self._chunks():
+            if self.chunk_ms:
+                time.sleep(self.chunk_ms / 1000.0)
+            yield FakeMessage(chunk)
+
+    async def astream(self, messages, **kwargs):
+        import asyncio
+        self.calls += 1
+        await asyncio.sleep(self.first_token_ms / 1000.0)
+        for chunk in self._chunks():
+            await asyncio.sleep(self.chunk_ms / 1000.0)
+            yield FakeMessage(chunk)
+
+class _FakeResponse:
+    def __init__(self, payload):
+        self.ok = True
+        self.status_code = 200
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+def _km(a, b):
+    phi1, phi2 = math.radians(a[0]), math.radians(b[0])
+    dphi = phi2 - phi1
+    dlam = math.radians(b[1] - a[1])
+    h = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlam / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(h))
+
+class FakeMapsSession:
+    """Answers Distance Matrix requests from great-circle distance at 4.5 km/h plus a 2 minute overhead"""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.requests = 0
+        self.elements = 0
+
+    def get(self, url, params=None, **kwargs):
+        self.requests += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+        origins = [tuple(map(float, o.split(","))) for o in params["origins"].split("|")]
+        destinations = [tuple(map(float, d.split(","))) for d in params["destinations"].split("|")]
+        self.elements += len(origins) * len(destinations)
+        rows = [{"elements": [{"status": "OK", "duration": {"value": int(_km(o, d) / 4.5 * 3600) + 120}}
+                              for d in destinations]} for o in origins]
+        return _FakeResponse({"rows": rows, "status": "OK"})
+
+def synthetic_catalog(city, n, seed=0, center=(38.72, -9.14), spread_km=6.0):
+    """n deterministic POI metadata dicts scattered around center"""
+    rng = random.Random(seed)
+    dlat = spread_km / 111.0
+    dlng = spread_km / (111.0 * math.cos(math.radians(center[0])))
+    pois = []
+    for i in range(n):
+        cats = rng.sample(CATEGORIES, rng.randint(1, 3))
+        poi = {
+            "id": f"bench_{city.lower()}_{i}",
+            "name": f"{city} {cats[0].title()} Spot {i}",
+            "city": city,
+            "city_norm": city.lower(),
+            "category": ",".join(cats),
+            "desc": f"A {' and '.join(cats)} place in {city} (synthetic POI {i}).",
+            "duration_mins": rng.choice([30, 45, 60, 90, 120, 150]),
+            "lat": round(center[0] + rng.uniform(-dlat, dlat), 6),
+            "lng": round(center[1] + rng.uniform(-dlng, dlng), 6),
+            "source": "benchmark",
+        }
+        if i % 3 == 0:
+            opens = rng.choice([8, 9, 10])
+            poi["open"] = f"{opens:02d}:00"
+            poi["close"] = f"{opens + rng.choice([6, 8, 10]):02d}:00"
+        pois.append(poi)
+    return pois